@@ -3,96 +3,382 @@ You're expected to send messages via queues (async): *message_queue*.
 This is a module with underlying synchronous implementation.
 """
 import logging
+import math
+import random
 import time
-from typing import Iterable
-
-from telegram import Bot, Message as TgMessage
-from telegram.error import Unauthorized, BadRequest
-
-from rest_food.db import set_inactive
-from rest_food.entities import Reply
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, replace
+from functools import partial
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from telegram import Bot
+from telegram.error import Unauthorized, BadRequest, RetryAfter, NetworkError, TimedOut
+from telegram.utils.request import Request
+
+from rest_food.db import set_inactive, set_inactive_many
+from rest_food.entities import Reply, OriginalMessage
 from rest_food.enums import Provider, Workflow
-from rest_food.settings import TEST_TG_CHAT_ID, TELEGRAM_TOKEN_DEMAND, TELEGRAM_TOKEN_SUPPLY, STAGE
+from rest_food.exceptions import RetryLater
+from rest_food.rate_limit import RateLimiter, get_rate_limiter
+from rest_food.settings import (
+    TEST_TG_CHAT_ID, TELEGRAM_TOKEN_DEMAND, TELEGRAM_TOKEN_SUPPLY, TELEGRAM_API_URL, TG_SEND_CONCURRENCY,
+    FAKE_BOT,
+    FAKE_BOT_LATENCY,
+    FAKE_BOT_LATENCY_SIGMA,
+    FAKE_BOT_TOO_MANY_REQUESTS_RATIO,
+    FAKE_BOT_RETRY_AFTER,
+    FAKE_BOT_FORBIDDEN_RATIO,
+    FAKE_BOT_CHAT_NOT_FOUND_RATIO,
+    FAKE_BOT_TIMEOUT_RATIO,
+)
 
 logger = logging.getLogger(__name__)
 
 
 class FakeBot:
-    sleep_time = 0.2
-
-    def __init__(self, bot: Bot):
+    """
+    Simulates Bot API calls to chats other than `TEST_TG_CHAT_ID`: waits for a random latency and fails
+        at configured rates the way Telegram does, so that load tests go through the real error handling.
+        Blocked and not found chats are chosen by chat id, so they stay the same for every call.
+    Calls are counted per method and outcome, latencies are kept for the latest `max_latencies` calls.
+        The stats are logged every `log_every` calls.
+    """
+    # Method name -> position of `chat_id` argument.
+    simulated_methods = {
+        'send_message': 0,
+        'send_location': 0,
+        'edit_message_text': 1,
+        'delete_message': 0,
+    }
+    max_latencies = 10000
+    log_every = 1000
+
+    def __init__(
+            self,
+            bot: Bot,
+            *,
+            latency: float=FAKE_BOT_LATENCY,
+            latency_sigma: float=FAKE_BOT_LATENCY_SIGMA,
+            too_many_requests_ratio: float=FAKE_BOT_TOO_MANY_REQUESTS_RATIO,
+            retry_after: int=FAKE_BOT_RETRY_AFTER,
+            forbidden_ratio: float=FAKE_BOT_FORBIDDEN_RATIO,
+            chat_not_found_ratio: float=FAKE_BOT_CHAT_NOT_FOUND_RATIO,
+            timeout_ratio: float=FAKE_BOT_TIMEOUT_RATIO,
+            seed: Optional[int]=None,
+    ):
         self._bot = bot
+        self._latency = latency
+        self._latency_sigma = latency_sigma
+        self._too_many_requests_ratio = too_many_requests_ratio
+        self._retry_after = retry_after
+        self._forbidden_ratio = forbidden_ratio
+        self._chat_not_found_ratio = chat_not_found_ratio
+        self._timeout_ratio = timeout_ratio
+        self._seed = seed
+        self._random = random.Random(seed)
+        self._lock = Lock()
+        self.calls = Counter()  # type: Counter[Tuple[str, str]]
+        self.latencies = defaultdict(partial(deque, maxlen=self.max_latencies))  # type: Dict[str, deque]
+
+    def __getattr__(self, name):
+        method = getattr(self._bot, name)
+        if name not in self.simulated_methods:
+            return method
+
+        def simulated_method(*args, **kwargs):
+            chat_id = kwargs['chat_id'] if 'chat_id' in kwargs else args[self.simulated_methods[name]]
+            if chat_id in TEST_TG_CHAT_ID:
+                return method(*args, **kwargs)
+
+            return self._simulate(name, chat_id)
+
+        return simulated_method
+
+    def _get_latency(self) -> float:
+        with self._lock:
+            if not self._latency_sigma or not self._latency:
+                return self._latency
+            return self._random.lognormvariate(math.log(self._latency), self._latency_sigma)
+
+    def _is_chat_failed(self, chat_id, *, kind: str, ratio: float) -> bool:
+        return ratio > 0 and random.Random(f'{self._seed}:{kind}:{chat_id}').random() < ratio
+
+    def _get_error(self, chat_id) -> Tuple[str, Optional[Exception]]:
+        if self._is_chat_failed(chat_id, kind='forbidden', ratio=self._forbidden_ratio):
+            return 'forbidden', Unauthorized('Forbidden: bot was blocked by the user')
+
+        if self._is_chat_failed(chat_id, kind='chat_not_found', ratio=self._chat_not_found_ratio):
+            return 'chat_not_found', BadRequest('Chat not found')
+
+        with self._lock:
+            value = self._random.random()
+
+        if value < self._too_many_requests_ratio:
+            return 'too_many_requests', RetryAfter(self._retry_after)
+        if value < self._too_many_requests_ratio + self._timeout_ratio:
+            return 'timeout', TimedOut()
+
+        return 'ok', None
+
+    def _simulate(self, name: str, chat_id):
+        latency = self._get_latency()
+        time.sleep(latency)
+        outcome, error = self._get_error(chat_id)
+
+        with self._lock:
+            self.calls[name, outcome] += 1
+            self.latencies[name].append(latency)
+            total = sum(self.calls.values())
+
+        if total % self.log_every == 0:
+            logger.info('Fake Bot API stats: %s', self.get_stats())
+
+        if error is not None:
+            raise error
+
+    def get_stats(self) -> Dict[str, dict]:
+        """
+        Returns
+        -------
+        Calls count per outcome and latency percentiles per method.
+
+        """
+        with self._lock:
+            stats = {}
+            for name, latencies in self.latencies.items():
+                latencies = sorted(latencies)
+                stats[name] = {
+                    'calls': {outcome: v for (method, outcome), v in self.calls.items() if method == name},
+                    'p50': latencies[len(latencies) // 2],
+                    'p99': latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)],
+                }
+
+            return stats
+
+
+class RateLimitedBot:
+    """
+    Reserves rate limiter slots before chat-bound Bot API calls.
+        Telegram `RetryAfter` blocks the whole bot for the time requested and is raised as `RetryLater`.
+    """
+    # Method name -> position of `chat_id` argument.
+    limited_methods = {
+        'send_message': 0,
+        'send_location': 0,
+        'edit_message_text': 1,
+        'delete_message': 0,
+    }
 
-    def _sleep(self):
-        logger.warning('Sleep for %s s', self.sleep_time)
-        time.sleep(0.2)
-
-    def send_location(self, chat_id, *args, **kwargs):
-        if chat_id in TEST_TG_CHAT_ID:
-            return self._bot.send_location(chat_id, *args, **kwargs)
-        else:
-            self._sleep()
+    def __init__(self, bot, *, token: str, rate_limiter: RateLimiter):
+        self._bot = bot
+        self._bot_key = rate_limiter.build_bot_key(token)
+        self._rate_limiter = rate_limiter
 
-    def edit_message_text(self, text, chat_id, *args, **kwargs):
-        if chat_id in TEST_TG_CHAT_ID:
-            return self._bot.edit_message_text(text, chat_id, *args, **kwargs)
-        else:
-            self._sleep()
+    def __getattr__(self, name):
+        method = getattr(self._bot, name)
+        if name not in self.limited_methods:
+            return method
 
-    def send_message(self, chat_id, *args, **kwargs):
-        if chat_id in TEST_TG_CHAT_ID:
-            return self._bot.send_message(chat_id, *args, **kwargs)
-        else:
-            self._sleep()
+        def limited_method(*args, **kwargs):
+            chat_id = kwargs['chat_id'] if 'chat_id' in kwargs else args[self.limited_methods[name]]
+            self._rate_limiter.acquire(self._bot_key, chat_id)
 
-    def delete_message(self, chat_id, *args, **kwargs):
-        if chat_id in TEST_TG_CHAT_ID:
-            return self._bot.delete_message(chat_id, *args, **kwargs)
-        else:
-            self._sleep()
+            try:
+                return method(*args, **kwargs)
+            except RetryAfter as e:
+                self._rate_limiter.penalize(self._bot_key, e.retry_after)
+                raise RetryLater(e.retry_after) from e
 
-    def set_webhook(self, *args, **kwargs):
-        return self._bot.set_webhook(*args, **kwargs)
+        return limited_method
 
 
-def get_bot(workflow: Workflow):
+def _create_bot(workflow: Workflow):
     if workflow == Workflow.SUPPLY:
         token = TELEGRAM_TOKEN_SUPPLY
     else:
         token = TELEGRAM_TOKEN_DEMAND
 
-    bot = Bot(token)
+    # Connection pool is shared by all the threads sending messages concurrently.
+    bot = Bot(
+        token,
+        base_url=TELEGRAM_API_URL,
+        request=Request(con_pool_size=TG_SEND_CONCURRENCY + 2),
+    )
 
-    if STAGE == 'dev':
-        return FakeBot(bot)
+    if FAKE_BOT:
+        bot = FakeBot(bot)
 
-    return bot
+    return RateLimitedBot(bot, token=token, rate_limiter=get_rate_limiter())
 
 
-def send_messages(
+_bots = {}  # type: Dict[Workflow, RateLimitedBot]
+_send_executor = None
+
+# Chats found blocked while `collect_deactivations` is active.
+_deactivations = ContextVar('deactivations', default=None)  # type: ContextVar[Optional[List[Tuple[int, Workflow]]]]
+
+
+def get_bot(workflow: Workflow):
+    """
+    Bots are created once per process, so that keep-alive connections are reused by warm lambdas.
+    """
+    if workflow not in _bots:
+        _bots[workflow] = _create_bot(workflow)
+
+    return _bots[workflow]
+
+
+def get_send_executor() -> ThreadPoolExecutor:
+    """
+    Thread pool to make Bot API calls concurrently.
+    """
+    global _send_executor
+    if _send_executor is None:
+        _send_executor = ThreadPoolExecutor(max_workers=TG_SEND_CONCURRENCY, thread_name_prefix='tg-send')
+
+    return _send_executor
+
+
+@contextmanager
+def collect_deactivations():
+    """
+    Chats that blocked the bot are deactivated with a single db write on exit.
+
+    Executor threads have to run `send_messages` in a copy of the caller's context (`contextvars.copy_context`).
+
+    Returns
+    -------
+    (chat id, workflow) list of the chats collected so far.
+
+    """
+    chats = []
+    token = _deactivations.set(chats)
+    try:
+        yield chats
+    finally:
+        _deactivations.reset(token)
+        if chats:
+            logger.warning('Deactivating %s blocked chats.', len(chats))
+            set_inactive_many(chats, Provider.TG)
+
+
+def _deactivate(chat_id: int, workflow: Workflow):
+    chats = _deactivations.get()
+    if chats is None:
+        set_inactive(chat_id=chat_id, provider=Provider.TG, workflow=workflow)
+    else:
+        chats.append((chat_id, workflow))
+
+
+@dataclass
+class TgCall:
+    """
+    Bot API call planned to deliver replies.
+    """
+    method: str
+    """ `Bot` method name, like `send_message`.
+    """
+    kwargs: dict
+
+
+# `Bot` method name -> Bot API method name.
+_api_methods = {
+    'send_message': 'sendMessage',
+    'send_location': 'sendLocation',
+    'edit_message_text': 'editMessageText',
+    'delete_message': 'deleteMessage',
+}
+
+
+# Bot API limit for a message text.
+MAX_TEXT_LENGTH = 4096
+
+
+def plan_tg_calls(
     *,
     tg_chat_id: int,
-    original_message: TgMessage = None,
+    original_message: Optional[OriginalMessage] = None,
     replies: Iterable[Reply],
-    workflow: Workflow
-):
+    coalesce: bool=True,
+) -> List[TgCall]:
     """
-    It's intended to be async (vs `build_tg_response`).
+    Returns
+    -------
+    Bot API calls to make one by one to deliver `replies`. The original message (of a callback query)
+        is edited with a text reply or removed.
+        Calls are coalesced: adjacent text replies are merged if possible and the original message
+        is edited or deleted only once.
     """
-    bot = get_bot(workflow)
+    replies = [x for x in replies if x is not None and (x.text or x.coordinates) is not None]
+    calls = _build_tg_calls(tg_chat_id=tg_chat_id, original_message=original_message, replies=replies)
+
+    if not coalesce:
+        return calls
+
+    coalesced = _build_tg_calls(
+        tg_chat_id=tg_chat_id, original_message=original_message, replies=_merge_replies(replies), replace_once=True,
+    )
+    if len(coalesced) < len(calls):
+        logger.info('%s of %s Bot API calls to %s are saved by coalescing.', len(calls) - len(coalesced), len(calls),
+                    tg_chat_id)
+
+    return coalesced
+
+
+def _merge_replies(replies: List[Reply]) -> List[Reply]:
+    """
+    A text reply is merged into the previous one if that has no buttons and the text fits a single message.
+    """
+    merged = []
+
+    for reply in replies:
+        previous = merged and merged[-1]
+        if (
+                previous and previous.text and not previous.buttons and reply.text and not reply.coordinates and
+                len(previous.text) + len(reply.text) + 2 <= MAX_TEXT_LENGTH
+        ):
+            merged[-1] = replace(reply, text=f'{previous.text}\n\n{reply.text}', coordinates=previous.coordinates)
+        else:
+            merged.append(reply)
+
+    return merged
+
+
+def _build_tg_calls(
+    *,
+    tg_chat_id: int,
+    original_message: Optional[OriginalMessage],
+    replies: List[Reply],
+    replace_once: bool=False,
+) -> List[TgCall]:
+    """
+    Parameters
+    ----------
+    replace_once
+        The original message is edited or deleted by the first reply only, the rest are sent.
+            Otherwise every reply replaces it again, so only the last edit stays visible.
+
+    """
+    calls = []
     original_message_can_be_replaced = (
         (original_message and original_message.message_id) is not None
     )
 
-    for reply in filter(lambda x: x is not None and (x.text or x.coordinates) is not None, replies):
+    for reply in replies:
         markup = _build_tg_reply_markup(reply)
 
         if reply.coordinates:
-            bot.send_location(
-                tg_chat_id,
-                *(float(x) for x in reply.coordinates),
-                reply_markup=None if reply.text else markup,
-            )
+            latitude, longitude = (float(x) for x in reply.coordinates)
+            calls.append(TgCall('send_location', {
+                'chat_id': tg_chat_id,
+                'latitude': latitude,
+                'longitude': longitude,
+                'reply_markup': None if reply.text else markup,
+            }))
 
         original_message_should_be_removed = original_message_can_be_replaced
 
@@ -104,39 +390,92 @@ def send_messages(
                 'parse_mode': 'HTML',
             }
 
-            if original_message_can_be_replaced and original_message.text is not None and not reply.is_text_buttons:
-                method = bot.edit_message_text
+            if original_message_can_be_replaced and original_message.has_text and not reply.is_text_buttons:
+                method = 'edit_message_text'
                 original_message_should_be_removed = False
                 kwargs['message_id'] = original_message.message_id
             else:
-                method = bot.send_message
+                method = 'send_message'
 
                 # Actually we can keep track of sent `keyboard` messages and remove them on the next
                 #   interaction with the user.
                 # On the other hand this is not likely to happen as this method is designed to query db.
                 kwargs['reply_markup'] = kwargs['reply_markup'] or {'remove_keyboard': True}
 
-            try:
-                method(**kwargs)
-            except Unauthorized:
-                logger.warning(
-                    '%s is blocked for the bot. ',
-                    tg_chat_id
-                )
-                set_inactive(chat_id=tg_chat_id, provider=Provider.TG, workflow=workflow)
-
-            except BadRequest as e:
-                if 'the same' in e.message:
-                    pass
-                elif 'Chat not found' in e.message:
-                    logger.warning('Tg chat %s not found', tg_chat_id)
-                    set_inactive(chat_id=tg_chat_id, provider=Provider.TG, workflow=workflow)
-                else:
-                    logger.warning('Failed to send to tg_chat_id=%s', tg_chat_id)
-                    raise e
+            calls.append(TgCall(method, kwargs))
 
         if original_message_should_be_removed:
-            bot.delete_message(chat_id=tg_chat_id, message_id=original_message.message_id)
+            calls.append(TgCall('delete_message', {
+                'chat_id': tg_chat_id,
+                'message_id': original_message.message_id,
+            }))
+
+        if replace_once:
+            original_message_can_be_replaced = False
+
+    return calls
+
+
+def send_messages(
+    *,
+    tg_chat_id: int,
+    original_message: Optional[OriginalMessage] = None,
+    replies: Iterable[Reply],
+    workflow: Workflow
+):
+    """
+    It's intended to be async (vs `build_tg_response`).
+        Timeouts and network errors are raised as `RetryLater`. The whole call plan is retried then,
+        so a call which timed out but was made after all, or calls made before it, may be repeated.
+    """
+    bot = get_bot(workflow)
+
+    for call in plan_tg_calls(tg_chat_id=tg_chat_id, original_message=original_message, replies=replies):
+        try:
+            getattr(bot, call.method)(**call.kwargs)
+        except Unauthorized:
+            logger.warning(
+                '%s is blocked for the bot. ',
+                tg_chat_id
+            )
+            _deactivate(tg_chat_id, workflow)
+
+        except BadRequest as e:
+            if 'the same' in e.message:
+                pass
+            elif 'Chat not found' in e.message:
+                logger.warning('Tg chat %s not found', tg_chat_id)
+                _deactivate(tg_chat_id, workflow)
+            else:
+                logger.warning('Failed to send to tg_chat_id=%s', tg_chat_id)
+                raise e
+
+        # `BadRequest` is a `NetworkError` too.
+        except NetworkError as e:
+            logger.warning('Bot API call to %s failed: %s', tg_chat_id, e)
+            raise RetryLater(0) from e
+
+
+def build_inline_tg_response(*, tg_chat_id: int, replies: Iterable[Reply]) -> Optional[dict]:
+    """
+    Telegram makes a single Bot API call given in a webhook response, which saves a queue round trip.
+        It's used only if replies are delivered with a single call, as queued calls could overtake it otherwise.
+        Errors of such a call are not reported, so a blocked chat is not deactivated until the next queued message.
+
+    Returns
+    -------
+    Webhook response, or None if replies have to be queued.
+
+    """
+    calls = plan_tg_calls(tg_chat_id=tg_chat_id, replies=replies)
+    if len(calls) != 1:
+        return None
+
+    call, = calls
+    return {
+        'method': _api_methods[call.method],
+        **{k: v for k, v in call.kwargs.items() if v is not None},
+    }
 
 
 def build_tg_response(*, chat_id: int, reply: Reply):
@@ -0,0 +1,9 @@
+"""
+Sends offer digests which are due (digest mode, see `DIGEST_WINDOW_SECONDS`).
+    It's run by schedule on staging/live (see `serverless.yaml`).
+"""
+from rest_food.communication import flush_digests
+
+
+if __name__ == '__main__':
+    print('%s digests are sent.' % flush_digests())
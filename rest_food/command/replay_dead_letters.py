@@ -0,0 +1,20 @@
+"""
+Queues messages kept in dead letters again, e.g. once Telegram is available after an outage.
+"""
+import argparse
+
+from rest_food.communication import replay_dead_letters
+from rest_food.enums import SendQueue
+
+
+parser = argparse.ArgumentParser(description='Replay dead letters.')
+parser.add_argument('--queue', choices=[x.value for x in SendQueue], help='all the queues by default')
+parser.add_argument('--batch-size', type=int, default=100)
+
+
+if __name__ == '__main__':
+    arguments = parser.parse_args()
+    count = replay_dead_letters(
+        queue=arguments.queue and SendQueue(arguments.queue), batch_size=arguments.batch_size
+    )
+    print('%s dead letters are replayed.' % count)
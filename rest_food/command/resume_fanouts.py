@@ -0,0 +1,9 @@
+"""
+Reschedules unfinished fan-outs which were not advanced recently (e.g. after a worker crash).
+    It's run by schedule on staging/live (see `serverless.yaml`).
+"""
+from rest_food.message_queue import get_mass_queue
+
+
+if __name__ == '__main__':
+    print('%s fan-outs are resumed.' % get_mass_queue().resume_stale_fanouts())
@@ -1,9 +1,12 @@
 """
 This module methods are supposed to return strings.
 """
+import datetime
+from typing import Optional
+
 from rest_food.common.constants import CITIES, CITY_DICT, COUNTRY_DICT
 from rest_food.db import get_supply_editing_message, get_supply_message_record_by_id
-from rest_food.entities import Message, User
+from rest_food.entities import Message, User, Fanout
 from rest_food.enums import UserInfoField
 from rest_food.translation import translate_lazy as _
 
@@ -146,4 +149,35 @@ def location_to_string(location_code: str) -> str:
 
 
 def bold(text: str) -> str:
-    return f'<b>{text}</b>'
\ No newline at end of file
+    return f'<b>{text}</b>'
+
+
+def _seconds_since(dt_from: Optional[datetime.datetime], dt_to: Optional[datetime.datetime]) -> str:
+    if dt_from is None or dt_to is None:
+        return '-'
+
+    return '{:.0f}'.format((dt_to - dt_from).total_seconds())
+
+
+def build_fanout_report_text(fanout: Fanout) -> str:
+    counters = fanout.counters
+    skipped = counters.get('stale', 0) + counters.get('duplicate', 0) + counters.get('capped', 0)
+
+    if fanout.created_at is None:
+        title = _('Publication time is unknown')
+    else:
+        title = _('Published at {} UTC').format(fanout.created_at.strftime('%Y-%m-%d %H:%M'))
+
+    return '\n'.join([
+        bold(title),
+        _('Audience: {}').format(fanout.audience_size),
+        _('Queued: {}').format(fanout.enqueued),
+        _('Delivered: {}').format(counters.get('delivered', 0)),
+        _('Blocked: {}').format(counters.get('blocked', 0)),
+        _('Failed: {}').format(counters.get('failed', 0)),
+        _('Skipped: {}').format(skipped),
+        _('First delivery in {} s, last in {} s').format(
+            _seconds_since(fanout.created_at, fanout.first_delivery_at),
+            _seconds_since(fanout.created_at, fanout.last_delivery_at),
+        ),
+    ])
@@ -2,43 +2,125 @@
 Module with generic wrappers for sending bot messages. They are usually sent via queue.
 """
 
+import datetime
 import logging
-import random
-from typing import Iterable
+import json
+from typing import Dict, Iterable, Optional
 
 from telegram import Message as TgMessage
 
 from rest_food.db import (
     get_message_demanded_user, get_admin_users, set_info,
-    get_demand_users)
-from rest_food.entities import Reply, User
-from rest_food.enums import Workflow, SupplyCommand, UserInfoField, SupplyState
+    get_supply_message_record_by_id, get_user_by_id, get_message_states,
+    add_to_digest, claim_due_digest, set_digest_chunks, finish_digest, get_dead_letters, delete_dead_letters)
+from rest_food.entities import Reply, User, Message, Digest, DeadLetter
+from rest_food.enums import Workflow, SupplyCommand, UserInfoField, SupplyState, MessageState, SendQueue
 from rest_food.message_queue import get_mass_queue, get_single_queue
-from rest_food.settings import FEEDBACK_TG_BOT
+from rest_food.settings import FEEDBACK_TG_BOT, DIGEST_WINDOW_SECONDS, DIGEST_MAX_OFFERS, FANOUT_LEASE_SECONDS
 from rest_food.demand.demand_reply import build_demand_side_short_message, \
-    build_demand_side_message_by_id
+    build_demand_side_message_by_id, build_demand_side_digest_message
 from rest_food.supply.supply_reply import (
     build_supply_side_booked_message, build_new_supplier_notification,
 )
 from rest_food.common.formatters import build_demand_side_full_message_text_by_id
-from rest_food.translation import translate_lazy as _
+from rest_food.translation import translate_lazy as _, switch_language, LANGUAGES_SUPPORTED
 from rest_food.user_utilities import user_language
 
 logger = logging.getLogger(__name__)
 
 
 def publish_supply_event(supply_user: User):
-    users = get_demand_users(location=supply_user.get_info_field(UserInfoField.LOCATION))
-    random.shuffle(users)
+    """
+    Starts a background fan-out of the supplier's editing message to their location audience.
+        In digest mode the message is added to the location digest instead.
+    """
+    if DIGEST_WINDOW_SECONDS:
+        digest = add_to_digest(
+            location=supply_user.get_info_field(UserInfoField.LOCATION),
+            message_id=supply_user.editing_message_id,
+            owner_id=supply_user.id,
+            window=datetime.timedelta(seconds=DIGEST_WINDOW_SECONDS),
+        )
+        if len(digest.offers) == 1:
+            get_mass_queue().schedule_digest_flush(
+                flush_digests, delay=max((digest.flush_at - datetime.datetime.utcnow()).total_seconds(), 0)
+            )
+        return
+
+    # The offer is the same for the whole audience, so it's read once and rendered once per language.
+    _start_offer_fanout(
+        supply_user, get_supply_message_record_by_id(message_id=supply_user.editing_message_id)
+    )
+
+
+def _start_offer_fanout(supply_user: User, message: Message):
+    templates = {}  # type: Dict[str, Reply]
+
+    for language in LANGUAGES_SUPPORTED:
+        with switch_language(language):
+            templates[language] = build_demand_side_short_message(supply_user, message)
+
+    get_mass_queue().start_fanout(
+        templates=templates,
+        message_id=str(message.message_id),
+        owner_id=supply_user.id,
+        location=supply_user.get_info_field(UserInfoField.LOCATION),
+        workflow=Workflow.DEMAND,
+    )
+
+
+def flush_digests() -> int:
+    """
+    Sends every digest which is due. Offers booked or deactivated since they were published are left out.
+
+    Returns
+    -------
+    Number of digests sent.
+
+    """
+    count = 0
+    while True:
+        digest = claim_due_digest(lease=datetime.timedelta(seconds=FANOUT_LEASE_SECONDS))
+        if digest is None:
+            return count
+
+        _flush_digest(digest)
+        count += 1
 
-    message_and_user_list = []
 
-    for user in users:
-        with user_language(user):
-            message = build_demand_side_short_message(supply_user, supply_user.editing_message_id)
-            message_and_user_list.append((message, user))
+def _flush_digest(digest: Digest):
+    states = get_message_states(x['message_id'] for x in digest.offers)
+    published = [i for i, x in enumerate(digest.offers) if states.get(x['message_id']) == MessageState.PUBLISHED]
+    chunks = [published[i:i + DIGEST_MAX_OFFERS] for i in range(0, len(published), DIGEST_MAX_OFFERS)]
+    # Digest messages are rendered again from the record when a demand user gets back to them.
+    set_digest_chunks(digest.digest_id, chunks)
+
+    for number, indexes in enumerate(chunks):
+        chunk = [
+            (get_user_by_id(x['owner_id']), get_supply_message_record_by_id(message_id=x['message_id']))
+            for x in (digest.offers[i] for i in indexes)
+        ]
+        if len(chunk) == 1:
+            _start_offer_fanout(*chunk[0])
+            continue
+
+        templates = {}  # type: Dict[str, Reply]
+        for language in LANGUAGES_SUPPORTED:
+            with switch_language(language):
+                templates[language] = build_demand_side_digest_message(
+                    chunk, digest_id=digest.digest_id, chunk_number=number
+                )
+
+        get_mass_queue().start_fanout(
+            templates=templates,
+            message_id=None,
+            owner_id=None,
+            location=digest.location,
+            workflow=Workflow.DEMAND,
+        )
 
-    get_mass_queue().push_super_batch(message_and_user=message_and_user_list, workflow=Workflow.DEMAND)
+    logger.info('Digest %s of %s offers is sent to %s.', digest.digest_id, len(published), digest.location)
+    finish_digest(digest.digest_id)
 
 
 def notify_supply_for_booked(*, supply_user: User, message_id: str, demand_user: User):
@@ -165,3 +247,60 @@ def queue_messages(
     Put messages into a single-message-queue
     """
     get_single_queue().put(tg_chat_id=tg_chat_id, replies=replies, workflow=workflow, original_message=original_message)
+
+
+def buffer_messages():
+    """
+    Context manager to put all the single-queue messages of a block into the queue at once.
+    """
+    return get_single_queue().buffered()
+
+
+def has_buffered_messages(tg_chat_id: int) -> bool:
+    """
+    Whether messages for the chat are waiting in the `buffer_messages()` block to be queued.
+    """
+    return get_single_queue().has_buffered(tg_chat_id)
+
+
+def replay_dead_letters(*, queue: Optional[SendQueue]=None, batch_size: int=100) -> int:
+    """
+    Queues dead letters again and removes them one by one. Letters which fail again while replaying
+        and malformed letters are kept for later.
+
+    Returns
+    -------
+    Number of letters replayed.
+
+    """
+    started_at = datetime.datetime.utcnow()
+    after_id = None
+    count = 0
+
+    while True:
+        letters = get_dead_letters(queue=queue, created_before=started_at, after_id=after_id, limit=batch_size)
+        if not letters:
+            return count
+
+        for letter in letters:
+            if _requeue_dead_letter(letter):
+                delete_dead_letters([letter.dead_letter_id])
+                count += 1
+
+        after_id = letters[-1].dead_letter_id
+
+
+def _requeue_dead_letter(letter: DeadLetter) -> bool:
+    if letter.queue == SendQueue.MASS:
+        get_mass_queue().requeue(letter.payload, delay=0)
+        return True
+
+    try:
+        tg_chat_id = json.loads(letter.payload)['tg_chat_id']
+    except (ValueError, KeyError, TypeError):
+        # Single-queue messages which could not be decoded are kept as they were received.
+        logger.warning('Dead letter %s is malformed. It is kept.', letter.dead_letter_id)
+        return False
+
+    get_single_queue().requeue(letter.payload, tg_chat_id=tg_chat_id, delay=0)
+    return True
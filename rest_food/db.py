@@ -1,14 +1,24 @@
 import datetime
 import logging
-from typing import Optional, Union, List
+from typing import Dict, Iterable, Iterator, Optional, Set, Tuple, Union, List
 
 from bson.objectid import ObjectId
-from pymongo import MongoClient, ReturnDocument
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
 from rest_food.common.constants import DT_DB_FORMAT
-from rest_food.entities import User, Message, Command
-from rest_food.enums import Provider, Workflow, UserInfoField, MessageState
-from rest_food.settings import DB_CONNECTION_STRING, DB_NAME, ADMIN_USERNAMES
+from rest_food.entities import User, Message, Command, Recipient, Fanout, Digest, DeadLetter
+from rest_food.enums import (
+    Provider, Workflow, UserInfoField, MessageState, FanoutState, DigestState, DormantAudience, SendQueue,
+)
+from rest_food.settings import (
+    DB_CONNECTION_STRING,
+    DB_NAME,
+    ADMIN_USERNAMES,
+    DELIVERY_LEDGER_TTL_HOURS,
+    DELIVERY_CLAIM_TIMEOUT_SECONDS,
+    LAST_SEEN_UPDATE_SECONDS,
+)
 
 
 logger = logging.getLogger(__name__)
@@ -30,10 +40,16 @@ def import_messages(data: List[dict]):
     db.messages.insert(data)
 
 
+# User fields which are copied into `audience`.
+AUDIENCE_FIELDS = (
+    'is_active', 'last_seen', f'info.{UserInfoField.LOCATION.value}', f'info.{UserInfoField.LANGUAGE.value}',
+)
+
+
 def _update_user(
         user_id: Union[str, int], provider: Provider, workflow: Workflow, *, method: str='$set', update: dict,
 ) -> dict:
-    return db.users.find_one_and_update(
+    record = db.users.find_one_and_update(
         {
             'user_id': str(user_id),
             'provider': provider.value,
@@ -43,6 +59,40 @@ def _update_user(
         return_document=ReturnDocument.AFTER,
     )
 
+    if record is not None and any(x in AUDIENCE_FIELDS for x in update):
+        _sync_audience(record)
+
+    return record
+
+
+def _sync_audience(record: dict):
+    """
+    `audience` is a materialized view of active demand users having a location.
+        It holds only the fields required to deliver mass messages and is kept up to date
+        on every change of AUDIENCE_FIELDS.
+    """
+    if record['workflow'] != Workflow.DEMAND.value:
+        return
+
+    info = record.get('info') or {}
+    location = info.get(UserInfoField.LOCATION.value)
+
+    if record.get('is_active') is False or not location:
+        db.audience.delete_one({'_id': record['_id']})
+        return
+
+    db.audience.replace_one(
+        {'_id': record['_id']},
+        {
+            'location': location,
+            'chat_id': record['chat_id'],
+            'provider': record['provider'],
+            'language': info.get(UserInfoField.LANGUAGE.value),
+            'last_seen': record.get('last_seen'),
+        },
+        upsert=True,
+    )
+
 
 def _update_user_entity(user: User, update: dict, *, method: str='$set') -> User:
     updated_doc = _update_user(user.user_id, user.provider, user.workflow, update=update, method=method)
@@ -99,6 +149,7 @@ def get_or_create_user(
     """
     Queries db for a user record with user_id, provider and workflow specified.
         Marks it as active if found but not active. Creates a new active one if no record found.
+        `last_seen` is updated along, at most once per `LAST_SEEN_UPDATE_SECONDS`.
     """
     user = get_user(user_id, provider, workflow)
 
@@ -133,9 +184,15 @@ def get_or_create_user(
                 if UserInfoField.IS_APPROVED_LANGUAGE.value not in user.info:
                     update_statement[f'info.{UserInfoField.IS_APPROVED_LANGUAGE.value}'] = False
 
+        now = datetime.datetime.utcnow()
+
         # `is_active` if it was not active before.
         if not user.is_active:
-            update_statement.update({'is_active': True, 'active_from': datetime.datetime.utcnow()})
+            update_statement.update({'is_active': True, 'active_from': now})
+
+        # `last_seen` if it's outdated. Not on every update, so that reading the user is usually the only query.
+        if user.last_seen is None or (now - user.last_seen).total_seconds() >= LAST_SEEN_UPDATE_SECONDS:
+            update_statement['last_seen'] = now
 
         if update_statement:
             user = _update_user_entity(user, update_statement)
@@ -159,6 +216,7 @@ def _create_user(user: User) -> ObjectId:
         'context': {},
         'active_from' if user.is_active else 'inactive_from': create_time,
         'created_at': create_time,
+        'last_seen': create_time,
     })
     return result.inserted_id
 
@@ -181,6 +239,60 @@ def get_demand_users(location: Optional[str]=None):
     return [User.from_dict(x) for x in db.users.find(filters)]
 
 
+def iter_demand_audience(
+        location: Optional[str]=None,
+        *,
+        after_id: Optional[ObjectId]=None,
+        limit: int=0,
+        batch_size: int=1000,
+        seen_since: Optional[datetime.datetime]=None,
+        seen_before: Optional[datetime.datetime]=None,
+) -> Iterator[Recipient]:
+    """
+    Streams active demand users of the location from the `audience` materialized view.
+        Users are ordered by `_id`, so that the stream can be resumed `after_id` the last one processed.
+        Documents are fetched lazily from the cursor, `batch_size` at a time.
+
+    Parameters
+    ----------
+    seen_since
+        Only users seen since then. Users who were never seen are included.
+    seen_before
+        Only users last seen before then.
+
+    """
+    filters = _build_last_seen_filters(seen_since=seen_since, seen_before=seen_before)
+    if location is not None:
+        filters['location'] = location
+    if after_id is not None:
+        filters['_id'] = {'$gt': after_id}
+
+    cursor = db.audience.find(
+        filters,
+        projection={'_id': True, 'chat_id': True, 'language': True},
+        sort=[('_id', 1)],
+        limit=limit,
+        batch_size=batch_size,
+    )
+
+    for record in cursor:
+        yield Recipient.from_dict(record)
+
+
+def count_demand_audience(location: str, *, seen_since: Optional[datetime.datetime]=None) -> int:
+    return db.audience.count_documents({'location': location, **_build_last_seen_filters(seen_since=seen_since)})
+
+
+def _build_last_seen_filters(
+        *, seen_since: Optional[datetime.datetime]=None, seen_before: Optional[datetime.datetime]=None
+) -> dict:
+    if seen_since is not None:
+        return {'last_seen': {'$not': {'$lt': seen_since}}}
+    if seen_before is not None:
+        return {'last_seen': {'$lt': seen_before}}
+    return {}
+
+
 def get_admin_users():
     return [
         User.from_dict(x)
@@ -241,6 +353,7 @@ def set_booking_to_cancel(user: User, message_id: str):
 
 def delete_user(user: User):
     db.users.remove({'_id': user.id})
+    db.audience.delete_one({'_id': user.id})
 
 
 def create_supply_message(user: User, message: str, *, provider: Provider):
@@ -288,6 +401,19 @@ def deactivate_message_and_unset_booking(message_id):
     _update_message(message_id, update={'state': MessageState.DEACTIVATED.value, 'demand_user_id': None})
 
 
+def get_message_states(message_ids: Iterable[str]) -> Dict[str, Optional[MessageState]]:
+    """
+    Returns
+    -------
+    State per message id. Removed messages are missing.
+    """
+    records = db.messages.find(
+        {'_id': {'$in': [ObjectId(x) for x in message_ids]}},
+        projection={'state': True},
+    )
+    return {str(x['_id']): x.get('state') and MessageState(x['state']) for x in records}
+
+
 def set_message_state(message_id: Union[str, ObjectId], state: MessageState):
     _update_message(message_id, update={'state': state.value})
 
@@ -377,3 +503,427 @@ def set_inactive(chat_id: int, provider: Provider, workflow: Workflow):
             },
         }
     )
+
+    if workflow == Workflow.DEMAND:
+        db.audience.delete_one({'chat_id': chat_id, 'provider': provider.value})
+
+
+def set_inactive_many(chats: Iterable[Tuple[int, Workflow]], provider: Provider):
+    """
+    The same as `set_inactive` for many chats at once.
+    """
+    chats = set(chats)
+    if not chats:
+        return
+
+    now = datetime.datetime.utcnow()
+    db.users.bulk_write([
+        UpdateOne(
+            {
+                'chat_id': chat_id,
+                'provider': provider.value,
+                'workflow': workflow.value,
+            },
+            {
+                '$set': {
+                    'is_active': False,
+                    'inactive_from': now,
+                },
+            },
+        ) for chat_id, workflow in chats
+    ], ordered=False)
+
+    demand_chat_ids = [chat_id for chat_id, workflow in chats if workflow == Workflow.DEMAND]
+    if demand_chat_ids:
+        db.audience.delete_many({'chat_id': {'$in': demand_chat_ids}, 'provider': provider.value})
+
+
+def create_fanout(
+        *,
+        message_id: Optional[str],
+        owner_id: Optional[ObjectId],
+        location: str,
+        workflow: Workflow,
+        templates: dict,
+        dormant_before: Optional[datetime.datetime]=None,
+        dormant_audience: DormantAudience=DormantAudience.INCLUDE,
+) -> ObjectId:
+    """
+    Parameters
+    ----------
+    dormant_before
+        Users last seen before are treated according to `dormant_audience`.
+
+    """
+    if dormant_before is None:
+        dormant_audience = DormantAudience.INCLUDE
+
+    now = datetime.datetime.utcnow()
+    audience_size = count_demand_audience(
+        location, seen_since=dormant_before if dormant_audience == DormantAudience.EXCLUDE else None
+    )
+    result = db.fanouts.insert_one({
+        'message_id': message_id and str(message_id),
+        'owner_id': owner_id,
+        'location': location,
+        'workflow': workflow.value,
+        'templates': templates,
+        'state': FanoutState.PENDING.value,
+        'last_user_id': None,
+        'enqueued': 0,
+        'audience_size': audience_size,
+        'next_step_at': now,
+        'dormant_before': dormant_before,
+        'dormant_audience': dormant_audience.value,
+        'is_dormant_pass': False,
+        'created_at': now,
+        'updated_at': now,
+        'lease_until': None,
+    })
+    return result.inserted_id
+
+
+def claim_fanout(
+        fanout_id: Union[str, ObjectId], *, last_user_id: Optional[ObjectId], lease: datetime.timedelta
+) -> Optional[Fanout]:
+    """
+    Locks an unfinished fan-out for `lease` time, so that only one worker advances it.
+
+    Returns
+    -------
+    None if the fan-out is finished, has moved past `last_user_id` or is locked by another worker.
+
+    """
+    now = datetime.datetime.utcnow()
+    record = db.fanouts.find_one_and_update(
+        {
+            '_id': ObjectId(fanout_id),
+            'last_user_id': last_user_id,
+            'state': {'$ne': FanoutState.DONE.value},
+            '$or': [{'lease_until': None}, {'lease_until': {'$lt': now}}],
+        },
+        {'$set': {'state': FanoutState.RUNNING.value, 'lease_until': now + lease, 'updated_at': now}},
+        return_document=ReturnDocument.AFTER,
+    )
+    return record and Fanout.from_db(record)
+
+
+def checkpoint_fanout(
+        fanout_id: ObjectId,
+        *,
+        last_user_id: Optional[ObjectId],
+        enqueued: int,
+        is_done: bool,
+        next_step_at: Optional[datetime.datetime]=None,
+        start_dormant_pass: bool=False,
+):
+    """
+    Parameters
+    ----------
+    next_step_at
+        When the next step is scheduled for. The fan-out isn't considered stale before that.
+    start_dormant_pass
+        Active users are done: the checkpoint is reset to go through dormant ones.
+
+    """
+    now = datetime.datetime.utcnow()
+    update = {
+        'state': (FanoutState.DONE if is_done else FanoutState.PENDING).value,
+        'lease_until': None,
+        'updated_at': now,
+        'next_step_at': next_step_at or now,
+    }
+    if last_user_id is not None:
+        update['last_user_id'] = last_user_id
+    if start_dormant_pass:
+        update.update({'last_user_id': None, 'is_dormant_pass': True})
+    if is_done:
+        update['finished_at'] = now
+
+    db.fanouts.update_one({'_id': fanout_id}, {'$set': update, '$inc': {'enqueued': enqueued}})
+
+
+def count_fanout_deliveries(
+        counters: Dict[ObjectId, Dict[str, int]],
+        *,
+        delivery_times: Dict[ObjectId, Tuple[datetime.datetime, datetime.datetime]]=None,
+):
+    """
+    Updates delivery reports of many fan-outs at once: increments `counters`
+        and extends the interval of deliveries to (first, last) of `delivery_times`.
+    """
+    delivery_times = delivery_times or {}
+    requests = []
+
+    for fanout_id in set(counters) | set(delivery_times):
+        update = {}
+        fanout_counters = {f'counters.{k}': v for k, v in counters.get(fanout_id, {}).items() if v}
+        if fanout_counters:
+            update['$inc'] = fanout_counters
+        if fanout_id in delivery_times:
+            first, last = delivery_times[fanout_id]
+            update['$min'] = {'first_delivery_at': first}
+            update['$max'] = {'last_delivery_at': last}
+        if update:
+            requests.append(UpdateOne({'_id': fanout_id}, update))
+
+    if requests:
+        db.fanouts.bulk_write(requests, ordered=False)
+
+
+def list_fanouts(*, owner_id: Optional[ObjectId]=None, limit: int=5) -> List[Fanout]:
+    """
+    Returns
+    -------
+    The latest fan-outs, of the owner if specified.
+
+    """
+    filters = {} if owner_id is None else {'owner_id': owner_id}
+    return [
+        Fanout.from_db(x)
+        for x in db.fanouts.find(filters, projection={'templates': False}, sort=[('created_at', -1)], limit=limit)
+    ]
+
+
+def release_fanout(fanout_id: ObjectId):
+    now = datetime.datetime.utcnow()
+    db.fanouts.update_one(
+        {'_id': fanout_id},
+        {'$set': {
+            'state': FanoutState.PENDING.value,
+            'lease_until': None,
+            'updated_at': now,
+            'next_step_at': now,
+        }},
+    )
+
+
+def get_stale_fanouts(*, idle_for: datetime.timedelta) -> List[Tuple[ObjectId, Optional[ObjectId], bool]]:
+    """
+    Unfinished fan-outs which were not advanced for `idle_for` time since their next step was due
+        and are not locked.
+
+    Returns
+    -------
+    (fan-out id, its checkpoint, whether it's in the dormant pass) triples.
+
+    """
+    now = datetime.datetime.utcnow()
+    return [(x['_id'], x.get('last_user_id'), x.get('is_dormant_pass', False)) for x in db.fanouts.find(
+        {
+            'state': {'$ne': FanoutState.DONE.value},
+            '$and': [
+                {'$or': [{'lease_until': None}, {'lease_until': {'$lt': now}}]},
+                {'$or': [
+                    {'next_step_at': {'$lt': now - idle_for}},
+                    # Fan-outs created before steps were paced.
+                    {'next_step_at': {'$exists': False}, 'updated_at': {'$lt': now - idle_for}},
+                ]},
+            ],
+        },
+        projection={'_id': True, 'last_user_id': True, 'is_dormant_pass': True},
+    )]
+
+
+def add_to_digest(
+        *, location: str, message_id: str, owner_id: ObjectId, window: datetime.timedelta
+) -> Digest:
+    """
+    Adds the offer to the open digest of the location. The first offer opens a digest to be flushed in `window`.
+    """
+    now = datetime.datetime.utcnow()
+
+    for attempt in range(2):
+        try:
+            record = db.digests.find_one_and_update(
+                {'location': location, 'state': DigestState.OPEN.value},
+                {
+                    '$push': {'offers': {'message_id': str(message_id), 'owner_id': owner_id}},
+                    '$setOnInsert': {'flush_at': now + window, 'created_at': now, 'lease_until': None},
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+            return Digest.from_db(record)
+        except DuplicateKeyError:
+            # A concurrent publish has just opened the digest (unique index on open digest location).
+            if attempt:
+                raise
+
+
+def claim_due_digest(*, lease: datetime.timedelta) -> Optional[Digest]:
+    """
+    Locks a digest which is due to be sent. New offers go to a new digest since then.
+    """
+    now = datetime.datetime.utcnow()
+    record = db.digests.find_one_and_update(
+        {
+            'state': {'$ne': DigestState.DONE.value},
+            'flush_at': {'$lte': now},
+            '$or': [{'lease_until': None}, {'lease_until': {'$lt': now}}],
+        },
+        {'$set': {'state': DigestState.FLUSHING.value, 'lease_until': now + lease}},
+        sort=[('flush_at', 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+    return record and Digest.from_db(record)
+
+
+def get_digest(digest_id: str) -> Optional[Digest]:
+    record = db.digests.find_one({'_id': ObjectId(digest_id)})
+    return record and Digest.from_db(record)
+
+
+def set_digest_chunks(digest_id: ObjectId, chunks: List[List[int]]):
+    db.digests.update_one({'_id': digest_id}, {'$set': {'chunks': chunks}})
+
+
+def finish_digest(digest_id: ObjectId):
+    db.digests.update_one(
+        {'_id': digest_id},
+        {'$set': {
+            'state': DigestState.DONE.value,
+            'lease_until': None,
+            'finished_at': datetime.datetime.utcnow(),
+        }},
+    )
+
+
+def add_dead_letter(*, queue: SendQueue, payload: str, error: str):
+    db.dead_letters.insert_one({
+        'queue': queue.value,
+        'payload': payload,
+        'error': error,
+        'created_at': datetime.datetime.utcnow(),
+    })
+
+
+def get_dead_letters(
+        *,
+        queue: Optional[SendQueue]=None,
+        created_before: Optional[datetime.datetime]=None,
+        after_id: Optional[ObjectId]=None,
+        limit: int=100,
+) -> List[DeadLetter]:
+    """
+    Returns
+    -------
+    The oldest dead letters, of the queue if specified. Letters are ordered by `_id`,
+        so that the next page starts `after_id` the last letter of the previous one.
+
+    """
+    filters = {}
+    if queue is not None:
+        filters['queue'] = queue.value
+    if created_before is not None:
+        filters['created_at'] = {'$lt': created_before}
+    if after_id is not None:
+        filters['_id'] = {'$gt': after_id}
+
+    return [DeadLetter.from_db(x) for x in db.dead_letters.find(filters, sort=[('_id', 1)], limit=limit)]
+
+
+def delete_dead_letters(dead_letter_ids: List[ObjectId]):
+    db.dead_letters.delete_many({'_id': {'$in': dead_letter_ids}})
+
+
+def claim_deliveries(keys: List[str]) -> Set[str]:
+    """
+    Records mass message deliveries in a `deliveries` ledger which expires by TTL index.
+        Claims are pending until `confirm_deliveries`. A pending claim expires in `DELIVERY_CLAIM_TIMEOUT_SECONDS`,
+        so messages of a sender which crashed are sent once they are redelivered.
+
+    Returns
+    -------
+    Keys which were not claimed before, i.e. messages to be sent.
+
+    """
+    if not keys:
+        return set()
+
+    now = datetime.datetime.utcnow()
+    expire_at = now + datetime.timedelta(seconds=DELIVERY_CLAIM_TIMEOUT_SECONDS)
+
+    try:
+        db.deliveries.insert_many([{'_id': x, 'expire_at': expire_at} for x in keys], ordered=False)
+    except BulkWriteError as e:
+        errors = e.details['writeErrors']
+        if any(x['code'] != 11000 for x in errors):
+            raise
+
+        taken = [keys[x['index']] for x in errors]
+    else:
+        return set(keys)
+
+    # TTL monitor removes expired claims with a delay.
+    expired = [
+        x['_id'] for x in db.deliveries.find({'_id': {'$in': taken}, 'expire_at': {'$lte': now}}, {'_id': True})
+    ]
+    reclaimed = {
+        key for key in expired
+        if db.deliveries.update_one(
+            {'_id': key, 'expire_at': {'$lte': now}}, {'$set': {'expire_at': expire_at}}
+        ).modified_count
+    }
+
+    return set(keys) - set(taken) | reclaimed
+
+
+def confirm_deliveries(keys: List[str]):
+    """
+    Keeps deliveries claimed by `claim_deliveries` for `DELIVERY_LEDGER_TTL_HOURS` once messages are sent.
+    """
+    if keys:
+        expire_at = datetime.datetime.utcnow() + datetime.timedelta(hours=DELIVERY_LEDGER_TTL_HOURS)
+        db.deliveries.update_many({'_id': {'$in': keys}}, {'$set': {'expire_at': expire_at}})
+
+
+def take_notification_quota(user_ids: List[ObjectId], *, limit: int, period: int) -> Set[ObjectId]:
+    """
+    Counts a notification for every user who has got less than `limit` of them in the current `period` (seconds).
+        Counters are compact: a single `{_id: user id, p: period number, n: count}` document per user.
+
+    Returns
+    -------
+    Ids of the users who can be notified.
+
+    """
+    if not user_ids:
+        return set()
+
+    current = int(datetime.datetime.utcnow().timestamp() // period)
+    counters = {x['_id']: x for x in db.notification_counters.find({'_id': {'$in': user_ids}})}
+    allowed = [x for x in user_ids if x not in counters or counters[x]['p'] != current or counters[x]['n'] < limit]
+    existing = [x for x in allowed if x in counters]
+    new = [x for x in allowed if x not in counters]
+
+    if new:
+        try:
+            db.notification_counters.insert_many([{'_id': x, 'p': current, 'n': 1} for x in new], ordered=False)
+        except BulkWriteError as e:
+            errors = e.details['writeErrors']
+            if any(x['code'] != 11000 for x in errors):
+                raise
+
+            # Counted by a concurrent fan-out in the meantime.
+            existing.extend(new[x['index']] for x in errors)
+
+    if existing:
+        # Counter of a previous period is restarted.
+        db.notification_counters.update_many(
+            {'_id': {'$in': existing}},
+            [{'$set': {
+                'n': {'$cond': [{'$eq': ['$p', current]}, {'$add': ['$n', 1]}, 1]},
+                'p': current,
+            }}],
+        )
+
+    return set(allowed)
+
+
+def release_deliveries(keys: List[str]):
+    """
+    Allows sending messages claimed by `claim_deliveries` once again.
+    """
+    if keys:
+        db.deliveries.delete_many({'_id': {'$in': keys}})
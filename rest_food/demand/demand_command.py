@@ -20,7 +20,9 @@ from rest_food.enums import DemandState, Provider, Workflow, SocialStatus, Deman
     DemandTgCommand, MessageState
 from rest_food.translation import translate_lazy as _, set_language
 from rest_food.demand.demand_reply import (
-    build_demand_side_short_message,
+    build_demand_side_short_message_by_id,
+    build_demand_side_digest_message_by_id,
+    get_digest_offers,
     MapInfoHandler,
     MapTakeHandler,
     build_demand_side_message_by_id, MapBookedHandler,
@@ -228,7 +230,42 @@ def _handle_short_info(user: User, supply_provider: str, supply_user_id: str, me
     supply_user = get_user(
         user_id=supply_user_id, provider=Provider(supply_provider), workflow=Workflow.SUPPLY
     )
-    return build_demand_side_short_message(supply_user, message_id)
+    return build_demand_side_short_message_by_id(supply_user, message_id)
+
+
+def _handle_digest(user: User, digest_id: str, chunk_number: str):
+    return build_demand_side_digest_message_by_id(digest_id, int(chunk_number))
+
+
+def _handle_digest_info(user: User, digest_id: str, chunk_number: str, number: str):
+    return _handle_digest_offer(_handle_info, user, digest_id, chunk_number, number)
+
+
+def _handle_digest_take(user: User, digest_id: str, chunk_number: str, number: str):
+    return _handle_digest_offer(_handle_take, user, digest_id, chunk_number, number)
+
+
+def _handle_digest_offer(handler, user: User, digest_id: str, chunk_number: str, number: str):
+    """
+    The offer replaces the digest message. Buttons which would show the offer alone lead back to the digest.
+    """
+    offers = get_digest_offers(digest_id, int(chunk_number))
+    if not 0 < int(number) <= len(offers):
+        return Reply(_('Information was not found.'))
+
+    supply_user, message = offers[int(number) - 1]
+    arguments = supply_user.provider.value, supply_user.user_id, str(message.message_id)
+    reply = handler(user, *arguments)
+
+    replacements = {
+        DemandCommand.SHORT_INFO.build(*arguments): DemandCommand.DIGEST.build(digest_id, chunk_number),
+        DemandCommand.TAKE.build(*arguments): DemandCommand.DIGEST_TAKE.build(digest_id, chunk_number, number),
+    }
+    for row in reply.buttons or []:
+        for button in row:
+            button['data'] = replacements.get(button['data'], button['data'])
+
+    return reply
 
 
 def _handle_booked(user: User, supply_provider: str, supply_user_id: str, message_id: str):
@@ -392,6 +429,9 @@ COMMAND_HANDLERS = {
     DemandCommand.MAP_INFO: _handle_map_info,
     DemandCommand.MAP_TAKE: _handle_map_take,
     DemandCommand.MAP_BOOKED: _handle_map_booked,
+    DemandCommand.DIGEST: _handle_digest,
+    DemandCommand.DIGEST_INFO: _handle_digest_info,
+    DemandCommand.DIGEST_TAKE: _handle_digest_take,
     DemandCommand.ENABLE_USERNAME: _handle_enable_username,
     DemandCommand.DISABLE_USERNAME: _handle_disable_username,
     DemandCommand.FINISH_TAKE: _handle_finish_take,
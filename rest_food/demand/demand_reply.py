@@ -1,10 +1,13 @@
 import logging
+from typing import List, Tuple, Union
+
+from bson import ObjectId
 
 from rest_food.common.constants import CITY_DICT, COUNTRY_DICT
-from rest_food.db import get_supply_user, get_supply_message_record_by_id
+from rest_food.db import get_supply_user, get_supply_message_record_by_id, get_digest, get_user_by_id
 from rest_food.entities import User, Reply, Message
 from rest_food.enums import Provider, DemandCommand, UserInfoField, DemandTgCommand, MessageState
-from rest_food.common.formatters import build_short_message_text_by_id, \
+from rest_food.common.formatters import message_to_text, \
     build_demand_side_full_message_text_by_id, bold, build_demand_side_full_message_text
 
 from rest_food.translation import translate_lazy as _
@@ -13,8 +16,9 @@ from rest_food.translation import translate_lazy as _
 logger = logging.getLogger(__name__)
 
 
-def build_demand_side_short_message(supply_user: User, message_id: str):
-    text_message = build_short_message_text_by_id(message_id=message_id)
+def build_demand_side_short_message(supply_user: User, message: Message):
+    message_id = str(message.message_id)
+    text_message = message_to_text(message)
     return Reply(
         text=_('{} can share the following:\n{}').format(
             supply_user.info[UserInfoField.NAME.value], text_message
@@ -33,6 +37,59 @@ def build_demand_side_short_message(supply_user: User, message_id: str):
     )
 
 
+def build_demand_side_digest_message(
+        offers: List[Tuple[User, Message]], *, digest_id: Union[str, ObjectId], chunk_number: int
+) -> Reply:
+    """
+    Several offers in a single message. Buttons of every offer are numbered as the offer in the text.
+        They refer to the digest, so the offers shown from there lead back to the digest.
+    """
+    texts = []
+    buttons = []
+
+    for number, (supply_user, message) in enumerate(offers, 1):
+        texts.append('{}. {}'.format(number, _('{} can share the following:\n{}').format(
+            supply_user.info[UserInfoField.NAME.value], message_to_text(message)
+        )))
+        buttons.append([{
+            'text': '{} {}'.format(_('Take it'), number),
+            'data': DemandCommand.DIGEST_TAKE.build(str(digest_id), str(chunk_number), str(number)),
+        }, {
+            'text': '{} {}'.format(_('Info'), number),
+            'data': DemandCommand.DIGEST_INFO.build(str(digest_id), str(chunk_number), str(number)),
+        }])
+
+    return Reply(text='\n\n'.join(texts), buttons=buttons)
+
+
+def get_digest_offers(digest_id: str, chunk_number: int) -> List[Tuple[User, Message]]:
+    """
+    Offers of a digest message in the order they are numbered there.
+    """
+    digest = get_digest(digest_id)
+    if digest is None or not digest.chunks or chunk_number >= len(digest.chunks):
+        return []
+
+    return [
+        (get_user_by_id(x['owner_id']), get_supply_message_record_by_id(message_id=x['message_id']))
+        for x in (digest.offers[i] for i in digest.chunks[chunk_number])
+    ]
+
+
+def build_demand_side_digest_message_by_id(digest_id: str, chunk_number: int) -> Reply:
+    offers = get_digest_offers(digest_id, chunk_number)
+    if not offers:
+        return Reply(_('Information was not found.'))
+
+    return build_demand_side_digest_message(offers, digest_id=digest_id, chunk_number=chunk_number)
+
+
+def build_demand_side_short_message_by_id(supply_user: User, message_id: str):
+    return build_demand_side_short_message(
+        supply_user, get_supply_message_record_by_id(message_id=message_id)
+    )
+
+
 def build_demand_side_message_by_id(supply_user: User, message_id: str, *, intro: str=None):
     message = get_supply_message_record_by_id(message_id=message_id)
     text = build_demand_side_full_message_text(supply_user, message)
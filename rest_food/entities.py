@@ -1,12 +1,16 @@
 import datetime
 from typing import Dict, List, Optional, Tuple, Union
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from decimal import Decimal
 
 from bson import ObjectId
+from telegram.message import Message as TgMessage
 from telegram.user import User as TgUser
 
-from rest_food.enums import DemandState, SupplyState, Provider, Workflow, SocialStatus, UserInfoField, MessageState
+from rest_food.enums import (
+    DemandState, SupplyState, Provider, Workflow, SocialStatus, UserInfoField, MessageState, FanoutState,
+    DigestState, DormantAudience, SendQueue,
+)
 from rest_food.translation import translate_lazy as _
 from rest_food import settings
 
@@ -89,6 +93,10 @@ class User:
     """ Moment when user with undefined or inactive state sent a message, so that their `is_active` field became True.
     """
 
+    last_seen: Optional[datetime.datetime]=None
+    """ Moment of the latest interaction with the bot, up to `LAST_SEEN_UPDATE_SECONDS`.
+    """
+
     @property
     def id(self) -> Optional[ObjectId]:
         return self._id
@@ -129,6 +137,24 @@ class User:
         return cls(**record)
 
 
+@dataclass
+class Recipient:
+    """
+    Projection of a demand user which is enough to deliver a mass message.
+    """
+    chat_id: Union[str, int]
+    language: Optional[str] = None
+    _id: Optional[ObjectId] = None
+
+    @property
+    def id(self) -> Optional[ObjectId]:
+        return self._id
+
+    @classmethod
+    def from_dict(cls, record: dict):
+        return cls(**record)
+
+
 @dataclass
 class Message:
     message_id: ObjectId
@@ -146,6 +172,115 @@ class Message:
         return Message(**record)
 
 
+@dataclass
+class Fanout:
+    """
+    Background delivery of a message to the whole audience of a location.
+        Audience is processed in `_id` order, `last_user_id` is the checkpoint to resume from.
+    """
+    fanout_id: ObjectId
+    message_id: Optional[str]
+    """ Offer to deliver. None for digests.
+    """
+    owner_id: Optional[ObjectId]
+    location: str
+    workflow: Workflow
+    state: FanoutState
+    last_user_id: Optional[ObjectId] = None
+    enqueued: int = 0
+    audience_size: int = 0
+    """ Audience size at the start. Used to pace delivery.
+    """
+    templates: Optional[Dict[str, Dict]] = None
+    """ Rendered reply per language.
+    """
+    next_step_at: Optional[datetime.datetime] = None
+    dormant_before: Optional[datetime.datetime] = None
+    """ Users last seen before are dormant. None if everyone is treated as active.
+    """
+    dormant_audience: DormantAudience = DormantAudience.INCLUDE
+    is_dormant_pass: bool = False
+    """ Active users are done and dormant ones are processed, from the start of `_id` order.
+    """
+    counters: Dict[str, int] = field(default_factory=dict)
+    """ Delivery outcomes: delivered, blocked, failed, stale (the offer was booked or deactivated)
+        and duplicate (the message was delivered already).
+    """
+    first_delivery_at: Optional[datetime.datetime] = None
+    last_delivery_at: Optional[datetime.datetime] = None
+    created_at: Optional[datetime.datetime] = None
+    updated_at: Optional[datetime.datetime] = None
+    lease_until: Optional[datetime.datetime] = None
+    finished_at: Optional[datetime.datetime] = None
+
+    @classmethod
+    def from_db(cls, record: dict):
+        record['fanout_id'] = record.pop('_id')
+        record['workflow'] = Workflow(record['workflow'])
+        record['state'] = FanoutState(record['state'])
+        record['dormant_audience'] = DormantAudience(record.get('dormant_audience', DormantAudience.INCLUDE.value))
+        return cls(**record)
+
+
+@dataclass
+class Digest:
+    """
+    Offers of a location collected to be sent as a single message at `flush_at`.
+    """
+    digest_id: ObjectId
+    location: str
+    offers: List[Dict]
+    """ `message_id` and `owner_id` of every offer.
+    """
+    state: DigestState
+    flush_at: datetime.datetime
+    created_at: Optional[datetime.datetime] = None
+    lease_until: Optional[datetime.datetime] = None
+    finished_at: Optional[datetime.datetime] = None
+    chunks: Optional[List[List[int]]] = None
+    """ Indexes of `offers` sent in every digest message.
+    """
+
+    @classmethod
+    def from_db(cls, record: dict):
+        record['digest_id'] = record.pop('_id')
+        record['state'] = DigestState(record['state'])
+        return cls(**record)
+
+
+@dataclass
+class DeadLetter:
+    """
+    Envelope which could not be sent: either it failed for a permanent reason or its retries are over.
+    """
+    dead_letter_id: ObjectId
+    queue: SendQueue
+    payload: str
+    """ Envelope as it's queued.
+    """
+    error: str
+    created_at: datetime.datetime
+
+    @classmethod
+    def from_db(cls, record: dict):
+        record['dead_letter_id'] = record.pop('_id')
+        record['queue'] = SendQueue(record['queue'])
+        return cls(**record)
+
+
+@dataclass
+class OriginalMessage:
+    """
+    Message of a callback query, as much of it as replies need to edit or replace it.
+    """
+    message_id: int
+    has_text: bool
+
+    @classmethod
+    def from_tg(cls, message: TgMessage):
+        return cls(message_id=message.message_id, has_text=message.text is not None)
+
+
 @dataclass
 class Reply:
     text: Optional[str] = None
@@ -66,6 +66,9 @@ class DemandCommand(Enum):
     MAP_INFO = 'mapi'
     MAP_TAKE = 'mapt'
     MAP_BOOKED = 'mapb'
+    DIGEST = 'dgst'
+    DIGEST_INFO = 'dgsti'
+    DIGEST_TAKE = 'dgstt'
     CHOOSE_LOCATION = 'choose_location'
     CHOOSE_OTHER_LOCATION = 'choose_other_location'
 
@@ -101,6 +104,7 @@ class SupplyTgCommand(Enum):
     START = 'start'
     LANGUAGE = 'language'
     DELETE = 'delete'
+    REPORT = 'report'
 
 
 class DemandTgCommand(Enum):
@@ -144,3 +148,40 @@ class MessageState(Enum):
     APPROVED = 'approved'
     DEACTIVATED = 'deactivated'
     TAKEN = 'taken'
+
+
+class FanoutState(Enum):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+
+
+class DigestState(Enum):
+    OPEN = 'open'
+    FLUSHING = 'flushing'
+    DONE = 'done'
+
+
+class DormantAudience(Enum):
+    """
+    How fan-outs treat demand users who were not seen for `DORMANT_AFTER_DAYS`.
+    """
+    INCLUDE = 'include'
+    EXCLUDE = 'exclude'
+    LAST = 'last'
+    """ Dormant users get an offer after everyone else.
+    """
+
+
+class SuperBatchGrouping(Enum):
+    """
+    FIFO group of super-batches. Groups are processed in parallel, super-batches of one group are serialized.
+    """
+    COMMON = 'common'
+    FANOUT = 'fanout'
+    LOCATION = 'location'
+
+
+class SendQueue(Enum):
+    SINGLE = 'single'
+    MASS = 'mass'
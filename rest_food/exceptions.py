@@ -1,4 +1,21 @@
 class ValidationError(ValueError):
     def __init__(self, message, *args, **kwargs):
         self.message = message
-        super().__init__(*args, **kwargs)
\ No newline at end of file
+        super().__init__(*args, **kwargs)
+
+
+class RetryLater(Exception):
+    """
+    Telegram can't accept the call right now. It should be queued again in `retry_after` seconds.
+
+    Parameters
+    ----------
+    is_failure
+        The call was made and failed (vs it was not made because of the local rate limiter).
+            Failures count towards `SEND_RETRY_MAX_ATTEMPTS`.
+
+    """
+    def __init__(self, retry_after: float, *args, is_failure: bool=True, **kwargs):
+        self.retry_after = retry_after
+        self.is_failure = is_failure
+        super().__init__(retry_after, *args, **kwargs)
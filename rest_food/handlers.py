@@ -1,5 +1,5 @@
 import logging
-from typing import Optional
+from typing import List, Optional
 
 from telegram import Update
 
@@ -15,13 +15,14 @@ from rest_food.state_machine import (
     get_demand_state,
     set_demand_state,
 )
-from rest_food._sync_communication import get_bot, build_tg_response
-from rest_food.communication import queue_messages
+from rest_food._sync_communication import get_bot, build_tg_response, build_inline_tg_response
+from rest_food.communication import queue_messages, buffer_messages, has_buffered_messages
 from rest_food.demand.demand_command import handle_demand_data
 from rest_food.supply.supply_state import DefaultState
 from rest_food.supply.supply_command import handle_supply_command
 from rest_food.supply.supply_tg_command import handle_supply_tg_command
 from rest_food.tg_helpers import update_to_text, update_to_coordinates
+from rest_food.settings import TG_INLINE_RESPONSE
 from rest_food.translation import hack_telegram_json_dumps, translate_lazy as _, set_language
 
 logger = logging.getLogger(__name__)
@@ -42,47 +43,38 @@ def tg_supply(data):
     data = update.callback_query and update.callback_query.data     # type: Optional[str]
 
     try:
-        state = get_supply_state(tg_user_id=user_id, tg_user=tg_user, tg_chat_id=chat_id)
-        set_language(state.db_user.info[UserInfoField.LANGUAGE.value])
+        # Replies are queued at the end of the block. If that fails, the webhook still responds,
+        #   so Telegram doesn't redeliver the update to be handled once more.
+        with buffer_messages():
+            state = get_supply_state(tg_user_id=user_id, tg_user=tg_user, tg_chat_id=chat_id)
+            set_language(state.db_user.info[UserInfoField.LANGUAGE.value])
 
-        db_user = state.db_user
+            db_user = state.db_user
 
-        if data and data.startswith('c|'):
-            parts = data.split('|')
-            reply = handle_supply_command(db_user, SupplyCommand(parts[1]), parts[2:])
-            if reply.next_state is None:
-                reply.next_state = SupplyState.NO_STATE
-
-        else:
-            tg_command = optional_text_to_command(update.message and update.message.text, SupplyTgCommand)
-            if tg_command is not None:
-                reply = handle_supply_tg_command(db_user, tg_command)
+            if data and data.startswith('c|'):
+                parts = data.split('|')
+                reply = handle_supply_command(db_user, SupplyCommand(parts[1]), parts[2:])
+                if reply.next_state is None:
+                    reply.next_state = SupplyState.NO_STATE
 
             else:
-                reply = state.handle(
-                    update_to_text(update),
-                    data,
-                    update_to_coordinates(update),
-                )
-
-        if reply is not None and reply.next_state is not None:
-            next_state = set_supply_state(db_user, reply.next_state)
-        else:
-            next_state = state
-
-        queue_messages(
-            tg_chat_id=chat_id,
-            original_message=update.callback_query and update.callback_query.message,
-            replies=[reply, next_state.get_intro()],
-            workflow=Workflow.SUPPLY
-        )
+                tg_command = optional_text_to_command(update.message and update.message.text, SupplyTgCommand)
+                if tg_command is not None:
+                    reply = handle_supply_tg_command(db_user, tg_command)
+
+                else:
+                    reply = state.handle(
+                        update_to_text(update),
+                        data,
+                        update_to_coordinates(update),
+                    )
+
+            if reply is not None and reply.next_state is not None:
+                next_state = set_supply_state(db_user, reply.next_state)
+            else:
+                next_state = state
 
-        # Remove a spinner on tg application UI.
-        if update.callback_query:
-            return {
-                'method': 'answerCallbackQuery',
-                'callback_query_id': update.callback_query.id,
-            }
+            return _respond(update, replies=[reply, next_state.get_intro()], workflow=Workflow.SUPPLY)
 
     except Exception:
         logger.exception('Something went wrong for a supply user.')
@@ -98,6 +90,40 @@ def tg_supply(data):
         )
 
 
+def _respond(update: Update, *, replies: List[Optional[Reply]], workflow: Workflow) -> Optional[dict]:
+    """
+    Queues replies to the update.
+
+    Returns
+    -------
+    Webhook response: replies themselves in `TG_INLINE_RESPONSE` mode if possible.
+        Not if messages for the chat were queued while handling the update: the response would overtake them.
+
+    """
+    chat_id = update.effective_chat.id
+    if TG_INLINE_RESPONSE and update.callback_query is None and not has_buffered_messages(chat_id):
+        response = build_inline_tg_response(tg_chat_id=chat_id, replies=replies)
+        if response is not None:
+            return response
+
+    queue_messages(
+        tg_chat_id=chat_id,
+        original_message=update.callback_query and update.callback_query.message,
+        replies=replies,
+        workflow=workflow,
+    )
+    return _answer_callback_query(update)
+
+
+def _answer_callback_query(update: Update) -> Optional[dict]:
+    # Remove a spinner on tg application UI.
+    if update.callback_query:
+        return {
+            'method': 'answerCallbackQuery',
+            'callback_query_id': update.callback_query.id,
+        }
+
+
 def tg_demand(data):
     update = Update.de_json(data, None)
     user_id = update.effective_user.id
@@ -106,54 +132,47 @@ def tg_demand(data):
     text = update.message and update.message.text
 
     try:
+        # Replies are queued at the end of the block. If that fails, the webhook still responds,
+        #   so Telegram doesn't redeliver the update to be handled once more.
+        with buffer_messages():
+            user = get_or_create_user(
+                user_id=user_id,
+                chat_id=chat_id,
+                provider=Provider.TG,
+                workflow=Workflow.DEMAND,
+                info={
+                    UserInfoField.NAME.value: tg_user.first_name,
+                    UserInfoField.USERNAME.value: tg_user.username,
+                    UserInfoField.LANGUAGE.value: tg_user.language_code,
+                },
+            )
+            set_language(user.info[UserInfoField.LANGUAGE.value])
 
-        user = get_or_create_user(
-            user_id=user_id,
-            chat_id=chat_id,
-            provider=Provider.TG,
-            workflow=Workflow.DEMAND,
-            info={
-                UserInfoField.NAME.value: tg_user.first_name,
-                UserInfoField.USERNAME.value: tg_user.username,
-                UserInfoField.LANGUAGE.value: tg_user.language_code,
-            },
-        )
-        set_language(user.info[UserInfoField.LANGUAGE.value])
+            if update.callback_query is not None:
+                reply = handle_demand_data(user=user, data=update.callback_query.data)
+            else:
+                tg_command = optional_text_to_command(text, DemandTgCommand)
+                if tg_command is not None:
+                    reply = handle_demand_tg_command(user, tg_command)
 
-        if update.callback_query is not None:
-            reply = handle_demand_data(user=user, data=update.callback_query.data)
-        else:
-            tg_command = optional_text_to_command(text, DemandTgCommand)
-            if tg_command is not None:
-                reply = handle_demand_tg_command(user, tg_command)
+                else:
+                    state = get_demand_state(user)
+                    reply = state.handle(
+                        update_to_text(update),
+                        data=None,
+                        coordinates=update_to_coordinates(update),
+                    )
 
-            else:
-                state = get_demand_state(user)
-                reply = state.handle(
-                    update_to_text(update),
-                    data=None,
-                    coordinates=update_to_coordinates(update),
-                )
-
-        replies = [reply]
-
-        if reply is not None:
-            if reply.next_state is not None:
-                next_state = set_demand_state(user=user, state=reply.next_state)
-                replies.append(next_state.get_intro())
-
-            queue_messages(
-                tg_chat_id=chat_id,
-                original_message=update.callback_query and update.callback_query.message,
-                replies=replies,
-                workflow=Workflow.DEMAND
-            )
+            replies = [reply]
+
+            if reply is not None:
+                if reply.next_state is not None:
+                    next_state = set_demand_state(user=user, state=reply.next_state)
+                    replies.append(next_state.get_intro())
+
+                return _respond(update, replies=replies, workflow=Workflow.DEMAND)
 
-        if update.callback_query:
-            return {
-                'method': 'answerCallbackQuery',
-                'callback_query_id': update.callback_query.id,
-            }
+            return _answer_callback_query(update)
 
     except Exception:
         logger.exception('Something went wrong for a demand user.')
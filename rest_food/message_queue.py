@@ -1,71 +1,742 @@
+import atexit
+import base64
+import datetime
+import heapq
 import json
 import logging
 import multiprocessing
+import os
+import queue
 import random
+import signal
+import time
+import zlib
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
 from dataclasses import asdict
-from typing import Tuple, List, Iterable
-from threading import Thread
+from hashlib import sha256
+from itertools import count
+from collections import OrderedDict
+from typing import Callable, Dict, Tuple, List, Iterable, Optional, Set, Union
+from threading import Condition, Lock, Thread, Timer
 from uuid import uuid4
 
 import boto3
+from bson import ObjectId
 from telegram import Message as TgMessage
 
 from rest_food import db as db_module
-from rest_food.entities import Reply, User
-from rest_food.enums import Workflow, UserInfoField
-from rest_food.translation import LazyAwareJsonEncoder, switch_language
-from rest_food.settings import STAGE
-from rest_food._sync_communication import send_messages
+from rest_food.entities import Reply, Recipient, Fanout, OriginalMessage
+from rest_food.enums import Workflow, MessageState, SuperBatchGrouping, DormantAudience, SendQueue
+from rest_food.exceptions import RetryLater
+from rest_food.retry import RetryPolicy
+from rest_food.translation import LazyAwareJsonEncoder, switch_language, get_language_code
+from rest_food.settings import (
+    STAGE,
+    FANOUT_STEP_SIZE,
+    FANOUT_LEASE_SECONDS,
+    FANOUT_RESUME_AFTER_SECONDS,
+    FANOUT_DELIVERY_WINDOW_SECONDS,
+    DORMANT_AFTER_DAYS,
+    DORMANT_AUDIENCE,
+    NOTIFICATION_CAP,
+    NOTIFICATION_CAP_PERIOD_SECONDS,
+    OFFER_STATE_CACHE_SECONDS,
+    SUPER_BATCH_GROUPING,
+    SUPER_BATCH_GROUP_SHARDS,
+    SUPER_BATCH_MAX_RECIPIENTS,
+    SUPER_BATCH_MAX_BYTES,
+    SUPER_BATCH_COMPRESSION,
+    LOCAL_QUEUE_PROCESSES,
+    LOCAL_QUEUE_THREADS,
+    LOCAL_QUEUE_MAX_SIZE,
+    LOCAL_QUEUE_PUT_TIMEOUT,
+    LOCAL_QUEUE_DRAIN_TIMEOUT,
+)
+from rest_food._sync_communication import send_messages, get_send_executor, collect_deactivations
 
 
 logger = logging.getLogger(__name__)
 
+COMPRESSED_PREFIX = 'zlib:'
+
+
+class DeliveryReport:
+    """
+    Delivery outcomes of fan-outs collected in memory to be saved with a single db write.
+    """
+    def __init__(self):
+        self.counters = {}  # type: Dict[ObjectId, Dict[str, int]]
+        self.delivery_times = {}    # type: Dict[ObjectId, Tuple[datetime.datetime, datetime.datetime]]
+
+    def count(self, headers: dict, outcome: str):
+        if 'fanout_id' not in headers:
+            return
+
+        counters = self.counters.setdefault(ObjectId(headers['fanout_id']), {})
+        counters[outcome] = counters.get(outcome, 0) + 1
+
+    def count_delivered(self, headers: dict, *, at: datetime.datetime):
+        self.count(headers, 'delivered')
+        if 'fanout_id' not in headers:
+            return
+
+        fanout_id = ObjectId(headers['fanout_id'])
+        first, last = self.delivery_times.get(fanout_id, (at, at))
+        self.delivery_times[fanout_id] = min(first, at), max(last, at)
+
+    def save(self):
+        db_module.count_fanout_deliveries(self.counters, delivery_times=self.delivery_times)
+
+
+class OfferStateCache:
+    """
+    Senders check every batch against offer states. States are cached for `ttl` seconds per process,
+        so a fan-out costs a single lookup per offer in this interval.
+    """
+    def __init__(self, ttl: float):
+        self._ttl = ttl
+        self._states = {}   # type: Dict[str, Tuple[float, Optional[MessageState]]]
+        self._lock = Lock()
+
+    def get_stale(self, message_ids: Iterable[str]) -> Set[str]:
+        """
+        Returns
+        -------
+        Ids of offers which are not published anymore: booked, deactivated or removed.
+        """
+        message_ids = set(message_ids)
+        if not message_ids:
+            return set()
+
+        now = time.monotonic()
+        with self._lock:
+            self._states = {k: v for k, v in self._states.items() if v[0] > now}
+            states = {k: self._states[k][1] for k in message_ids if k in self._states}
+
+        missing = message_ids - set(states)
+        if missing:
+            fetched = db_module.get_message_states(missing)
+            states.update((x, fetched.get(x)) for x in missing)
+            with self._lock:
+                self._states.update((x, (now + self._ttl, states[x])) for x in missing)
+
+        return {k for k, v in states.items() if v != MessageState.PUBLISHED}
+
 
 class BaseMassMessageQueue:
+    """
+    Mass messages travel as *envelopes*: every distinct rendered reply is stored once
+        together with a list of chat ids it should be delivered to:
+
+        {
+            "workflow": "demand",
+            "fanout_id": "...",
+            "messages": [{"reply": {...}, "chat_ids": [1, 2, 3]}, ...]
+        }
+
+    Envelopes are expanded into separate Bot API calls only at send time.
+        Messages of a fan-out are delivered at most once per chat (see `db.claim_deliveries`).
+    """
     super_batch_size = None     # type: int
+    """ Max number of recipients in a super-batch.
+    """
+    super_batch_max_bytes = SUPER_BATCH_MAX_BYTES
+    super_batch_compression = SUPER_BATCH_COMPRESSION
+    fanout_step_size = FANOUT_STEP_SIZE
+    fanout_delivery_window = FANOUT_DELIVERY_WINDOW_SECONDS
+    max_step_delay = 900
+    """ SQS limit for DelaySeconds.
+    """
+    offer_states = OfferStateCache(ttl=OFFER_STATE_CACHE_SECONDS)
+    super_batch_grouping = SuperBatchGrouping(SUPER_BATCH_GROUPING)
+    super_batch_group_shards = SUPER_BATCH_GROUP_SHARDS
+    dormant_after_days = DORMANT_AFTER_DAYS
+    dormant_audience = DormantAudience(DORMANT_AUDIENCE)
+    notification_cap = NOTIFICATION_CAP
+    notification_cap_period = NOTIFICATION_CAP_PERIOD_SECONDS
+    retry_policy = RetryPolicy()
 
-    def put_mass_messages_into_queue(self, items: List[str]):
+    def put_mass_messages_into_queue(self, items: List[str], *, deduplication_ids: List[Optional[str]]=None):
         raise NotImplementedError()
 
-    def serialize(self, message: Reply, *, chat_id: int, language: str, workflow: Workflow) -> str:
+    @staticmethod
+    def _render_reply(message: Reply, *, language: str) -> dict:
         with switch_language(language):
-            return json.dumps({
-                'reply': asdict(message),
-                'chat_id': int(chat_id),
-                'workflow': workflow.value,
-            }, cls=LazyAwareJsonEncoder)
+            return json.loads(json.dumps(asdict(message), cls=LazyAwareJsonEncoder))
 
-    def process(self, serialized_data: str):
-        data = json.loads(serialized_data)
+    @staticmethod
+    def _build_headers(
+            *, workflow: Workflow, fanout_id: Optional[ObjectId], message_id: Optional[str]=None
+    ) -> dict:
+        headers = {'workflow': workflow.value}
+        if fanout_id is not None:
+            headers['fanout_id'] = str(fanout_id)
+        if message_id is not None:
+            headers['message_id'] = str(message_id)
+
+        return headers
+
+    @staticmethod
+    def _serialize_envelope(headers: dict, messages: List[Tuple[dict, List[int]]], *, compress: bool=False) -> str:
+        payload = json.dumps(dict(
+            headers,
+            messages=[{'reply': reply, 'chat_ids': chat_ids} for reply, chat_ids in messages],
+        ), separators=(',', ':'))
+
+        if compress:
+            payload = COMPRESSED_PREFIX + base64.b64encode(zlib.compress(payload.encode())).decode()
+
+        return payload
+
+    @staticmethod
+    def loads(payload: str) -> Union[dict, list]:
+        """
+        Decodes any mass queue payload: compressed or not.
+        """
+        if payload.startswith(COMPRESSED_PREFIX):
+            payload = zlib.decompress(base64.b64decode(payload[len(COMPRESSED_PREFIX):])).decode()
+
+        return json.loads(payload)
+
+    @staticmethod
+    def is_fanout_step(data: Union[dict, list]) -> bool:
+        # Envelopes have `fanout_id` header too.
+        return isinstance(data, dict) and 'last_user_id' in data
+
+    @classmethod
+    def _serialize_recipients(cls, headers: dict, recipients: Iterable[Tuple[dict, int]]) -> str:
+        """
+        Reverse of `_iter_envelope`.
+        """
+        return cls._serialize_envelope(headers, cls._group_recipients(recipients))
+
+    @staticmethod
+    def _iter_envelope(data: dict) -> Iterable[Tuple[dict, int]]:
+        for message in data['messages']:
+            for chat_id in message['chat_ids']:
+                yield message['reply'], chat_id
+
+    @staticmethod
+    def _decode(serialized_data: str) -> Tuple[dict, dict]:
+        """
+        Returns
+        -------
+        Envelope headers and the envelope itself.
+
+        """
+        data = BaseMassMessageQueue.loads(serialized_data)
+
+        if 'messages' not in data:
+            # Legacy single-recipient format.
+            data = {
+                'workflow': data['workflow'],
+                'messages': [{'reply': data['reply'], 'chat_ids': [data['chat_id']]}],
+            }
+
+        return {k: v for k, v in data.items() if k != 'messages'}, data
+
+    @staticmethod
+    def _get_delivery_key(headers: dict, chat_id: int) -> Optional[str]:
+        return headers.get('fanout_id') and f'{headers["fanout_id"]}:{chat_id}'
+
+    @staticmethod
+    def _send(reply: dict, chat_id: int, workflow: Workflow) -> Tuple[Optional[Exception], datetime.datetime]:
+        """
+        Returns
+        -------
+        An error (`RetryLater` if the message has to be postponed) and the time the call was over.
+
+        """
         try:
             send_messages(
-                tg_chat_id=data['chat_id'],
-                replies=[Reply(**data['reply'])],
-                workflow=Workflow(data['workflow'])
+                tg_chat_id=chat_id,
+                replies=[Reply(**reply)],
+                workflow=workflow,
             )
+        except RetryLater as e:
+            return e, datetime.datetime.utcnow()
         except Exception as e:
-            logger.exception('Message was not send:\n%s', data)
+            logger.exception('Message was not send to %s:\n%s', chat_id, reply)
+            return e, datetime.datetime.utcnow()
 
-    def put_super_batch_into_queue(self, items: List[str]):
-        raise NotImplementedError()
+        return None, datetime.datetime.utcnow()
+
+    def process(self, serialized_data: str):
+        self.process_many([serialized_data])
+
+    def process_many(self, items: Iterable[str]):
+        """
+        Sends all the envelopes concurrently. Messages postponed by the rate limiter or failed for a transient
+            reason are queued again according to `retry_policy`. Messages which failed otherwise or ran out of
+            retries are kept in dead letters. Fan-out delivery reports are updated once per call.
+        """
+        tasks = []  # type: List[Tuple[dict, int, dict]]
+        for serialized_data in items:
+            try:
+                headers, data = self._decode(serialized_data)
+            except Exception:
+                logger.exception('Malformed mass message:\n%s', serialized_data)
+                continue
+
+            tasks.extend((reply, chat_id, headers) for reply, chat_id in self._iter_envelope(data))
+
+        report = DeliveryReport()
+
+        # Offers booked or deactivated after they were queued.
+        stale = self.offer_states.get_stale({x[2]['message_id'] for x in tasks if 'message_id' in x[2]})
+        if stale:
+            stale_count = len(tasks)
+            for _, _, headers in tasks:
+                if headers.get('message_id') in stale:
+                    report.count(headers, 'stale')
 
-    def push_super_batch(self, *, message_and_user: List[Tuple[Reply, User]], workflow: Workflow):
-        for i in range(0, len(message_and_user), self.super_batch_size):
-            self.put_super_batch_into_queue(
-                [
-                    self.serialize(
-                        msg,
-                        chat_id=user.chat_id,
-                        language=user.get_info_field(UserInfoField.LANGUAGE),
-                        workflow=workflow,
-                    )
-                    for msg, user in message_and_user[i:i+self.super_batch_size]
+            tasks = [x for x in tasks if x[2].get('message_id') not in stale]
+            stale_count -= len(tasks)
+            logger.info('%s messages of not available offers %s are skipped.', stale_count, ', '.join(stale))
+
+        # Redelivered or retried messages of a fan-out are dropped here.
+        delivery_keys = [self._get_delivery_key(headers, chat_id) for _, chat_id, headers in tasks]
+        claimed = db_module.claim_deliveries([x for x in delivery_keys if x is not None])
+        duplicates_count = len(tasks)
+        for (_, _, headers), key in zip(tasks, delivery_keys):
+            if key is not None and key not in claimed:
+                report.count(headers, 'duplicate')
+        tasks = [task for task, key in zip(tasks, delivery_keys) if key is None or key in claimed]
+        duplicates_count -= len(tasks)
+        if duplicates_count:
+            logger.info('%s messages were already delivered.', duplicates_count)
+
+        # Claims which are neither confirmed nor released. They are released if the batch fails to be handled,
+        #   so its messages are not taken for duplicates when it's redelivered.
+        pending = set(claimed)
+
+        try:
+            with collect_deactivations() as deactivated:
+                futures = [
+                    get_send_executor().submit(
+                        copy_context().run, self._send, reply, chat_id, Workflow(headers['workflow'])
+                    ) for reply, chat_id, headers in tasks
                 ]
+                results = [x.result() for x in futures]
+                blocked = set(deactivated)
+
+            postponed = OrderedDict()   # type: Dict[int, Tuple[dict, List[Tuple[dict, int]], List[RetryLater]]]
+            failed = []  # type: List[Tuple[dict, List[Tuple[dict, int]], Exception]]
+            sent_keys = []
+            for (reply, chat_id, headers), (error, finished_at) in zip(tasks, results):
+                if isinstance(error, RetryLater):
+                    _, recipients, errors = postponed.setdefault(id(headers), (headers, [], []))
+                    recipients.append((reply, chat_id))
+                    errors.append(error)
+                    continue
+
+                if error is not None:
+                    failed.append((headers, [(reply, chat_id)], error))
+                    continue
+
+                sent_keys.append(self._get_delivery_key(headers, chat_id))
+                if (chat_id, Workflow(headers['workflow'])) in blocked:
+                    report.count(headers, 'blocked')
+                else:
+                    report.count_delivered(headers, at=finished_at)
+
+            sent_keys = [x for x in sent_keys if x is not None]
+            db_module.confirm_deliveries(sent_keys)
+            pending.difference_update(sent_keys)
+
+            for headers, recipients, errors in postponed.values():
+                failures = headers.get('failures', 0) + any(x.is_failure for x in errors)
+                delay = self.retry_policy.get_delay(failures, retry_after=max(x.retry_after for x in errors))
+
+                if delay is None:
+                    failed.append((headers, recipients, errors[0].__cause__ or errors[0]))
+                    continue
+
+                logger.warning('%s messages are postponed for %.1f s.', len(recipients), delay)
+                pending.difference_update(self._release_deliveries(headers, recipients))
+                self.requeue(self._serialize_recipients(dict(headers, failures=failures), recipients), delay=delay)
+
+            for headers, recipients, error in failed:
+                logger.warning('%s messages are kept in dead letters: %r', len(recipients), error)
+                for _ in recipients:
+                    report.count(headers, 'failed')
+                pending.difference_update(self._release_deliveries(headers, recipients))
+
+                # Retries start over once the letter is replayed.
+                db_module.add_dead_letter(
+                    queue=SendQueue.MASS,
+                    payload=self._serialize_recipients(
+                        {k: v for k, v in headers.items() if k != 'failures'}, recipients
+                    ),
+                    error=repr(error),
+                )
+
+        except Exception:
+            db_module.release_deliveries(list(pending))
+            raise
+
+        report.save()
+
+    def _release_deliveries(self, headers: dict, recipients: List[Tuple[dict, int]]) -> List[str]:
+        """
+        Messages which are not delivered are not remembered by the ledger, so that retries are not dropped.
+
+        Returns
+        -------
+        Keys released.
+
+        """
+        keys = [
+            key for key in (self._get_delivery_key(headers, chat_id) for _, chat_id in recipients)
+            if key is not None
+        ]
+        db_module.release_deliveries(keys)
+        return keys
+
+    def requeue(self, payload: str, *, delay: float):
+        """
+        Put an envelope back into the send-message queue to be processed in `delay` seconds.
+        """
+        raise NotImplementedError()
+
+    def put_super_batch_into_queue(self, payload: str, *, group_id: str):
+        raise NotImplementedError()
+
+    def _get_super_batch_group_id(
+            self, *, fanout_id: Optional[ObjectId], location: Optional[str], number: int
+    ) -> str:
+        """
+        Super-batches of a fan-out (or location) are spread over `super_batch_group_shards` groups in round-robin.
+            Different fan-outs never share a group unless `common` grouping is configured.
+        """
+        if self.super_batch_grouping == SuperBatchGrouping.FANOUT and fanout_id is not None:
+            key = f'fanout-{fanout_id}'
+        elif self.super_batch_grouping == SuperBatchGrouping.LOCATION and location:
+            key = f'location-{sha256(location.encode()).hexdigest()[:16]}'
+        else:
+            key = 'CommonGroup'
+
+        shard = number % self.super_batch_group_shards
+        return key if shard == 0 else f'{key}-{shard}'
+
+    def push_super_batch(
+            self,
+            *,
+            message_and_user: Iterable[Tuple[Reply, Recipient]],
+            workflow: Workflow,
+            fanout_id: Optional[ObjectId]=None,
+            message_id: Optional[str]=None,
+            location: Optional[str]=None,
+            first_number: int=0,
+    ) -> int:
+        """
+        Consumes `message_and_user` lazily: each super-batch is queued as soon as it's collected.
+
+        Parameters
+        ----------
+        message_id
+            Offer being delivered. Senders skip it once the offer is booked or deactivated.
+        location
+            Audience location, used by `location` super-batch grouping.
+        first_number
+            Number of the first super-batch. Steps of a fan-out continue the numbering,
+                so that their super-batches keep rotating over group shards.
+
+        Returns
+        -------
+        Number of messages queued.
+
+        """
+        # Replies are kept along with their rendering and its size, so that `id(msg)` stays unique.
+        rendered = {}   # type: Dict[Tuple[int, str], Tuple[Reply, dict, int]]
+        headers = self._build_headers(workflow=workflow, fanout_id=fanout_id, message_id=message_id)
+        headers_size = len(self._serialize_envelope(headers, []))
+        # Compressed payload size is checked after encoding, see `_pack_super_batch`.
+        max_size = self.super_batch_max_bytes * (2 if self.super_batch_compression else 1)
+        number = first_number
+        total = 0
+
+        chat_ids = OrderedDict()    # type: Dict[Tuple[int, str], List[int]]
+        size = headers_size
+        recipients_count = 0
+
+        def flush():
+            nonlocal number
+            for payload in self._pack_super_batch(
+                    headers, [(rendered[key][1], ids) for key, ids in chat_ids.items()]
+            ):
+                self.put_super_batch_into_queue(
+                    payload,
+                    group_id=self._get_super_batch_group_id(fanout_id=fanout_id, location=location, number=number),
+                )
+                number += 1
+
+        for msg, recipient in message_and_user:
+            key = (id(msg), get_language_code(recipient.language))
+            if key not in rendered:
+                reply = self._render_reply(msg, language=key[1])
+                rendered[key] = msg, reply, len(self._serialize_envelope({}, [(reply, [])]))
+
+            chat_id = int(recipient.chat_id)
+            item_size = len(str(chat_id)) + 1 + (0 if key in chat_ids else rendered[key][2])
+            if recipients_count and (recipients_count >= self.super_batch_size or size + item_size > max_size):
+                flush()
+                total += recipients_count
+                logger.info('%s messages are sent into super-queue', total)
+                chat_ids, size, recipients_count = OrderedDict(), headers_size, 0
+                item_size = len(str(chat_id)) + 1 + rendered[key][2]
+
+            chat_ids.setdefault(key, []).append(chat_id)
+            size += item_size
+            recipients_count += 1
+
+        if recipients_count:
+            flush()
+            total += recipients_count
+            logger.info('%s messages are sent into super-queue', total)
+
+        return total
+
+    def _pack_super_batch(self, headers: dict, messages: List[Tuple[dict, List[int]]]) -> List[str]:
+        """
+        Returns
+        -------
+        Encoded super-batches, split in halves until every one fits `super_batch_max_bytes`.
+        """
+        payload = self._serialize_envelope(headers, messages, compress=self.super_batch_compression)
+        recipients = [(reply, chat_id) for reply, chat_ids in messages for chat_id in chat_ids]
+        if len(payload) <= self.super_batch_max_bytes or len(recipients) < 2:
+            return [payload]
+
+        half = len(recipients) // 2
+        return [
+            payload
+            for part in (recipients[:half], recipients[half:])
+            for payload in self._pack_super_batch(headers, self._group_recipients(part))
+        ]
+
+    @staticmethod
+    def _group_recipients(recipients: Iterable[Tuple[dict, int]]) -> List[Tuple[dict, List[int]]]:
+        messages = OrderedDict()    # type: Dict[int, Tuple[dict, List[int]]]
+        for reply, chat_id in recipients:
+            messages.setdefault(id(reply), (reply, []))[1].append(chat_id)
+
+        return list(messages.values())
+
+    def put_fanout_step(
+            self, fanout_id: ObjectId, *, last_user_id: Optional[ObjectId], is_dormant_pass: bool=False, delay: float=0
+    ):
+        """
+        Schedule `advance_fanout` for a worker in `delay` seconds.
+
+        Parameters
+        ----------
+        is_dormant_pass
+            The step belongs to the dormant pass. Both passes start with no checkpoint.
+
+        """
+        raise NotImplementedError()
+
+    def _get_step_delay(self, fanout: Fanout, *, passed: int) -> float:
+        """
+        Returns
+        -------
+        Seconds to wait before the next step, so that a fan-out is spread evenly over `fanout_delivery_window`.
+            The pace is kept against `created_at`, so slow steps are caught up with.
+        """
+        if not self.fanout_delivery_window or not fanout.audience_size or fanout.created_at is None:
+            return 0
+
+        progress = min(passed / fanout.audience_size, 1)
+        due = fanout.created_at + datetime.timedelta(seconds=self.fanout_delivery_window * progress)
+        return min(max((due - datetime.datetime.utcnow()).total_seconds(), 0), self.max_step_delay)
+
+    @staticmethod
+    def _serialize_fanout_step(fanout_id: ObjectId, last_user_id: Optional[ObjectId]) -> str:
+        return json.dumps({'fanout_id': str(fanout_id), 'last_user_id': last_user_id and str(last_user_id)})
+
+    def start_fanout(
+            self,
+            *,
+            templates: Dict[str, Reply],
+            message_id: Optional[str],
+            owner_id: Optional[ObjectId],
+            location: str,
+            workflow: Workflow,
+    ) -> ObjectId:
+        """
+        Creates a fan-out job to deliver a message to the whole location audience in background.
+
+        Parameters
+        ----------
+        templates
+            Reply per language.
+        message_id
+            Offer to deliver. Digests of several offers have none.
+
+        """
+        fanout_id = db_module.create_fanout(
+            message_id=message_id,
+            owner_id=owner_id,
+            location=location,
+            workflow=workflow,
+            templates={
+                language: self._render_reply(reply, language=language) for language, reply in templates.items()
+            },
+            dormant_before=(
+                datetime.datetime.utcnow() - datetime.timedelta(days=self.dormant_after_days)
+                if self.dormant_after_days else None
+            ),
+            dormant_audience=self.dormant_audience,
+        )
+        self.put_fanout_step(fanout_id, last_user_id=None)
+        return fanout_id
+
+    def advance_fanout(self, fanout_id: Union[str, ObjectId], last_user_id: Optional[Union[str, ObjectId]]):
+        """
+        Queues the next `fanout_step_size` recipients of the fan-out and checkpoints the progress.
+            Schedules the next step if there are more recipients.
+
+        Parameters
+        ----------
+        last_user_id
+            Checkpoint the step was scheduled for. Steps for outdated checkpoints are skipped.
+
+        """
+        fanout = db_module.claim_fanout(
+            fanout_id,
+            last_user_id=last_user_id and ObjectId(last_user_id),
+            lease=datetime.timedelta(seconds=FANOUT_LEASE_SECONDS),
+        )
+        if fanout is None:
+            logger.info('Fan-out %s step is outdated or is processed by another worker.', fanout_id)
+            return
+
+        if fanout.message_id is not None and fanout.message_id in self.offer_states.get_stale([fanout.message_id]):
+            logger.info('Offer %s is not available anymore. Fan-out %s is stopped.', fanout.message_id, fanout_id)
+            db_module.checkpoint_fanout(fanout.fanout_id, last_user_id=None, enqueued=0, is_done=True)
+            return
+
+        try:
+            audience = list(db_module.iter_demand_audience(
+                fanout.location,
+                after_id=fanout.last_user_id,
+                limit=self.fanout_step_size,
+                **self._get_audience_filters(fanout),
+            ))
+            last_user_id = audience[-1].id if audience else None
+            is_done = len(audience) < self.fanout_step_size
+            start_dormant_pass = (
+                is_done and fanout.dormant_audience == DormantAudience.LAST and not fanout.is_dormant_pass
+            )
+            streamed = len(audience)
+            audience = self._apply_notification_cap(audience, fanout=fanout)
+
+            replies = {language: Reply(**reply) for language, reply in fanout.templates.items()}
+            random.shuffle(audience)
+
+            enqueued = self.push_super_batch(
+                message_and_user=(
+                    (replies[get_language_code(recipient.language)], recipient) for recipient in audience
+                ),
+                workflow=fanout.workflow,
+                fanout_id=fanout.fanout_id,
+                message_id=fanout.message_id,
+                location=fanout.location,
+                first_number=fanout.enqueued // self.super_batch_size,
+            )
+
+        except Exception:
+            db_module.release_fanout(fanout.fanout_id)
+            raise
+
+        # Capped recipients are passed over too, otherwise the pace is kept as if they were still ahead.
+        passed = fanout.enqueued + fanout.counters.get('capped', 0) + streamed
+        if start_dormant_pass:
+            is_done = False
+            last_user_id = None
+
+        delay = 0 if is_done else self._get_step_delay(fanout, passed=passed)
+        db_module.checkpoint_fanout(
+            fanout.fanout_id,
+            last_user_id=last_user_id,
+            enqueued=enqueued,
+            is_done=is_done,
+            next_step_at=datetime.datetime.utcnow() + datetime.timedelta(seconds=delay),
+            start_dormant_pass=start_dormant_pass,
+        )
+
+        if not is_done:
+            self.put_fanout_step(
+                fanout.fanout_id,
+                last_user_id=last_user_id,
+                is_dormant_pass=fanout.is_dormant_pass or start_dormant_pass,
+                delay=delay,
             )
-            logger.info('%s messages are sent into super-queue', i+self.super_batch_size)
+
+    @staticmethod
+    def _get_audience_filters(fanout: Fanout) -> dict:
+        """
+        Returns
+        -------
+        `iter_demand_audience` filters of the current pass: active users first, dormant ones are either
+            excluded or go in a separate pass afterwards.
+        """
+        if fanout.dormant_before is None or fanout.dormant_audience == DormantAudience.INCLUDE:
+            return {}
+
+        if fanout.is_dormant_pass:
+            return {'seen_before': fanout.dormant_before}
+
+        return {'seen_since': fanout.dormant_before}
+
+    def _apply_notification_cap(self, audience: List[Recipient], *, fanout: Fanout) -> List[Recipient]:
+        """
+        Drops recipients who have got `notification_cap` offers within the period already.
+            It happens before anything is rendered or queued for them.
+        """
+        if not self.notification_cap or not audience:
+            return audience
+
+        allowed = db_module.take_notification_quota(
+            [x.id for x in audience], limit=self.notification_cap, period=self.notification_cap_period
+        )
+        capped = len(audience) - len(allowed)
+        if capped:
+            logger.info('%s recipients of fan-out %s are over the notification cap.', capped, fanout.fanout_id)
+            db_module.count_fanout_deliveries({fanout.fanout_id: {'capped': capped}})
+
+        return [x for x in audience if x.id in allowed]
+
+    def schedule_digest_flush(self, flush: Callable[[], None], *, delay: float):
+        """
+        Digests are flushed by schedule on staging/live (see `serverless.yaml`).
+        """
+
+    def resume_stale_fanouts(self) -> int:
+        """
+        Reschedules unfinished fan-outs which were not advanced recently, e.g. because a worker crashed.
+        """
+        fanouts = db_module.get_stale_fanouts(idle_for=datetime.timedelta(seconds=FANOUT_RESUME_AFTER_SECONDS))
+        for fanout_id, last_user_id, is_dormant_pass in fanouts:
+            logger.warning('Fan-out %s is resumed.', fanout_id)
+            self.put_fanout_step(fanout_id, last_user_id=last_user_id, is_dormant_pass=is_dormant_pass)
+
+        return len(fanouts)
 
 
 class BaseSingleMessageQueue:
+    """
+    Messages put within `buffered()` block are collected and queued at once when the block is over.
+    """
+    _buffer = ContextVar('single_message_buffer', default=None)
+    retry_policy = RetryPolicy()
+    envelope_version = 2
+    """ 2: only the fields of `OriginalMessage` are kept, replies have no default values.
+        1 (no `version`): `original_message` is a whole Telegram message.
+    """
+
     def put(
         self,
         *,
@@ -74,148 +745,513 @@ class BaseSingleMessageQueue:
         replies: Iterable[Reply],
         workflow: Workflow
     ):
-        replies_data = [asdict(r) for r in replies if r is not None]
-        for r in replies_data:
-            r.pop('next_state')
-
-        self._put_serialized(json.dumps({
+        item = tg_chat_id, json.dumps({
+            'version': self.envelope_version,
             'tg_chat_id': tg_chat_id,
-            'original_message': original_message and original_message.to_dict(),
-            'replies': replies_data,
+            'original_message': original_message and asdict(OriginalMessage.from_tg(original_message)),
+            'replies': [self._serialize_reply(x) for x in replies if x is not None],
             'workflow': workflow.value,
-        }, cls=LazyAwareJsonEncoder))
+        }, cls=LazyAwareJsonEncoder, separators=(',', ':'))
+
+        buffer = self._buffer.get()
+        if buffer is None:
+            self._put_serialized_batch([item])
+        else:
+            buffer.append(item)
+
+    @contextmanager
+    def buffered(self):
+        """
+        Collects all the messages put within the block and flushes them in batches at the end of it.
+            Messages are flushed even if the block fails, as they would have been queued without buffering.
+        """
+        buffer = []
+        token = self._buffer.set(buffer)
+
+        try:
+            yield
+        finally:
+            self._buffer.reset(token)
+            if buffer:
+                self._put_serialized_batch(buffer)
+
+    def has_buffered(self, tg_chat_id: int) -> bool:
+        """
+        Whether messages for the chat were put within the current `buffered()` block.
+        """
+        # Chat ids of users are strings sometimes.
+        return any(int(x) == int(tg_chat_id) for x, _ in self._buffer.get() or [])
+
+    def _put_serialized_batch(self, items: List[Tuple[int, str]]):
+        """
+
+        Parameters
+        ----------
+        items
+            (tg_chat_id, serialized messages) pairs in the order they were put.
+        """
+        raise NotImplementedError()
+
+    @staticmethod
+    def _serialize_reply(reply: Reply) -> dict:
+        default = Reply()
+        return {
+            k: v for k, v in asdict(reply).items()
+            if k != 'next_state' and v != getattr(default, k)
+        }
+
+    @staticmethod
+    def _decode_original_message(data: dict) -> Optional[OriginalMessage]:
+        original_message = data['original_message']
+        if original_message is None:
+            return None
 
-    def _put_serialized(self, data: str):
+        if 'version' not in data:
+            # Legacy envelope: a whole Telegram message.
+            return OriginalMessage(
+                message_id=original_message['message_id'], has_text=original_message.get('text') is not None
+            )
+
+        return OriginalMessage(**original_message)
+
+    def requeue(self, data: str, *, tg_chat_id: int, delay: float):
+        """
+        Put serialized messages back into the queue to be processed in `delay` seconds.
+        """
         raise NotImplementedError()
 
-    def process(self, data: str):
+    def process(self, serialized_data: str):
+        data = serialized_data
+
         try:
-            data = json.loads(data)
+            data = json.loads(serialized_data)
             send_messages(
                 tg_chat_id=data['tg_chat_id'],
-                original_message=(
-                    data['original_message'] and TgMessage.de_json(data['original_message'], None)
-                ),
+                original_message=self._decode_original_message(data),
                 replies=[Reply(**x) for x in data['replies']],
                 workflow=Workflow(data['workflow']),
             )
-        except Exception:
+        except RetryLater as e:
+            failures = data.get('failures', 0) + e.is_failure
+            delay = self.retry_policy.get_delay(failures, retry_after=e.retry_after)
+
+            if delay is None:
+                error = e.__cause__ or e
+                logger.warning('Messages for %s are kept in dead letters: %r', data['tg_chat_id'], error)
+                self._add_dead_letter(data, error)
+                return
+
+            logger.warning('Messages for %s are postponed for %.1f s.', data['tg_chat_id'], delay)
+            self.requeue(
+                json.dumps(dict(data, failures=failures)), tg_chat_id=data['tg_chat_id'], delay=delay,
+            )
+        except Exception as e:
             logger.exception('Message was not sent. Data:\n%s', data)
+            self._add_dead_letter(data, e)
+
+    @staticmethod
+    def _add_dead_letter(data: Union[dict, str], error: Exception):
+        if isinstance(data, dict):
+            # Retries start over once the letter is replayed.
+            data = json.dumps({k: v for k, v in data.items() if k != 'failures'})
+
+        db_module.add_dead_letter(queue=SendQueue.SINGLE, payload=data, error=repr(error))
 
 
 class AwsMassMessageQueue(BaseMassMessageQueue):
     batch_size = 10
-    super_batch_size = 100
+    super_batch_size = SUPER_BATCH_MAX_RECIPIENTS
 
     def __init__(self):
         sqs = boto3.resource('sqs', region_name='eu-central-1')
         self._queue = sqs.get_queue_by_name(QueueName=f'send_message_{STAGE}.fifo')
         self._super_queue = sqs.get_queue_by_name(QueueName=f'super_send_{STAGE}.fifo')
+        self._step_queue = None
+
+    def put_super_batch_into_queue(self, payload: str, *, group_id: str):
+        # Content based deduplication: an identical super-batch is a retry of the same one.
+        self._super_queue.send_message(
+            MessageBody=payload,
+            MessageDeduplicationId=sha256(payload.encode()).hexdigest(),
+            MessageGroupId=group_id,
+        )
 
-    def put_super_batch_into_queue(self, items: List[str]):
+    def put_fanout_step(
+            self, fanout_id: ObjectId, *, last_user_id: Optional[ObjectId], is_dormant_pass: bool=False, delay: float=0
+    ):
         """
+        Fan-out steps share the super-queue, but their `step-<fanout id>` group is never used by super-batches
+            (see `_get_super_batch_group_id`), so they don't wait behind them. The same step is deduplicated by
+            FIFO queue.
+        FIFO queues don't support per-message delays. Delayed steps go to a standard queue,
+            duplicates are skipped by `advance_fanout` there.
+        """
+        body = self._serialize_fanout_step(fanout_id, last_user_id)
 
-        Parameters
-        ----------
-        items
-            100 items
+        if delay >= 1:
+            self._get_step_queue().send_message(MessageBody=body, DelaySeconds=int(delay))
+            return
 
-        """
-        payload = json.dumps(items)
         self._super_queue.send_message(
-            MessageBody=payload,
-            MessageDeduplicationId=str(uuid4()),
-            MessageGroupId='CommonGroup',
+            MessageBody=body,
+            # The dormant pass starts from no checkpoint again: it must not be taken for the first step.
+            MessageDeduplicationId=f'{fanout_id}-{int(is_dormant_pass)}-{last_user_id}',
+            MessageGroupId=f'step-{fanout_id}',
         )
 
-    def redestrib_super_batch(self, items: List[str]):
+    def _get_step_queue(self):
+        # It's only required if `FANOUT_DELIVERY_WINDOW_SECONDS` is set.
+        if self._step_queue is None:
+            self._step_queue = boto3.resource('sqs', region_name='eu-central-1').get_queue_by_name(
+                QueueName=f'fanout_step_{STAGE}'
+            )
+
+        return self._step_queue
+
+    def redestrib_super_batch(self, data: Union[dict, List[str]]):
+        """
+        Splits a super-batch envelope into single-recipient envelopes for the send-message queue.
+            A list of serialized messages is a legacy super-batch format.
+        """
+        if isinstance(data, dict):
+            headers = {k: v for k, v in data.items() if k != 'messages'}
+            recipients = list(self._iter_envelope(data))
+
+            message_id = headers.get('message_id')
+            if message_id is not None and message_id in self.offer_states.get_stale([message_id]):
+                logger.info('%s messages of not available offer %s are skipped.', len(recipients), message_id)
+                if 'fanout_id' in headers:
+                    db_module.count_fanout_deliveries({ObjectId(headers['fanout_id']): {'stale': len(recipients)}})
+                return
+            items = [self._serialize_envelope(headers, [(reply, [chat_id])]) for reply, chat_id in recipients]
+            deduplication_ids = [
+                headers.get('fanout_id') and f'{headers["fanout_id"]}-{chat_id}' for _, chat_id in recipients
+            ]
+        else:
+            items = data
+            deduplication_ids = [None] * len(items)
+
         for i in range(0, len(items), self.batch_size):
-            self.put_mass_messages_into_queue(items[i:i + self.batch_size])
+            self.put_mass_messages_into_queue(
+                items[i:i + self.batch_size], deduplication_ids=deduplication_ids[i:i + self.batch_size]
+            )
 
             logger.info('%s messages are sent into send-message queue', i + self.batch_size)
 
-    def put_mass_messages_into_queue(self, items: List[str]):
+    def requeue(self, payload: str, *, delay: float):
+        if delay >= 1:
+            _put_aws_retry(SendQueue.MASS, payload, delay=delay)
+            return
+
+        self.put_mass_messages_into_queue([payload])
+
+    def put_mass_messages_into_queue(self, items: List[str], *, deduplication_ids: List[Optional[str]]=None):
         """
 
         Parameters
         ----------
         items
             10 items
+        deduplication_ids
+            Deterministic FIFO deduplication ids, so that SQS drops copies sent within 5 minutes.
+                Random ones are used if not set.
         """
+        deduplication_ids = deduplication_ids or [None] * len(items)
+
         self._queue.send_messages(Entries=[{
             'Id': str(i),
             'MessageBody': x,
             'MessageGroupId': str(i),
-            'MessageDeduplicationId': str(uuid4()),
-        } for i, x in enumerate(items)])
+            'MessageDeduplicationId': deduplication_id or str(uuid4()),
+        } for i, (x, deduplication_id) in enumerate(zip(items, deduplication_ids))])
 
 
 class AwsSingleMessageQueue(BaseSingleMessageQueue):
     queue_name = f'single_message_{STAGE}.fifo'
     number_of_groups = 100
+    batch_size = 10
 
     def __init__(self):
         sqs = boto3.resource('sqs', region_name='eu-central-1')
         self._queue = sqs.get_queue_by_name(QueueName=self.queue_name)
 
-    def _put_serialized(self, data: str):
-        self._queue.send_message(
-            MessageBody=data,
-            MessageDeduplicationId=str(uuid4()),
-            MessageGroupId=str(random.randint(1, self.number_of_groups)),
+    def _get_group_id(self, tg_chat_id: int) -> str:
+        # Messages for the same chat go into the same group, so they are processed in order.
+        return str(abs(int(tg_chat_id)) % self.number_of_groups)
+
+    def _put_serialized_batch(self, items: List[Tuple[int, str]]):
+        """
+        Entries SQS failed on its side are sent once more. Messages which are not queued after that
+            raise, as a failed `send_message` would.
+        """
+        for i in range(0, len(items), self.batch_size):
+            entries = [{
+                'Id': str(j),
+                'MessageBody': data,
+                'MessageDeduplicationId': str(uuid4()),
+                'MessageGroupId': self._get_group_id(tg_chat_id),
+            } for j, (tg_chat_id, data) in enumerate(items[i:i + self.batch_size])]
+
+            failed = self._queue.send_messages(Entries=entries).get('Failed', [])
+            retried = {x['Id'] for x in failed if not x.get('SenderFault')}
+            if retried:
+                logger.warning('%s messages were not queued. Retrying.', len(retried))
+                # Deduplication ids are kept: a message accepted despite the failure is not queued twice.
+                failed = [x for x in failed if x['Id'] not in retried] + self._queue.send_messages(
+                    Entries=[x for x in entries if x['Id'] in retried]
+                ).get('Failed', [])
+
+            if failed:
+                raise RuntimeError(f'{len(failed)} messages were not queued: {failed}')
+
+    def requeue(self, data: str, *, tg_chat_id: int, delay: float):
+        if delay >= 1:
+            _put_aws_retry(SendQueue.SINGLE, data, delay=delay)
+            return
+
+        self._put_serialized_batch([(tg_chat_id, data)])
+
+
+_retry_queue = None
+
+
+def _put_aws_retry(queue: SendQueue, payload: str, *, delay: float):
+    """
+    FIFO queues don't support per-message delays, so retries wait in a standard queue
+        (see `serverless.send_retries`). SQS delay is 15 minutes at most.
+    """
+    global _retry_queue
+    if _retry_queue is None:
+        _retry_queue = boto3.resource('sqs', region_name='eu-central-1').get_queue_by_name(
+            QueueName=f'send_retry_{STAGE}'
         )
 
+    _retry_queue.send_message(
+        MessageBody=json.dumps({'queue': queue.value, 'payload': payload}),
+        DelaySeconds=min(int(delay), 900),
+    )
+
+
+class LocalWorkerRuntime:
+    """
+    Workers for local (dev and self-hosted) queues.
+
+    Every queue has its own *lane*. Lanes are bounded and polled in `lanes` order,
+        so interactive replies never wait behind a fan-out.
+    A producer which can not put a message into a full lane for `put_timeout` seconds handles it itself.
+        It slows fan-outs down instead of growing memory, and never blocks workers producing into their own lane.
+    """
+    poll_interval = 0.1
 
-class LocalQueue:
-    def __init__(self, handler):
-        self._queue = multiprocessing.Queue()
-        self._handler = handler
-        multiprocessing.Process(target=self._launch_threads).start()
+    def __init__(
+            self,
+            lanes: Dict[str, Callable[[str], None]],
+            *,
+            processes: int=LOCAL_QUEUE_PROCESSES,
+            threads: int=LOCAL_QUEUE_THREADS,
+            max_size: int=LOCAL_QUEUE_MAX_SIZE,
+            put_timeout: float=LOCAL_QUEUE_PUT_TIMEOUT,
+            queue_factory=multiprocessing.Queue,
+            event_factory=multiprocessing.Event,
+    ):
+        self._handlers = lanes
+        self._queues = OrderedDict((lane, queue_factory(max_size)) for lane in lanes)
+        self._stopping = event_factory()
+        self._processes_number = processes
+        self._threads_number = threads
+        self._put_timeout = put_timeout
+        self._processes = []
+        self._scheduler_lock = Lock()
+        self._scheduler_pid = None
+        self._scheduled = None
+        self._scheduled_changed = None
+        self._sequence = count()
+
+    def start(self):
+        for _ in range(self._processes_number):
+            process = multiprocessing.Process(target=self._launch_threads)
+            process.start()
+            self._processes.append(process)
+
+        atexit.register(self.stop)
+
+    def stop(self, timeout: float=LOCAL_QUEUE_DRAIN_TIMEOUT):
+        """
+        Let workers handle everything that is queued already and wait for them to exit.
+        """
+        self._stopping.set()
+        deadline = time.time() + timeout
+        for process in self._processes:
+            process.join(max(deadline - time.time(), 0))
+            if process.is_alive():
+                logger.warning('Queue worker %s did not drain in time. Terminating.', process.pid)
+                process.terminate()
+
+        self._processes = []
 
     def _launch_threads(self):
+        # Ctrl+C goes to the whole process group. Leave it to the parent, which drains the lanes.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
         # Mongo client can not into multiprocessing (but can into multithreading)
         db_module.db = db_module.create_mongo_connector()
 
-        ts = [Thread(target=self.read_queue) for _ in range(10)]
+        ts = [Thread(target=self.read_queue) for _ in range(self._threads_number)]
         for t in ts:
             t.start()
         for t in ts:
             t.join()
 
-    def read_queue(self):
+    def _get_next(self) -> Optional[Tuple[str, str]]:
+        """
+        Returns
+        -------
+        (lane, message) from the first non-empty lane or None if the runtime is stopping and all lanes are empty.
+        """
+        first_lane = next(iter(self._queues))
         while True:
+            for lane, lane_queue in self._queues.items():
+                try:
+                    return lane, lane_queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+            if self._stopping.is_set():
+                return None
+
             try:
-                msg = self._queue.get()
-            except KeyboardInterrupt:
-                logger.info('Stop sending messages.')
+                return first_lane, self._queues[first_lane].get(timeout=self.poll_interval)
+            except queue.Empty:
+                pass
+
+    def read_queue(self):
+        while True:
+            item = self._get_next()
+            if item is None:
                 break
 
-            self._handler(msg)
+            self._handle(*item)
+
+    def _handle(self, lane: str, msg: str):
+        try:
+            self._handlers[lane](msg)
+        except Exception:
+            logger.exception('Failed to handle a %s message.', lane)
+
+    def put(self, lane: str, msg: str):
+        try:
+            self._queues[lane].put(msg, timeout=self._put_timeout)
+        except queue.Full:
+            logger.warning('%s lane is full. Handling the message in place.', lane)
+            self._handle(lane, msg)
+
+    def put_later(self, lane: str, msg: str, *, delay: float):
+        """
+        Delayed messages wait in a heap served by a single scheduler thread per process.
+            Messages which are not due yet are lost on shutdown (fan-outs are resumed by `resume_fanouts`).
+        """
+        with self._scheduler_lock:
+            if self._scheduler_pid != os.getpid():
+                # Worker processes are forked: they need a scheduler of their own.
+                self._scheduler_pid = os.getpid()
+                self._scheduled = []
+                self._scheduled_changed = Condition()
+                Thread(target=self._run_scheduler, args=(self._scheduled, self._scheduled_changed), daemon=True).start()
+
+            scheduled, scheduled_changed = self._scheduled, self._scheduled_changed
+
+        with scheduled_changed:
+            heapq.heappush(scheduled, (time.monotonic() + delay, next(self._sequence), lane, msg))
+            scheduled_changed.notify()
+
+    def _run_scheduler(self, scheduled: list, scheduled_changed: Condition):
+        while True:
+            with scheduled_changed:
+                while not scheduled or scheduled[0][0] > time.monotonic():
+                    scheduled_changed.wait(scheduled[0][0] - time.monotonic() if scheduled else None)
+
+                _, _, lane, msg = heapq.heappop(scheduled)
+
+            self.put(lane, msg)
+
+
+INTERACTIVE_LANE = 'interactive'
+BULK_LANE = 'bulk'
+
+
+def _handle_interactive(msg: str):
+    get_single_queue().process(msg)
+
+
+def _handle_bulk(msg: str):
+    get_mass_queue().handle(msg)
 
-    def put(self, msg: str):
-        self._queue.put(msg)
+
+_local_runtime = None
+
+
+def get_local_runtime() -> LocalWorkerRuntime:
+    """
+    Both local queues share workers. Handlers are looked up by lane,
+        so forked workers resolve them with their own queue instances.
+    """
+    global _local_runtime
+    if _local_runtime is None:
+        _local_runtime = LocalWorkerRuntime(OrderedDict((
+            (INTERACTIVE_LANE, _handle_interactive),
+            (BULK_LANE, _handle_bulk),
+        )))
+        _local_runtime.start()
+    return _local_runtime
 
 
 class LocalMassMessageQueue(BaseMassMessageQueue):
     super_batch_size = 100
 
     def __init__(self):
-        self._mass_message_queue = LocalQueue(self.process)
+        self._runtime = get_local_runtime()
 
-    def put_super_batch_into_queue(self, items: List[str]):
-        self.put_mass_messages_into_queue(items)
+    def handle(self, payload: str):
+        data = self.loads(payload)
+        if self.is_fanout_step(data):
+            self.advance_fanout(data['fanout_id'], data['last_user_id'])
+        else:
+            self.process(payload)
 
-    def put_mass_messages_into_queue(self, items: List[str]):
+    def schedule_digest_flush(self, flush: Callable[[], None], *, delay: float):
+        timer = Timer(delay, flush)
+        timer.daemon = True
+        timer.start()
+
+    def put_fanout_step(
+            self, fanout_id: ObjectId, *, last_user_id: Optional[ObjectId], is_dormant_pass: bool=False, delay: float=0
+    ):
+        if delay:
+            self._runtime.put_later(BULK_LANE, self._serialize_fanout_step(fanout_id, last_user_id), delay=delay)
+        else:
+            self._runtime.put(BULK_LANE, self._serialize_fanout_step(fanout_id, last_user_id))
+
+    def put_super_batch_into_queue(self, payload: str, *, group_id: str):
+        self._runtime.put(BULK_LANE, payload)
+
+    def put_mass_messages_into_queue(self, items: List[str], *, deduplication_ids: List[Optional[str]]=None):
         for x in items:
-            self._mass_message_queue.put(x)
+            self._runtime.put(BULK_LANE, x)
+
+    def requeue(self, payload: str, *, delay: float):
+        self._runtime.put_later(BULK_LANE, payload, delay=delay)
 
 
 class LocalSingleMessageQueue(BaseSingleMessageQueue):
     def __init__(self):
-        self._queue = LocalQueue(self.process)
+        self._runtime = get_local_runtime()
+
+    def _put_serialized_batch(self, items: List[Tuple[int, str]]):
+        for _, data in items:
+            self._runtime.put(INTERACTIVE_LANE, data)
 
-    def _put_serialized(self, data: str):
-        self._queue.put(data)
+    def requeue(self, data: str, *, tg_chat_id: int, delay: float):
+        self._runtime.put_later(INTERACTIVE_LANE, data, delay=delay)
 
 
 def _get_mass_queue() -> BaseMassMessageQueue:
@@ -0,0 +1,15 @@
+from rest_food.db import db
+from rest_food.enums import DigestState
+
+
+def forward():
+    # Offers of a location are added to its only open digest.
+    db.digests.create_index(
+        'location', unique=True, partialFilterExpression={'state': DigestState.OPEN.value}, name='open_location',
+    )
+    db.digests.create_index([('state', 1), ('flush_at', 1)])
+
+
+def backward():
+    db.digests.drop_index('open_location')
+    db.digests.drop_index('state_1_flush_at_1')
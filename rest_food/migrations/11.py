@@ -0,0 +1,28 @@
+from rest_food.db import db, _sync_audience
+from rest_food.enums import Workflow
+
+
+def forward():
+    db.users.create_index([('workflow', 1), ('last_seen', 1)])
+    db.audience.create_index([('location', 1), ('last_seen', 1)])
+
+    # The latest known interaction.
+    db.users.update_many(
+        {'last_seen': {'$exists': False}},
+        [{'$set': {'last_seen': {'$ifNull': ['$active_from', '$created_at']}}}],
+    )
+
+    for record in db.users.find(
+            {'workflow': Workflow.DEMAND.value},
+            projection={
+                'workflow': True, 'is_active': True, 'info': True, 'chat_id': True, 'provider': True, 'last_seen': True,
+            },
+    ):
+        _sync_audience(record)
+
+
+def backward():
+    db.users.drop_index('workflow_1_last_seen_1')
+    db.audience.drop_index('location_1_last_seen_1')
+    db.users.update_many({}, {'$unset': {'last_seen': ''}})
+    db.audience.update_many({}, {'$unset': {'last_seen': ''}})
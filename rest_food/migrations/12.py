@@ -0,0 +1,9 @@
+from rest_food.db import db
+
+
+def forward():
+    db.dead_letters.create_index([('queue', 1), ('_id', 1)])
+
+
+def backward():
+    db.dead_letters.drop_index('queue_1__id_1')
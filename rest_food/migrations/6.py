@@ -0,0 +1,9 @@
+from rest_food.db import db
+
+
+def forward():
+    db.rate_limits.create_index('expire_at', expireAfterSeconds=0)
+
+
+def backward():
+    db.rate_limits.drop_index('expire_at_1')
@@ -0,0 +1,11 @@
+from rest_food.db import db
+
+
+def forward():
+    db.users.create_index([('workflow', 1), ('info.location', 1), ('_id', 1)])
+    db.fanouts.create_index([('state', 1), ('updated_at', 1)])
+
+
+def backward():
+    db.users.drop_index('workflow_1_info.location_1__id_1')
+    db.fanouts.drop_index('state_1_updated_at_1')
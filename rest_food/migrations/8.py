@@ -0,0 +1,9 @@
+from rest_food.db import db
+
+
+def forward():
+    db.deliveries.create_index('expire_at', expireAfterSeconds=0)
+
+
+def backward():
+    db.deliveries.drop_index('expire_at_1')
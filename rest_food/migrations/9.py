@@ -0,0 +1,21 @@
+from rest_food.db import db, _sync_audience
+from rest_food.enums import Workflow
+
+
+def forward():
+    db.audience.create_index([('location', 1), ('_id', 1)])
+    db.audience.create_index([('chat_id', 1), ('provider', 1)])
+
+    for record in db.users.find(
+            {'workflow': Workflow.DEMAND.value},
+            projection={'workflow': True, 'is_active': True, 'info': True, 'chat_id': True, 'provider': True},
+    ):
+        _sync_audience(record)
+
+    # Fan-outs read recipients from `audience` now.
+    db.users.drop_index('workflow_1_info.location_1__id_1')
+
+
+def backward():
+    db.users.create_index([('workflow', 1), ('info.location', 1), ('_id', 1)])
+    db.audience.drop()
@@ -0,0 +1,188 @@
+"""
+Token buckets to keep Bot API calls within Telegram limits.
+    Buckets are shared between workers through mongodb on staging/live and are kept in memory locally.
+"""
+import datetime
+import logging
+import time
+from hashlib import sha1
+from threading import Lock
+from typing import Dict, Optional, Union
+
+from pymongo import ReturnDocument
+
+from rest_food import db as db_module
+from rest_food.exceptions import RetryLater
+from rest_food.settings import (
+    STAGE, TG_BOT_RATE_LIMIT, TG_BOT_RATE_BURST, TG_CHAT_RATE_LIMIT, TG_CHAT_RATE_BURST, TG_RATE_LIMIT_MAX_WAIT,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+class BaseRateLimitStore:
+    """
+    Buckets are kept as the time the next call is allowed at (GCRA), so a call reserves its slot at once
+        and never polls the store while it waits.
+    """
+    def reserve(self, key: str, *, rate: float, capacity: float, now: float, max_wait: float) -> float:
+        """
+        Reserves the earliest slot of the `key` bucket.
+
+        Returns
+        -------
+        Seconds to wait for the slot. Nothing is reserved if it's more than `max_wait`.
+
+        """
+        raise NotImplementedError()
+
+    def block(self, key: str, *, until: float):
+        """
+        Denies all slots of the `key` bucket until the moment specified.
+        """
+        raise NotImplementedError()
+
+
+class LocalRateLimitStore(BaseRateLimitStore):
+    def __init__(self):
+        self._buckets = {}  # type: Dict[str, dict]
+        self._lock = Lock()
+
+    def reserve(self, key: str, *, rate: float, capacity: float, now: float, max_wait: float) -> float:
+        with self._lock:
+            bucket = self._buckets.setdefault(key, {})
+            next_free = bucket.get('next_free', 0)
+            slot = max(now, next_free - (capacity - 1) / rate, bucket.get('blocked_until', 0))
+
+            if slot - now <= max_wait:
+                bucket['next_free'] = max(next_free, slot) + 1 / rate
+
+            return slot - now
+
+    def block(self, key: str, *, until: float):
+        with self._lock:
+            bucket = self._buckets.setdefault(key, {})
+            bucket['blocked_until'] = max(bucket.get('blocked_until', 0), until)
+
+
+class MongoRateLimitStore(BaseRateLimitStore):
+    """
+    Every bucket is a `rate_limits` document which is reserved with a single atomic pipeline update
+        (requires mongodb 4.2+). Documents expire by `expire_at` TTL index.
+    """
+    ttl = datetime.timedelta(hours=1)
+
+    def _expire_at(self) -> datetime.datetime:
+        return datetime.datetime.utcnow() + self.ttl
+
+    def reserve(self, key: str, *, rate: float, capacity: float, now: float, max_wait: float) -> float:
+        next_free = {'$ifNull': ['$next_free', 0]}
+        is_reserved = {'$lte': [{'$subtract': ['$slot', now]}, max_wait]}
+
+        bucket = db_module.db.rate_limits.find_one_and_update(
+            {'_id': key},
+            [
+                {'$set': {
+                    'slot': {'$max': [
+                        now,
+                        {'$subtract': [next_free, (capacity - 1) / rate]},
+                        {'$ifNull': ['$blocked_until', 0]},
+                    ]},
+                    'expire_at': self._expire_at(),
+                }},
+                {'$set': {
+                    'next_free': {'$cond': [
+                        is_reserved, {'$add': [{'$max': [next_free, '$slot']}, 1 / rate]}, next_free
+                    ]},
+                }},
+            ],
+            projection={'slot': True},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+
+        return bucket['slot'] - now
+
+    def block(self, key: str, *, until: float):
+        db_module.db.rate_limits.update_one(
+            {'_id': key},
+            {'$max': {'blocked_until': until}, '$set': {'expire_at': self._expire_at()}},
+            upsert=True,
+        )
+
+
+class RateLimiter:
+    """
+    Global per-bot and per-chat buckets.
+        Waits for a slot up to `max_wait` seconds and raises `RetryLater` if it's not enough.
+    """
+    def __init__(
+            self,
+            store: BaseRateLimitStore,
+            *,
+            bot_rate: float=TG_BOT_RATE_LIMIT,
+            bot_burst: float=TG_BOT_RATE_BURST,
+            chat_rate: float=TG_CHAT_RATE_LIMIT,
+            chat_burst: float=TG_CHAT_RATE_BURST,
+            max_wait: float=TG_RATE_LIMIT_MAX_WAIT,
+    ):
+        self._store = store
+        self._bot_rate = bot_rate
+        self._bot_burst = bot_burst
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._max_wait = max_wait
+
+    @staticmethod
+    def build_bot_key(token: str) -> str:
+        # Never keep bot tokens in db.
+        return 'bot:' + sha1(token.encode()).hexdigest()[:16]
+
+    def _reserve(self, key: str, *, rate: float, capacity: float, at: float, deadline: float) -> float:
+        """
+        Returns the moment of the slot reserved no earlier than `at`.
+        """
+        wait = self._store.reserve(key, rate=rate, capacity=capacity, now=at, max_wait=deadline - at)
+        if at + wait > deadline:
+            raise RetryLater(at + wait - time.time(), is_failure=False)
+
+        return at + wait
+
+    def acquire(self, bot_key: str, chat_id: Optional[Union[str, int]]=None):
+        now = time.time()
+        deadline = now + self._max_wait
+
+        # The bot bucket is the one all the workers contend for. It goes first, so a chat slot is not taken
+        #   for a call which can't be made anyway.
+        slot = self._reserve(bot_key, rate=self._bot_rate, capacity=self._bot_burst, at=now, deadline=deadline)
+
+        if chat_id is not None:
+            slot = self._reserve(
+                f'chat:{bot_key}:{chat_id}',
+                rate=self._chat_rate,
+                capacity=self._chat_burst,
+                at=slot,
+                deadline=deadline,
+            )
+
+        if slot > now:
+            time.sleep(slot - now)
+
+    def penalize(self, bot_key: str, retry_after: float):
+        logger.warning('Bot API asked to retry after %s s.', retry_after)
+        self._store.block(bot_key, until=time.time() + retry_after)
+
+
+_rate_limiter = None
+
+
+def get_rate_limiter() -> RateLimiter:
+    global _rate_limiter
+    if _rate_limiter is None:
+        if STAGE in ('live', 'staging'):
+            _rate_limiter = RateLimiter(MongoRateLimitStore())
+        else:
+            _rate_limiter = RateLimiter(LocalRateLimitStore())
+
+    return _rate_limiter
@@ -0,0 +1,43 @@
+"""
+Retries of messages which failed to be sent for a transient reason.
+"""
+import random
+from typing import Optional
+
+from rest_food.settings import SEND_RETRY_MAX_ATTEMPTS, SEND_RETRY_BASE_SECONDS, SEND_RETRY_MAX_SECONDS
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with jitter, so that messages failed at once are not retried at once again.
+    """
+    def __init__(
+            self,
+            *,
+            max_attempts: int=SEND_RETRY_MAX_ATTEMPTS,
+            base_delay: float=SEND_RETRY_BASE_SECONDS,
+            max_delay: float=SEND_RETRY_MAX_SECONDS,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def get_delay(self, failures: int, *, retry_after: float=0) -> Optional[float]:
+        """
+        Parameters
+        ----------
+        failures
+            Number of failed attempts so far, 0 if the message was only postponed by the local rate limiter.
+        retry_after
+            Time requested by Telegram or the rate limiter. It's never retried earlier.
+
+        Returns
+        -------
+        Seconds to wait before the next attempt, None if the message should not be retried anymore.
+
+        """
+        if failures >= self.max_attempts:
+            return None
+
+        backoff = min(self.base_delay * 2 ** max(failures - 1, 0), self.max_delay)
+        return retry_after + random.uniform(backoff / 2, backoff)
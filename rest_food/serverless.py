@@ -1,8 +1,12 @@
 import json
 import logging
 
+from rest_food import communication
+from rest_food.enums import SendQueue
 from rest_food.message_queue import get_mass_queue, get_single_queue
 from rest_food.handlers import tg_supply, tg_demand
+from rest_food.settings import DIGEST_WINDOW_SECONDS
+from rest_food.translation import LazyAwareJsonEncoder
 
 
 logger = logging.getLogger(__name__)
@@ -12,7 +16,7 @@ def json_response(data: dict) -> dict:
     return {
         'statusCode': 200,
         'headers': {},
-        'body': json.dumps(data, ensure_ascii=False, indent=2),
+        'body': json.dumps(data, ensure_ascii=False, indent=2, cls=LazyAwareJsonEncoder),
     }
 
 
@@ -32,22 +36,61 @@ def demand(event, context):
 
 def send_mass_messages(event, context):
     logger.info(event)
-    for record in event['Records']:
-        try:
-            get_mass_queue().process(record['body'])
-        except Exception:
-            logger.exception('Send message event was processed with unexpected exception.')
+    try:
+        get_mass_queue().process_many(record['body'] for record in event['Records'])
+    except Exception:
+        logger.exception('Send message event was processed with unexpected exception.')
 
 
 def super_send_mass_messages(event, context):
     logger.info(event)
     for record in event['Records']:
+        data = get_mass_queue().loads(record['body'])
+
+        if get_mass_queue().is_fanout_step(data):
+            # Exceptions are not caught, so that SQS redelivers the step. It resumes from the last checkpoint.
+            get_mass_queue().advance_fanout(data['fanout_id'], data['last_user_id'])
+            continue
+
         try:
-            get_mass_queue().redestrib_super_batch(json.loads(record['body']))
+            get_mass_queue().redestrib_super_batch(data)
         except Exception:
             logger.exception('Send message event was processed with unexpected exception.')
 
 
+def advance_fanouts(event, context):
+    """
+    Delayed fan-out steps (see `FANOUT_DELIVERY_WINDOW_SECONDS`).
+    """
+    logger.info(event)
+    for record in event['Records']:
+        data = json.loads(record['body'])
+        # Exceptions are not caught, so that SQS redelivers the step.
+        get_mass_queue().advance_fanout(data['fanout_id'], data['last_user_id'])
+
+
+def send_retries(event, context):
+    """
+    Messages postponed for a second or more (see `SEND_RETRY_BASE_SECONDS`).
+    """
+    logger.info(event)
+    for record in event['Records']:
+        data = json.loads(record['body'])
+        if SendQueue(data['queue']) == SendQueue.MASS:
+            get_mass_queue().process(data['payload'])
+        else:
+            get_single_queue().process(data['payload'])
+
+
+def resume_fanouts(event, context):
+    get_mass_queue().resume_stale_fanouts()
+
+
+def flush_digests(event, context):
+    if DIGEST_WINDOW_SECONDS:
+        communication.flush_digests()
+
+
 def send_single_message(event, context):
     logger.info(event)
     for record in event['Records']:
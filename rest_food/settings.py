@@ -37,4 +37,93 @@ STAGE = env_var('STAGE')
 TEST_TG_CHAT_ID = env_var('TEST_TG_CHAT_ID', '').split(',')
 TEST_TG_CHAT_ID.extend([int(x) for x in TEST_TG_CHAT_ID if x])
 
+# Bot API server, e.g. a local stand-in for load tests. python-telegram-bot default is used if empty.
+TELEGRAM_API_URL = env_var('TELEGRAM_API_URL', None) or None
+# Bot API calls to chats other than TEST_TG_CHAT_ID are simulated by `FakeBot` (always on dev).
+FAKE_BOT = STAGE == 'dev' or env_var('FAKE_BOT', '').lower() in ('1', 'true')
+# Median and spread (sigma of log-normal distribution, 0 for a constant) of simulated call latency, s.
+FAKE_BOT_LATENCY = float(env_var('FAKE_BOT_LATENCY', 0.2))
+FAKE_BOT_LATENCY_SIGMA = float(env_var('FAKE_BOT_LATENCY_SIGMA', 0))
+# Ratios of simulated errors: calls answered with 429, chats which blocked the bot or are not found
+#   (the same chats every time) and calls timed out.
+FAKE_BOT_TOO_MANY_REQUESTS_RATIO = float(env_var('FAKE_BOT_TOO_MANY_REQUESTS_RATIO', 0))
+FAKE_BOT_RETRY_AFTER = int(env_var('FAKE_BOT_RETRY_AFTER', 5))
+FAKE_BOT_FORBIDDEN_RATIO = float(env_var('FAKE_BOT_FORBIDDEN_RATIO', 0))
+FAKE_BOT_CHAT_NOT_FOUND_RATIO = float(env_var('FAKE_BOT_CHAT_NOT_FOUND_RATIO', 0))
+FAKE_BOT_TIMEOUT_RATIO = float(env_var('FAKE_BOT_TIMEOUT_RATIO', 0))
+
+# Number of Bot API calls a single worker makes in parallel.
+TG_SEND_CONCURRENCY = int(env_var('TG_SEND_CONCURRENCY', 10))
+
+# Bot API calls per second for a whole bot and for a single chat.
+TG_BOT_RATE_LIMIT = float(env_var('TG_BOT_RATE_LIMIT', 30))
+TG_BOT_RATE_BURST = float(env_var('TG_BOT_RATE_BURST', 30))
+TG_CHAT_RATE_LIMIT = float(env_var('TG_CHAT_RATE_LIMIT', 1))
+TG_CHAT_RATE_BURST = float(env_var('TG_CHAT_RATE_BURST', 3))
+# Seconds to wait for the rate limiter before the message is queued again.
+TG_RATE_LIMIT_MAX_WAIT = float(env_var('TG_RATE_LIMIT_MAX_WAIT', 5))
+
+# Messages failed for a transient reason (429, timeout, network error) are retried with exponential backoff
+#   from SEND_RETRY_BASE_SECONDS up to SEND_RETRY_MAX_SECONDS. Then they are kept in `dead_letters`.
+SEND_RETRY_MAX_ATTEMPTS = int(env_var('SEND_RETRY_MAX_ATTEMPTS', 5))
+SEND_RETRY_BASE_SECONDS = float(env_var('SEND_RETRY_BASE_SECONDS', 2))
+SEND_RETRY_MAX_SECONDS = float(env_var('SEND_RETRY_MAX_SECONDS', 300))
+
+# Replies which take a single Bot API call are returned in the webhook response instead of being queued.
+TG_INLINE_RESPONSE = env_var('TG_INLINE_RESPONSE', '').lower() in ('1', 'true')
+
+# Number of recipients a fan-out worker queues between two checkpoints.
+FANOUT_STEP_SIZE = int(env_var('FANOUT_STEP_SIZE', 2000))
+# A fan-out step is locked for this time. It has to be longer than a worker (lambda) timeout.
+FANOUT_LEASE_SECONDS = int(env_var('FANOUT_LEASE_SECONDS', 60))
+# Unfinished fan-outs which were not advanced for this time are resumed by `resume_fanouts`.
+FANOUT_RESUME_AFTER_SECONDS = int(env_var('FANOUT_RESUME_AFTER_SECONDS', 120))
+# A fan-out is spread over this time: steps are delayed to keep the pace. 0 to send as fast as possible.
+FANOUT_DELIVERY_WINDOW_SECONDS = int(env_var('FANOUT_DELIVERY_WINDOW_SECONDS', 0))
+
+# `last_seen` of a user is written at most this often.
+LAST_SEEN_UPDATE_SECONDS = int(env_var('LAST_SEEN_UPDATE_SECONDS', 60 * 60))
+# Demand users who were not seen for this time are dormant. 0 to treat everyone as active.
+DORMANT_AFTER_DAYS = int(env_var('DORMANT_AFTER_DAYS', 0))
+# include, exclude or last. See `DormantAudience`.
+DORMANT_AUDIENCE = env_var('DORMANT_AUDIENCE', 'last')
+
+# Max number of offers a demand user gets per NOTIFICATION_CAP_PERIOD_SECONDS. 0 for no limit.
+NOTIFICATION_CAP = int(env_var('NOTIFICATION_CAP', 0))
+NOTIFICATION_CAP_PERIOD_SECONDS = int(env_var('NOTIFICATION_CAP_PERIOD_SECONDS', 24 * 60 * 60))
+
+# Fan-out deliveries are remembered for this time to drop duplicates.
+DELIVERY_LEDGER_TTL_HOURS = int(env_var('DELIVERY_LEDGER_TTL_HOURS', 48))
+# Deliveries which were claimed but not sent, e.g. because the sender crashed, can be claimed again after this time.
+#   Should be longer than a batch takes to send (lambda timeout), but shorter than SQS visibility timeout.
+DELIVERY_CLAIM_TIMEOUT_SECONDS = int(env_var('DELIVERY_CLAIM_TIMEOUT_SECONDS', 60))
+
+# Digest mode: offers of a location published within this time are sent as a single message. 0 to disable.
+DIGEST_WINDOW_SECONDS = int(env_var('DIGEST_WINDOW_SECONDS', 0))
+# Max number of offers in a single digest message.
+DIGEST_MAX_OFFERS = int(env_var('DIGEST_MAX_OFFERS', 5))
+
+# common, fanout or location. See `SuperBatchGrouping`.
+SUPER_BATCH_GROUPING = env_var('SUPER_BATCH_GROUPING', 'fanout')
+# Super-batches of a group are spread over this number of shards in round-robin to be processed in parallel.
+SUPER_BATCH_GROUP_SHARDS = int(env_var('SUPER_BATCH_GROUP_SHARDS', 1))
+
+# Producers pack as many recipients into a super-batch as fit both limits. SQS message limit is 256 KB.
+SUPER_BATCH_MAX_RECIPIENTS = int(env_var('SUPER_BATCH_MAX_RECIPIENTS', 2000))
+SUPER_BATCH_MAX_BYTES = int(env_var('SUPER_BATCH_MAX_BYTES', 250000))
+# zlib + base64 super-batches.
+SUPER_BATCH_COMPRESSION = env_var('SUPER_BATCH_COMPRESSION', '').lower() in ('1', 'true')
+
+# Senders recheck that an offer is still published (not booked or deactivated) at most this often.
+OFFER_STATE_CACHE_SECONDS = float(env_var('OFFER_STATE_CACHE_SECONDS', 5))
+
+# Local (dev) queue workers: processes, threads per process and size of every lane.
+LOCAL_QUEUE_PROCESSES = int(env_var('LOCAL_QUEUE_PROCESSES', 1))
+LOCAL_QUEUE_THREADS = int(env_var('LOCAL_QUEUE_THREADS', 10))
+LOCAL_QUEUE_MAX_SIZE = int(env_var('LOCAL_QUEUE_MAX_SIZE', 1000))
+# Seconds a producer waits for a full lane before it handles the message itself.
+LOCAL_QUEUE_PUT_TIMEOUT = float(env_var('LOCAL_QUEUE_PUT_TIMEOUT', 1))
+# Seconds to let workers finish queued messages on shutdown.
+LOCAL_QUEUE_DRAIN_TIMEOUT = float(env_var('LOCAL_QUEUE_DRAIN_TIMEOUT', 30))
+
 FEEDBACK_TG_BOT = '@foodsharingsupport_bot'
\ No newline at end of file
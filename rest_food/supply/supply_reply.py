@@ -1,8 +1,11 @@
-from rest_food.entities import User, Reply
+from typing import List
+
+from rest_food.entities import User, Reply, Fanout
 from rest_food.enums import SupplyCommand
 from rest_food.common.formatters import (
     build_demanded_message_text,
     build_new_supplier_notification_text,
+    build_fanout_report_text,
 )
 from rest_food.translation import translate_lazy as _
 
@@ -39,4 +42,11 @@ def build_new_supplier_notification(supply_user: User) -> Reply:
             'text': _('Decline'),
             'data': SupplyCommand.DECLINE_SUPPLIER.build(supply_user.id),
         }]]
-    )
\ No newline at end of file
+    )
+
+
+def build_fanout_reports(fanouts: List[Fanout]) -> Reply:
+    if not fanouts:
+        return Reply(text=_('Nothing was published recently.'))
+
+    return Reply(text='\n\n'.join(build_fanout_report_text(x) for x in fanouts))
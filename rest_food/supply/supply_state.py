@@ -186,8 +186,9 @@ class SetMessageTimeState(State):
 
             message_id = self.db_user.editing_message_id
             set_message_time(message_id, text)
-            publish_supply_event(self.db_user)
+            # Mass senders skip offers which are not published.
             set_message_publication_time(message_id)
+            publish_supply_event(self.db_user)
             return Reply(
                 text=_(
                     "Information is sent. "
@@ -1,9 +1,11 @@
 from typing import Optional
 
 from rest_food.common.shared_commands import choose_language, handle_delete
+from rest_food.db import list_fanouts
 from rest_food.enums import SupplyTgCommand, SupplyState, Provider, SupplyCommand
 from rest_food.entities import User, Reply
 from rest_food.state_machine import set_supply_state
+from rest_food.supply.supply_reply import build_fanout_reports
 from rest_food.supply.supply_state import DefaultState, ForceInfoMixin
 from rest_food.translation import translate_lazy as _
 
@@ -45,3 +47,9 @@ def handle_supply_tg_command(user: User, command: SupplyTgCommand) -> Optional[R
         reply = handle_delete(user)
         reply.next_state = SupplyState.NO_STATE
         return reply
+
+    if command == SupplyTgCommand.REPORT:
+        # Admins see all the latest publications including digests.
+        reply = build_fanout_reports(list_fanouts(owner_id=None if user.is_admin else user.id))
+        reply.next_state = SupplyState.NO_STATE
+        return reply
@@ -33,6 +33,17 @@ def set_language(lang_code: str):
         logger.info('Language is not supported', extra={'language': lang_code})
 
 
+def get_language_code(lang_code: str) -> str:
+    """
+    Language which `set_language(lang_code)` would end up with for a default context.
+    """
+    lang_code = (lang_code or '')[:2]
+    if lang_code in LANGUAGES_SUPPORTED:
+        return lang_code
+
+    return DEFAULT_LANGUAGE
+
+
 def get_translation(language_code: str):
     if language_code not in _translations:
         if language_code not in LANGUAGES_SUPPORTED:
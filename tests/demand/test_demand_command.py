@@ -0,0 +1,63 @@
+import datetime
+from unittest.mock import patch
+
+from bson import ObjectId
+
+from rest_food.demand.demand_command import handle_demand_data
+from rest_food.entities import User, Message, Digest
+from rest_food.enums import Provider, Workflow, UserInfoField, DigestState, MessageState
+from rest_food.translation import switch_language
+
+
+def _build_offer(user_id, name):
+    supply_user = User(
+        _id=ObjectId(),
+        user_id=user_id,
+        chat_id=int(user_id),
+        provider=Provider.TG,
+        workflow=Workflow.SUPPLY,
+        info={
+            UserInfoField.NAME.value: name,
+            UserInfoField.ADDRESS.value: 'Main st, 1',
+            UserInfoField.LOCATION.value: 'by:minsk',
+        },
+    )
+    message = Message(
+        message_id=ObjectId(), owner_id=supply_user.id, products=['Soup'], state=MessageState.PUBLISHED
+    )
+    return supply_user, message
+
+
+def test_digest_info__back_to_digest():
+    offers = [_build_offer('1', 'Cafe'), _build_offer('2', 'Bakery'), _build_offer('3', 'Shop')]
+    users = {x.id: x for x, _ in offers}
+    messages = {str(x.message_id): x for _, x in offers}
+    digest = Digest(
+        digest_id=ObjectId(),
+        location='by:minsk',
+        offers=[{'message_id': str(message.message_id), 'owner_id': user.id} for user, message in offers],
+        state=DigestState.DONE,
+        flush_at=datetime.datetime.utcnow(),
+        chunks=[[0, 2]],
+    )
+    demand_user = User(_id=ObjectId(), user_id='7', chat_id=7, provider=Provider.TG, workflow=Workflow.DEMAND)
+
+    def get_message(message_id):
+        return messages[message_id]
+
+    with switch_language('en'), \
+            patch('rest_food.demand.demand_reply.get_digest', return_value=digest), \
+            patch('rest_food.demand.demand_reply.get_user_by_id', side_effect=users.get), \
+            patch('rest_food.demand.demand_reply.get_supply_message_record_by_id', side_effect=get_message), \
+            patch('rest_food.demand.demand_command.get_supply_message_record_by_id', side_effect=get_message), \
+            patch('rest_food.demand.demand_command.get_user', return_value=offers[2][0]), \
+            patch('rest_food.demand.demand_command.set_next_command'):
+        info = handle_demand_data(demand_user, f'dgsti|{digest.digest_id}|0|2')
+        info_buttons = {str(x['text']): x['data'] for row in info.buttons for x in row}
+        back = handle_demand_data(demand_user, info_buttons['Back'])
+        back_text = str(back.text)
+
+    assert 'Shop' in str(info.text)
+    assert info_buttons['Take it'] == f'dgstt|{digest.digest_id}|0|2'
+    assert back_text.startswith('1. Cafe') and '2. Shop' in back_text and 'Bakery' not in back_text
+    assert back.buttons[1][1]['data'] == f'dgsti|{digest.digest_id}|0|2'
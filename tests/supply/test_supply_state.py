@@ -0,0 +1,47 @@
+from unittest.mock import patch, MagicMock
+
+from bson import ObjectId
+
+from rest_food.entities import User
+from rest_food.enums import Provider, Workflow, UserInfoField
+from rest_food.message_queue import OfferStateCache
+from rest_food.supply.supply_state import SetMessageTimeState
+
+
+def _build_messages_collection(records):
+    def update_one(find, update):
+        records[find['_id']].update(update['$set'])
+
+    def find(query, projection=None):
+        return [dict(records[x], _id=x) for x in query['_id']['$in'] if x in records]
+
+    collection = MagicMock()
+    collection.update_one.side_effect = update_one
+    collection.find.side_effect = find
+    return collection
+
+
+def test_set_message_time__published_before_fanout():
+    message_id = ObjectId()
+    supply_user = User(
+        _id=ObjectId(),
+        user_id='42',
+        chat_id=42,
+        provider=Provider.TG,
+        workflow=Workflow.SUPPLY,
+        editing_message_id=str(message_id),
+        info={UserInfoField.IS_APPROVED_SUPPLY.value: True, UserInfoField.LOCATION.value: 'by:minsk'},
+    )
+    stale = []
+
+    def publish_supply_event(user):
+        # A fast worker checks the offer state as soon as the fan-out is started.
+        stale.extend(OfferStateCache(ttl=5).get_stale([user.editing_message_id]))
+
+    with patch('rest_food.db.db') as db, \
+            patch('rest_food.supply.supply_state.publish_supply_event', side_effect=publish_supply_event) as p:
+        db.messages = _build_messages_collection({message_id: {}})
+        SetMessageTimeState(supply_user).handle('18:00', None)
+
+    assert p.call_count == 1
+    assert stale == []
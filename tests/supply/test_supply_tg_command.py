@@ -0,0 +1,79 @@
+import datetime
+from unittest.mock import patch
+
+from bson import ObjectId
+
+from rest_food.entities import User, Fanout
+from rest_food.enums import Provider, Workflow, FanoutState, SupplyTgCommand
+from rest_food.supply.supply_tg_command import handle_supply_tg_command
+from rest_food.translation import switch_language
+
+
+def _build_supply_user(is_admin=False):
+    return User(
+        _id=ObjectId(),
+        user_id='42',
+        chat_id=42,
+        provider=Provider.TG,
+        workflow=Workflow.SUPPLY,
+        info={},
+        is_admin=is_admin,
+    )
+
+
+def test_report_command():
+    supply_user = _build_supply_user()
+    created_at = datetime.datetime(2020, 1, 1, 12)
+    fanout = Fanout(
+        fanout_id=ObjectId(),
+        message_id=str(ObjectId()),
+        owner_id=supply_user.id,
+        location='by:minsk',
+        workflow=Workflow.DEMAND,
+        state=FanoutState.DONE,
+        enqueued=100,
+        audience_size=100,
+        counters={'delivered': 90, 'blocked': 5, 'failed': 1, 'stale': 3, 'duplicate': 1},
+        created_at=created_at,
+        first_delivery_at=created_at + datetime.timedelta(seconds=2),
+        last_delivery_at=created_at + datetime.timedelta(seconds=40),
+    )
+
+    with patch('rest_food.supply.supply_tg_command.list_fanouts', return_value=[fanout]) as list_fanouts, \
+            patch('rest_food.supply.supply_tg_command.set_supply_state'), \
+            switch_language('en'):
+        reply = handle_supply_tg_command(supply_user, SupplyTgCommand.REPORT)
+
+    list_fanouts.assert_called_once_with(owner_id=supply_user.id)
+    assert 'Delivered: 90' in reply.text
+    assert 'Skipped: 4' in reply.text
+    assert 'First delivery in 2 s, last in 40 s' in reply.text
+
+
+def test_report_command__admin():
+    with patch('rest_food.supply.supply_tg_command.list_fanouts', return_value=[]) as list_fanouts, \
+            patch('rest_food.supply.supply_tg_command.set_supply_state'), \
+            switch_language('en'):
+        text = str(handle_supply_tg_command(_build_supply_user(is_admin=True), SupplyTgCommand.REPORT).text)
+
+    list_fanouts.assert_called_once_with(owner_id=None)
+    assert text == 'Nothing was published recently.'
+
+
+def test_report_command__translated():
+    fanout = Fanout(
+        fanout_id=ObjectId(),
+        message_id=str(ObjectId()),
+        owner_id=ObjectId(),
+        location='by:minsk',
+        workflow=Workflow.DEMAND,
+        state=FanoutState.RUNNING,
+    )
+
+    with patch('rest_food.supply.supply_tg_command.list_fanouts', return_value=[fanout]), \
+            patch('rest_food.supply.supply_tg_command.set_supply_state'), \
+            switch_language('be'):
+        text = str(handle_supply_tg_command(_build_supply_user(), SupplyTgCommand.REPORT).text)
+
+    assert 'Час публікацыі невядомы' in text
+    assert 'Дастаўлена: 0' in text
@@ -0,0 +1,171 @@
+import datetime
+from unittest.mock import patch, MagicMock
+
+from bson import ObjectId
+
+from rest_food.communication import publish_supply_event, flush_digests, replay_dead_letters
+from rest_food.entities import User, Message, Digest, DeadLetter
+from rest_food.enums import Provider, Workflow, UserInfoField, MessageState, DigestState, SendQueue
+from rest_food.translation import LANGUAGES_SUPPORTED
+
+
+def _build_supply_user(message_id):
+    return User(
+        _id=ObjectId(),
+        user_id='42',
+        chat_id=42,
+        provider=Provider.TG,
+        workflow=Workflow.SUPPLY,
+        editing_message_id=message_id,
+        info={
+            UserInfoField.NAME.value: 'Cafe',
+            UserInfoField.LOCATION.value: 'by:minsk',
+        },
+    )
+
+
+def test_publish_supply_event__reads_message_once():
+    message_id = ObjectId()
+    db = MagicMock()
+    db.messages.find_one.side_effect = lambda *args, **kwargs: {
+        '_id': message_id,
+        'owner_id': 'owner',
+        'products': ['Soup'],
+        'take_time': '18:00',
+    }
+    queue = MagicMock()
+    supply_user = _build_supply_user(str(message_id))
+
+    with patch('rest_food.db.db', db), patch('rest_food.communication.get_mass_queue', return_value=queue):
+        publish_supply_event(supply_user)
+
+    assert db.messages.find_one.call_count == 1
+    assert db.users.find.call_count == 0
+
+    kwargs = queue.start_fanout.call_args[1]
+    assert kwargs['message_id'] == str(message_id)
+    assert kwargs['owner_id'] == supply_user.id
+    assert kwargs['location'] == 'by:minsk'
+    assert sorted(kwargs['templates']) == sorted(LANGUAGES_SUPPORTED)
+    assert len({x.text for x in kwargs['templates'].values()}) == len(LANGUAGES_SUPPORTED)
+
+
+def _build_offer(message_id, name):
+    supply_user = _build_supply_user(str(message_id))
+    supply_user.info[UserInfoField.NAME.value] = name
+    message = Message(message_id=message_id, owner_id=supply_user.id, products=['Soup'], take_time='18:00')
+    return supply_user, message
+
+
+def test_publish_supply_event__digest_mode():
+    supply_user = _build_supply_user(str(ObjectId()))
+    queue = MagicMock()
+    digest = Digest(
+        digest_id=ObjectId(),
+        location='by:minsk',
+        offers=[{'message_id': supply_user.editing_message_id, 'owner_id': supply_user.id}],
+        state=DigestState.OPEN,
+        flush_at=datetime.datetime.utcnow() + datetime.timedelta(seconds=60),
+    )
+
+    with patch('rest_food.communication.DIGEST_WINDOW_SECONDS', 60), \
+            patch('rest_food.communication.add_to_digest', return_value=digest) as add_to_digest, \
+            patch('rest_food.communication.get_mass_queue', return_value=queue):
+        publish_supply_event(supply_user)
+
+    assert add_to_digest.call_args[1]['location'] == 'by:minsk'
+    assert queue.start_fanout.call_count == 0
+    assert 55 < queue.schedule_digest_flush.call_args[1]['delay'] <= 60
+
+
+def test_flush_digests():
+    offers = [_build_offer(ObjectId(), name) for name in ('Cafe', 'Bakery', 'Shop')]
+    users = {x.id: x for x, _ in offers}
+    messages = {str(x.message_id): x for _, x in offers}
+    digest = Digest(
+        digest_id=ObjectId(),
+        location='by:minsk',
+        offers=[{'message_id': str(message.message_id), 'owner_id': user.id} for user, message in offers],
+        state=DigestState.FLUSHING,
+        flush_at=datetime.datetime.utcnow(),
+    )
+    queue = MagicMock()
+    booked_id = str(offers[2][1].message_id)
+
+    with patch('rest_food.communication.claim_due_digest', side_effect=[digest, None]), \
+            patch('rest_food.communication.get_message_states', return_value={
+                **{x: MessageState.PUBLISHED for x in messages}, booked_id: MessageState.BOOKED,
+            }), \
+            patch('rest_food.communication.get_user_by_id', side_effect=users.get), \
+            patch('rest_food.communication.get_supply_message_record_by_id', side_effect=lambda message_id: messages[message_id]), \
+            patch('rest_food.communication.set_digest_chunks') as set_digest_chunks, \
+            patch('rest_food.communication.finish_digest') as finish_digest, \
+            patch('rest_food.communication.get_mass_queue', return_value=queue):
+        assert flush_digests() == 1
+
+    kwargs = queue.start_fanout.call_args[1]
+    assert queue.start_fanout.call_count == 1
+    assert kwargs['message_id'] is None
+    reply = kwargs['templates']['en']
+    assert reply.text.startswith('1. Cafe') and '2. Bakery' in reply.text and 'Shop' not in reply.text
+    assert [[x['data'] for x in row] for row in reply.buttons] == [
+        [f'dgstt|{digest.digest_id}|0|1', f'dgsti|{digest.digest_id}|0|1'],
+        [f'dgstt|{digest.digest_id}|0|2', f'dgsti|{digest.digest_id}|0|2'],
+    ]
+    set_digest_chunks.assert_called_once_with(digest.digest_id, [[0, 1]])
+    finish_digest.assert_called_once_with(digest.digest_id)
+
+
+
+def test_replay_dead_letters():
+    letters = [
+        DeadLetter(
+            dead_letter_id=ObjectId(),
+            queue=SendQueue.SINGLE,
+            payload='{"tg_chat_id": 42}',
+            error='TimedOut()',
+            created_at=datetime.datetime.utcnow(),
+        ),
+        DeadLetter(
+            dead_letter_id=ObjectId(),
+            queue=SendQueue.MASS,
+            payload='{"messages": []}',
+            error='TimedOut()',
+            created_at=datetime.datetime.utcnow(),
+        ),
+    ]
+    mass_queue, single_queue = MagicMock(), MagicMock()
+
+    with patch('rest_food.communication.get_dead_letters', side_effect=[letters, []]) as get_dead_letters, \
+            patch('rest_food.communication.delete_dead_letters') as delete_dead_letters, \
+            patch('rest_food.communication.get_mass_queue', return_value=mass_queue), \
+            patch('rest_food.communication.get_single_queue', return_value=single_queue):
+        assert replay_dead_letters() == 2
+
+    single_queue.requeue.assert_called_once_with('{"tg_chat_id": 42}', tg_chat_id=42, delay=0)
+    mass_queue.requeue.assert_called_once_with('{"messages": []}', delay=0)
+    assert [x[0][0] for x in delete_dead_letters.call_args_list] == [[x.dead_letter_id] for x in letters]
+    # Letters failed again while replaying are left for later.
+    assert len({x[1]['created_before'] for x in get_dead_letters.call_args_list}) == 1
+    assert get_dead_letters.call_args[1]['after_id'] == letters[-1].dead_letter_id
+
+
+def test_replay_dead_letters__malformed():
+    letters = [
+        DeadLetter(
+            dead_letter_id=ObjectId(),
+            queue=SendQueue.SINGLE,
+            payload=payload,
+            error='JSONDecodeError()',
+            created_at=datetime.datetime.utcnow(),
+        ) for payload in ('not a json', '{"tg_chat_id": 42}', '"a string"')
+    ]
+    single_queue = MagicMock()
+
+    with patch('rest_food.communication.get_dead_letters', side_effect=[letters, []]), \
+            patch('rest_food.communication.delete_dead_letters') as delete_dead_letters, \
+            patch('rest_food.communication.get_single_queue', return_value=single_queue):
+        assert replay_dead_letters() == 1
+
+    single_queue.requeue.assert_called_once_with('{"tg_chat_id": 42}', tg_chat_id=42, delay=0)
+    delete_dead_letters.assert_called_once_with([letters[1].dead_letter_id])
@@ -0,0 +1,224 @@
+import datetime
+from unittest.mock import patch, MagicMock
+
+import pytest
+from bson import ObjectId
+
+from pymongo.errors import BulkWriteError
+
+from rest_food.db import (
+    _sync_audience,
+    set_info,
+    set_inactive,
+    set_inactive_many,
+    count_fanout_deliveries,
+    take_notification_quota,
+    claim_deliveries,
+    get_or_create_user,
+    iter_demand_audience,
+)
+from rest_food.entities import User
+from rest_food.enums import Workflow, Provider, UserInfoField
+
+
+def _build_record(**kwargs):
+    record = {
+        '_id': ObjectId(),
+        'user_id': '1',
+        'chat_id': 1,
+        'workflow': Workflow.DEMAND.value,
+        'provider': Provider.TG.value,
+        'is_active': True,
+        'info': {'location': 'by:minsk', 'language': 'ru'},
+    }
+    record.update(kwargs)
+    return record
+
+
+@pytest.fixture
+def db():
+    db = MagicMock()
+    with patch('rest_food.db.db', db):
+        yield db
+
+
+def test_sync_audience__active(db):
+    last_seen = datetime.datetime(2020, 1, 1)
+    record = _build_record(last_seen=last_seen)
+
+    _sync_audience(record)
+
+    db.audience.replace_one.assert_called_once_with(
+        {'_id': record['_id']},
+        {'location': 'by:minsk', 'chat_id': 1, 'provider': 'telegram', 'language': 'ru', 'last_seen': last_seen},
+        upsert=True,
+    )
+
+
+@pytest.mark.parametrize('record', [
+    _build_record(is_active=False),
+    _build_record(info={'language': 'ru'}),
+    _build_record(info={'location': ''}),
+])
+def test_sync_audience__removed(db, record):
+    _sync_audience(record)
+
+    db.audience.delete_one.assert_called_once_with({'_id': record['_id']})
+    assert db.audience.replace_one.call_count == 0
+
+
+def test_sync_audience__supply(db):
+    _sync_audience(_build_record(workflow=Workflow.SUPPLY.value))
+
+    assert db.audience.method_calls == []
+
+
+def test_set_info__location(db):
+    record = _build_record()
+    db.users.find_one_and_update.return_value = dict(record)
+    user = User.from_dict(_build_record())
+
+    set_info(user, UserInfoField.LOCATION, 'by:minsk')
+
+    assert db.audience.replace_one.call_count == 1
+
+
+def test_set_info__other_field(db):
+    db.users.find_one_and_update.return_value = _build_record()
+    user = User.from_dict(_build_record())
+
+    set_info(user, UserInfoField.PHONE, '1234567')
+
+    assert db.audience.method_calls == []
+
+
+def test_set_inactive(db):
+    set_inactive(chat_id=1, provider=Provider.TG, workflow=Workflow.DEMAND)
+
+    db.audience.delete_one.assert_called_once_with({'chat_id': 1, 'provider': 'telegram'})
+
+
+def test_set_inactive_many(db):
+    set_inactive_many([(1, Workflow.DEMAND), (2, Workflow.SUPPLY), (1, Workflow.DEMAND)], Provider.TG)
+
+    requests, = db.users.bulk_write.call_args[0]
+    assert len(requests) == 2
+    assert db.users.bulk_write.call_args[1] == {'ordered': False}
+    db.audience.delete_many.assert_called_once_with({'chat_id': {'$in': [1]}, 'provider': 'telegram'})
+
+
+def test_set_inactive_many__empty(db):
+    set_inactive_many([], Provider.TG)
+
+    assert db.method_calls == []
+
+
+def test_count_fanout_deliveries(db):
+    fanout_id, other_fanout_id = ObjectId(), ObjectId()
+    first, last = datetime.datetime(2020, 1, 1, 12), datetime.datetime(2020, 1, 1, 13)
+
+    count_fanout_deliveries(
+        {fanout_id: {'delivered': 2, 'failed': 0}, other_fanout_id: {'stale': 3}},
+        delivery_times={fanout_id: (first, last)},
+    )
+
+    requests, = db.fanouts.bulk_write.call_args[0]
+    assert {x._filter['_id']: x._doc for x in requests} == {
+        fanout_id: {
+            '$inc': {'counters.delivered': 2},
+            '$min': {'first_delivery_at': first},
+            '$max': {'last_delivery_at': last},
+        },
+        other_fanout_id: {'$inc': {'counters.stale': 3}},
+    }
+
+
+def test_count_fanout_deliveries__nothing_to_count(db):
+    count_fanout_deliveries({ObjectId(): {'failed': 0}})
+
+    assert db.method_calls == []
+
+
+def test_take_notification_quota(db):
+    fresh, counted, capped, outdated, concurrent = [ObjectId() for _ in range(5)]
+    current = int(datetime.datetime.utcnow().timestamp() // 3600)
+    db.notification_counters.find.return_value = [
+        {'_id': counted, 'p': current, 'n': 1},
+        {'_id': capped, 'p': current, 'n': 2},
+        {'_id': outdated, 'p': current - 1, 'n': 2},
+    ]
+    db.notification_counters.insert_many.side_effect = BulkWriteError({
+        'writeErrors': [{'index': 1, 'code': 11000}],
+    })
+
+    allowed = take_notification_quota([fresh, counted, capped, outdated, concurrent], limit=2, period=3600)
+
+    assert allowed == {fresh, counted, outdated, concurrent}
+    assert db.notification_counters.insert_many.call_args[0][0] == [
+        {'_id': fresh, 'p': current, 'n': 1}, {'_id': concurrent, 'p': current, 'n': 1},
+    ]
+    update_filter, pipeline = db.notification_counters.update_many.call_args[0]
+    assert update_filter == {'_id': {'$in': [counted, outdated, concurrent]}}
+    assert pipeline[0]['$set']['p'] == current
+
+
+def test_take_notification_quota__unexpected_error(db):
+    db.notification_counters.find.return_value = []
+    db.notification_counters.insert_many.side_effect = BulkWriteError({
+        'writeErrors': [{'index': 0, 'code': 121}],
+    })
+
+    with pytest.raises(BulkWriteError):
+        take_notification_quota([ObjectId()], limit=2, period=3600)
+
+
+def test_claim_deliveries__expired_pending(db):
+    db.deliveries.insert_many.side_effect = BulkWriteError({
+        'writeErrors': [{'index': 1, 'code': 11000}, {'index': 2, 'code': 11000}, {'index': 3, 'code': 11000}],
+    })
+    # `f:2` and `f:3` were claimed by senders which crashed, `f:3` is claimed again meanwhile.
+    db.deliveries.find.return_value = [{'_id': 'f:2'}, {'_id': 'f:3'}]
+    db.deliveries.update_one.side_effect = lambda find, update: MagicMock(modified_count=int(find['_id'] == 'f:2'))
+
+    assert claim_deliveries(['f:1', 'f:2', 'f:3', 'f:4']) == {'f:1', 'f:2'}
+    assert db.deliveries.find.call_args[0][0]['_id'] == {'$in': ['f:2', 'f:3', 'f:4']}
+
+
+def _get_or_create_demand_user(db, record):
+    # `User.from_dict` changes the record in place.
+    db.users.find_one.side_effect = lambda *args, **kwargs: dict(record)
+    db.users.find_one_and_update.side_effect = lambda find, update, **kwargs: {**record, **update['$set']}
+    return get_or_create_user(
+        user_id=record['user_id'],
+        chat_id=record['chat_id'],
+        provider=Provider.TG,
+        workflow=Workflow.DEMAND,
+        info={'language': 'ru'},
+    )
+
+
+def test_get_or_create_user__last_seen_is_throttled(db):
+    record = _build_record(last_seen=datetime.datetime.utcnow() - datetime.timedelta(minutes=5))
+
+    _get_or_create_demand_user(db, record)
+
+    assert db.users.find_one_and_update.call_count == 0
+
+
+def test_get_or_create_user__last_seen_is_outdated(db):
+    record = _build_record(last_seen=datetime.datetime.utcnow() - datetime.timedelta(days=1))
+
+    user = _get_or_create_demand_user(db, record)
+
+    update, = [x[0][1]['$set'] for x in db.users.find_one_and_update.call_args_list]
+    assert list(update) == ['last_seen']
+    assert (datetime.datetime.utcnow() - user.last_seen).total_seconds() < 5
+    assert db.audience.replace_one.call_args[0][1]['last_seen'] == user.last_seen
+
+
+def test_iter_demand_audience__seen_since(db):
+    seen_since = datetime.datetime(2020, 1, 1)
+
+    list(iter_demand_audience('by:minsk', seen_since=seen_since))
+
+    assert db.audience.find.call_args[0][0] == {'location': 'by:minsk', 'last_seen': {'$not': {'$lt': seen_since}}}
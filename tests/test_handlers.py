@@ -0,0 +1,88 @@
+import json
+from unittest.mock import patch
+
+from telegram import Update
+
+from rest_food.entities import Reply, User
+from rest_food.enums import Workflow, UserInfoField
+from rest_food.handlers import _respond, tg_demand
+from rest_food.message_queue import BaseSingleMessageQueue
+
+
+class InMemorySingleQueue(BaseSingleMessageQueue):
+    def __init__(self):
+        self.items = []
+
+    def _put_serialized_batch(self, items):
+        self.items.extend(items)
+
+
+def _build_update(chat_id=42):
+    return Update.de_json({
+        'update_id': 1,
+        'message': {
+            'message_id': 7,
+            'date': 0,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Ann'},
+            'text': '+375291234567',
+        },
+    }, None)
+
+
+def _respond_buffered(queue, *, queued_before):
+    reply = Reply(text='Saved', buttons=[[{'text': 'Next', 'data': 'c|next'}]])
+
+    with patch('rest_food.communication.get_single_queue', return_value=queue), \
+            patch('rest_food.handlers.TG_INLINE_RESPONSE', True):
+        with queue.buffered():
+            for chat_id, text in queued_before:
+                queue.put(tg_chat_id=chat_id, replies=[Reply(text=text)], workflow=Workflow.DEMAND)
+
+            return _respond(_build_update(), replies=[reply, None], workflow=Workflow.DEMAND)
+
+
+def test_respond__inline():
+    queue = InMemorySingleQueue()
+
+    response = _respond_buffered(queue, queued_before=[(43, 'New supplier')])
+
+    assert response['method'] == 'sendMessage' and response['text'] == 'Saved'
+    assert len(queue.items) == 1
+
+
+def test_respond__queued_before():
+    queue = InMemorySingleQueue()
+
+    # E.g. `SetPhoneState` clears the text keyboard before it replies.
+    response = _respond_buffered(queue, queued_before=[('42', 'OK ✅')])
+
+    assert response is None
+    assert [[x['text'] for x in json.loads(data)['replies']] for _, data in queue.items] == [['OK ✅'], ['Saved']]
+
+
+def test_tg_demand__flush_fails():
+    queue = InMemorySingleQueue()
+    user = User(chat_id=42, workflow=Workflow.DEMAND, info={UserInfoField.LANGUAGE.value: 'en'})
+    update = {
+        'update_id': 1,
+        'callback_query': {
+            'id': '5',
+            'chat_instance': '1',
+            'data': 'take|1',
+            'from': {'id': 42, 'is_bot': False, 'first_name': 'Ann'},
+            'message': {'message_id': 7, 'date': 0, 'chat': {'id': 42, 'type': 'private'}, 'text': 'Soup'},
+        },
+    }
+
+    with patch('rest_food.communication.get_single_queue', return_value=queue), \
+            patch.object(queue, '_put_serialized_batch', side_effect=RuntimeError), \
+            patch('rest_food.handlers.get_or_create_user', return_value=user), \
+            patch('rest_food.handlers.handle_demand_data', return_value=Reply(text='Booked')) as p:
+        response = tg_demand(update)
+
+    # The update is not redelivered by Telegram, so it's handled once.
+    assert p.call_count == 1
+    assert response == {
+        'method': 'sendMessage', 'chat_id': 42, 'text': 'Something went wrong. Try something different, please.'
+    }
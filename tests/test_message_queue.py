@@ -0,0 +1,893 @@
+import datetime
+import json
+import queue
+import threading
+import time
+from collections import OrderedDict
+from hashlib import sha256
+from itertools import islice
+from unittest.mock import patch, MagicMock
+
+import pytest
+
+from bson import ObjectId
+from telegram import Message as TgMessage
+from telegram.error import Unauthorized, TimedOut
+
+from rest_food.entities import Reply, Recipient, Fanout, OriginalMessage
+from rest_food.exceptions import RetryLater
+from rest_food.enums import Workflow, FanoutState, MessageState, SuperBatchGrouping, DormantAudience, SendQueue
+from rest_food.message_queue import (
+    BaseMassMessageQueue, AwsMassMessageQueue, BaseSingleMessageQueue, AwsSingleMessageQueue, LocalWorkerRuntime,
+    LocalMassMessageQueue,
+)
+from rest_food.serverless import super_send_mass_messages
+from rest_food.translation import translate_lazy as _
+
+
+class InMemoryMassQueue(BaseMassMessageQueue):
+    super_batch_size = 100
+    fanout_step_size = 1000
+
+    def __init__(self):
+        self.super_batches = []
+        self.group_ids = []
+        self.fanout_steps = []
+        self.fanout_step_delays = []
+        self.fanout_step_passes = []
+        self.requeued = []
+
+    def put_super_batch_into_queue(self, payload: str, *, group_id: str):
+        self.super_batches.append(payload)
+        self.group_ids.append(group_id)
+
+    def put_fanout_step(self, fanout_id, *, last_user_id, is_dormant_pass=False, delay=0):
+        self.fanout_steps.append((fanout_id, last_user_id))
+        self.fanout_step_delays.append(delay)
+        self.fanout_step_passes.append(is_dormant_pass)
+
+    def requeue(self, payload, *, delay):
+        self.requeued.append((json.loads(payload), delay))
+
+
+class InMemoryAwsMassQueue(AwsMassMessageQueue):
+    def __init__(self):
+        self.items = []
+
+    def put_mass_messages_into_queue(self, items, *, deduplication_ids=None):
+        self.items.append(list(zip(items, deduplication_ids)))
+
+
+def _build_envelope(audience_size):
+    reply = Reply(text='Soup', buttons=[[{'text': _('Take it'), 'data': 'take|1'}]])
+    queue = InMemoryMassQueue()
+    queue.push_super_batch(
+        message_and_user=(
+            (reply, Recipient(chat_id=i, language=('ru', 'be')[i % 2])) for i in range(audience_size)
+        ),
+        workflow=Workflow.DEMAND,
+    )
+    return queue.super_batches
+
+
+def test_push_super_batch__template_per_language():
+    payload, = _build_envelope(100)
+    data = json.loads(payload)
+
+    assert data['workflow'] == 'demand'
+    assert len(data['messages']) == 2
+    assert [x['chat_ids'] for x in data['messages']] == [list(range(0, 100, 2)), list(range(1, 100, 2))]
+    assert data['messages'][0]['reply']['buttons'][0][0]['text'] != data['messages'][1]['reply']['buttons'][0][0]['text']
+    assert payload.count('Soup') == 2
+
+
+@pytest.mark.parametrize('compression', [False, True])
+def test_push_super_batch__fits_max_bytes(compression):
+    queue = InMemoryMassQueue()
+    queue.super_batch_size = 10000
+    queue.super_batch_max_bytes = 2000
+    queue.super_batch_compression = compression
+    replies = [Reply(text='Soup ' * 20), Reply(text='Bread ' * 20)]
+
+    total = queue.push_super_batch(
+        message_and_user=((replies[i % 2], Recipient(chat_id=10**9 + i * 7919)) for i in range(3000)),
+        workflow=Workflow.DEMAND,
+        fanout_id=ObjectId(),
+    )
+
+    assert total == 3000
+    assert all(len(x) <= 2000 for x in queue.super_batches)
+    # Every super-batch is packed close to the limit.
+    assert len(queue.super_batches) < 3000 * 11 / 2000 * 1.5
+    assert sorted(
+        chat_id for x in queue.super_batches for _, chat_id in queue._iter_envelope(queue.loads(x))
+    ) == [10**9 + i * 7919 for i in range(3000)]
+
+
+def test_process__compressed():
+    queue = InMemoryMassQueue()
+    queue.super_batch_compression = True
+    queue.push_super_batch(
+        message_and_user=((Reply(text='Soup'), Recipient(chat_id=i)) for i in range(3)),
+        workflow=Workflow.DEMAND,
+    )
+    payload, = queue.super_batches
+
+    with patch('rest_food.message_queue.send_messages') as p:
+        queue.process(payload)
+
+    assert payload.startswith('zlib:')
+    assert sorted(x[1]['tg_chat_id'] for x in p.call_args_list) == [0, 1, 2]
+
+
+def test_is_fanout_step():
+    payload, = _build_envelope(1)
+    envelope = json.loads(payload)
+    envelope['fanout_id'] = str(ObjectId())
+
+    assert not BaseMassMessageQueue.is_fanout_step(envelope)
+    assert not BaseMassMessageQueue.is_fanout_step([payload])
+    assert BaseMassMessageQueue.is_fanout_step(
+        json.loads(BaseMassMessageQueue._serialize_fanout_step(ObjectId(), None))
+    )
+
+
+def _build_fanout_envelope():
+    queue = InMemoryMassQueue()
+    queue.push_super_batch(
+        message_and_user=((Reply(text='Soup'), Recipient(chat_id=i)) for i in range(3)),
+        workflow=Workflow.DEMAND,
+        fanout_id=ObjectId(),
+    )
+    return queue.super_batches[0]
+
+
+def test_super_send_mass_messages__fanout_envelope():
+    queue = InMemoryAwsMassQueue()
+
+    with patch('rest_food.serverless.get_mass_queue', return_value=queue), \
+            patch.object(queue, 'advance_fanout') as advance_fanout:
+        super_send_mass_messages({'Records': [{'body': _build_fanout_envelope()}]}, None)
+
+    assert advance_fanout.call_count == 0
+    assert [json.loads(x)['messages'][0]['chat_ids'] for x, _ in queue.items[0]] == [[0], [1], [2]]
+
+
+def test_local_mass_queue__fanout_envelope():
+    queue = LocalMassMessageQueue.__new__(LocalMassMessageQueue)
+    payload = _build_fanout_envelope()
+
+    with patch.object(queue, 'advance_fanout') as advance_fanout, patch.object(queue, 'process') as process:
+        queue.handle(payload)
+
+    assert advance_fanout.call_count == 0
+    process.assert_called_once_with(payload)
+
+
+def test_process__expands_envelope():
+    payload, = _build_envelope(4)
+
+    with patch('rest_food.message_queue.send_messages') as p:
+        InMemoryMassQueue().process(payload)
+
+    assert sorted(x[1]['tg_chat_id'] for x in p.call_args_list) == [0, 1, 2, 3]
+    assert p.call_args_list[0][1]['replies'][0].text == 'Soup'
+
+
+def test_process__legacy_format():
+    payload = json.dumps({'reply': {'text': 'Soup'}, 'chat_id': 7, 'workflow': 'demand'})
+
+    with patch('rest_food.message_queue.send_messages') as p:
+        InMemoryMassQueue().process(payload)
+
+    p.assert_called_once_with(tg_chat_id=7, replies=[Reply(text='Soup')], workflow=Workflow.DEMAND)
+
+
+def test_redestrib_super_batch():
+    payload, = _build_envelope(25)
+    queue = InMemoryAwsMassQueue()
+
+    queue.redestrib_super_batch(json.loads(payload))
+
+    assert [len(x) for x in queue.items] == [10, 10, 5]
+    single, deduplication_id = queue.items[0][0]
+    assert json.loads(single)['messages'][0]['chat_ids'] == [0]
+    assert deduplication_id is None
+
+
+def test_redestrib_super_batch__deterministic_deduplication():
+    fanout_id = ObjectId()
+    queue = InMemoryMassQueue()
+    queue.push_super_batch(
+        message_and_user=[(Reply(text='Soup'), Recipient(chat_id=i)) for i in range(3)],
+        workflow=Workflow.DEMAND,
+        fanout_id=fanout_id,
+    )
+    aws_queue = InMemoryAwsMassQueue()
+
+    aws_queue.redestrib_super_batch(json.loads(queue.super_batches[0]))
+
+    assert [x[1] for x in aws_queue.items[0]] == [f'{fanout_id}-{i}' for i in range(3)]
+    assert {json.loads(x[0])['fanout_id'] for x in aws_queue.items[0]} == {str(fanout_id)}
+
+
+def test_process__deactivates_blocked_chats_at_once():
+    payload, = _build_envelope(4)
+    bot = MagicMock()
+    bot.send_message.side_effect = lambda chat_id, **kwargs: _raise_unauthorized() if chat_id % 2 else None
+
+    with patch('rest_food._sync_communication.get_bot', return_value=bot), \
+            patch('rest_food._sync_communication.set_inactive') as set_inactive, \
+            patch('rest_food._sync_communication.set_inactive_many') as set_inactive_many:
+        InMemoryMassQueue().process(payload)
+
+    assert set_inactive.call_count == 0
+    chats, provider = set_inactive_many.call_args[0]
+    assert sorted(chats) == [(1, Workflow.DEMAND), (3, Workflow.DEMAND)]
+
+
+def test_process__delivery_report():
+    fanout_id = ObjectId()
+    queue = InMemoryMassQueue()
+    queue.push_super_batch(
+        message_and_user=((Reply(text='Soup'), Recipient(chat_id=i)) for i in range(6)),
+        workflow=Workflow.DEMAND,
+        fanout_id=fanout_id,
+    )
+    bot = MagicMock()
+    outcomes = {1: _raise_unauthorized, 2: _raise_unexpected}
+    bot.send_message.side_effect = lambda chat_id, **kwargs: outcomes.get(chat_id, lambda: None)()
+
+    with patch('rest_food.message_queue.db_module') as db_module, \
+            patch('rest_food._sync_communication.get_bot', return_value=bot), \
+            patch('rest_food._sync_communication.set_inactive_many'):
+        # Chat 5 was delivered before.
+        db_module.claim_deliveries.side_effect = lambda keys: {x for x in keys if not x.endswith(':5')}
+        queue.process_many(queue.super_batches)
+
+    db_module.count_fanout_deliveries.assert_called_once()
+    counters, = db_module.count_fanout_deliveries.call_args[0]
+    assert counters == {fanout_id: {'delivered': 3, 'blocked': 1, 'failed': 1, 'duplicate': 1}}
+    first, last = db_module.count_fanout_deliveries.call_args[1]['delivery_times'][fanout_id]
+    assert first <= last
+
+
+def _raise_unexpected():
+    raise ValueError()
+
+
+def _raise_unauthorized():
+    raise Unauthorized('Forbidden: bot was blocked by the user')
+
+
+def test_process__skips_delivered():
+    fanout_id = ObjectId()
+    payload = json.dumps({
+        'workflow': 'demand',
+        'fanout_id': str(fanout_id),
+        'messages': [{'reply': {'text': 'Soup'}, 'chat_ids': [1, 2, 3]}],
+    })
+
+    with patch('rest_food.message_queue.send_messages') as p, \
+            patch('rest_food.message_queue.db_module') as db_module:
+        db_module.claim_deliveries.return_value = {f'{fanout_id}:2'}
+        InMemoryMassQueue().process(payload)
+
+    db_module.claim_deliveries.assert_called_once_with([f'{fanout_id}:{i}' for i in (1, 2, 3)])
+    p.assert_called_once_with(tg_chat_id=2, replies=[Reply(text='Soup')], workflow=Workflow.DEMAND)
+
+
+def test_process__confirms_sent():
+    fanout_id = ObjectId()
+    payload = json.dumps({
+        'workflow': 'demand',
+        'fanout_id': str(fanout_id),
+        'messages': [{'reply': {'text': 'Soup'}, 'chat_ids': [1, 2]}],
+    })
+    bot = MagicMock()
+    bot.send_message.side_effect = lambda chat_id, **kwargs: _raise_unexpected() if chat_id == 2 else None
+
+    with patch('rest_food.message_queue.db_module') as db_module, \
+            patch('rest_food._sync_communication.get_bot', return_value=bot):
+        db_module.claim_deliveries.side_effect = set
+        InMemoryMassQueue().process(payload)
+
+    db_module.confirm_deliveries.assert_called_once_with([f'{fanout_id}:1'])
+    db_module.release_deliveries.assert_called_once_with([f'{fanout_id}:2'])
+
+
+def test_process__releases_claims_on_error():
+    fanout_id = ObjectId()
+    payload = json.dumps({
+        'workflow': 'demand',
+        'fanout_id': str(fanout_id),
+        'messages': [{'reply': {'text': 'Soup'}, 'chat_ids': [1, 2, 3]}],
+    })
+
+    with patch('rest_food.message_queue.db_module') as db_module, \
+            patch('rest_food.message_queue.send_messages'):
+        db_module.claim_deliveries.return_value = {f'{fanout_id}:1', f'{fanout_id}:2'}
+        db_module.confirm_deliveries.side_effect = RuntimeError
+
+        with pytest.raises(RuntimeError):
+            InMemoryMassQueue().process(payload)
+
+    # Chat 3 is claimed by another sender.
+    released, = db_module.release_deliveries.call_args[0]
+    assert sorted(released) == [f'{fanout_id}:1', f'{fanout_id}:2']
+
+
+def _raise_timed_out():
+    raise TimedOut()
+
+
+def test_process__retries_with_backoff():
+    fanout_id = ObjectId()
+    payload = json.dumps({
+        'workflow': 'demand',
+        'fanout_id': str(fanout_id),
+        'failures': 1,
+        'messages': [{'reply': {'text': 'Soup'}, 'chat_ids': [1, 2]}],
+    })
+    queue = InMemoryMassQueue()
+    bot = MagicMock()
+    bot.send_message.side_effect = lambda chat_id, **kwargs: _raise_timed_out() if chat_id == 2 else None
+
+    with patch('rest_food.message_queue.db_module') as db_module, \
+            patch('rest_food._sync_communication.get_bot', return_value=bot):
+        db_module.claim_deliveries.side_effect = set
+        queue.process(payload)
+
+    (requeued, delay), = queue.requeued
+    assert requeued['failures'] == 2
+    assert requeued['messages'] == [{'reply': {'text': 'Soup'}, 'chat_ids': [2]}]
+    # Backoff is 4 s for the second failure.
+    assert 2 <= delay <= 4
+    db_module.release_deliveries.assert_called_once_with([f'{fanout_id}:2'])
+    assert db_module.add_dead_letter.call_count == 0
+
+
+def test_process__dead_letter_after_retries():
+    payload = json.dumps({
+        'workflow': 'demand',
+        'failures': 4,
+        'messages': [{'reply': {'text': 'Soup'}, 'chat_ids': [1]}],
+    })
+    queue = InMemoryMassQueue()
+    bot = MagicMock()
+    bot.send_message.side_effect = lambda chat_id, **kwargs: _raise_timed_out()
+
+    with patch('rest_food.message_queue.db_module') as db_module, \
+            patch('rest_food._sync_communication.get_bot', return_value=bot):
+        queue.process(payload)
+
+    assert queue.requeued == []
+    kwargs = db_module.add_dead_letter.call_args[1]
+    assert kwargs['queue'] == SendQueue.MASS
+    assert 'TimedOut' in kwargs['error']
+    # Retries start over once it's replayed.
+    assert json.loads(kwargs['payload']) == {
+        'workflow': 'demand', 'messages': [{'reply': {'text': 'Soup'}, 'chat_ids': [1]}],
+    }
+
+
+class InMemorySingleQueue(BaseSingleMessageQueue):
+    def __init__(self):
+        self.batches = []
+        self.requeued = []
+
+    def _put_serialized_batch(self, items):
+        self.batches.append(items)
+
+    def requeue(self, data, *, tg_chat_id, delay):
+        self.requeued.append((json.loads(data), delay))
+
+
+def _build_single_payload(**kwargs):
+    return json.dumps({
+        'tg_chat_id': 1,
+        'original_message': None,
+        'replies': [{'text': 'OK'}],
+        'workflow': 'demand',
+        **kwargs,
+    })
+
+
+def test_single_queue__retries_with_backoff():
+    queue = InMemorySingleQueue()
+
+    with patch('rest_food.message_queue.send_messages', side_effect=RetryLater(10)):
+        queue.process(_build_single_payload())
+
+    (data, delay), = queue.requeued
+    assert data['failures'] == 1
+    assert 11 <= delay <= 12
+
+
+def test_single_queue__throttled_is_not_a_failure():
+    queue = InMemorySingleQueue()
+
+    with patch('rest_food.message_queue.send_messages', side_effect=RetryLater(1, is_failure=False)), \
+            patch('rest_food.message_queue.db_module') as db_module:
+        queue.process(_build_single_payload(failures=4))
+
+    (data, _), = queue.requeued
+    assert data['failures'] == 4
+    assert db_module.add_dead_letter.call_count == 0
+
+
+def test_single_queue__dead_letter():
+    queue = InMemorySingleQueue()
+
+    with patch('rest_food.message_queue.send_messages', side_effect=ValueError()), \
+            patch('rest_food.message_queue.db_module') as db_module:
+        queue.process(_build_single_payload(failures=2))
+
+    assert queue.requeued == []
+    kwargs = db_module.add_dead_letter.call_args[1]
+    assert kwargs['queue'] == SendQueue.SINGLE
+    assert json.loads(kwargs['payload']) == json.loads(_build_single_payload())
+
+
+def test_single_queue__buffered():
+    queue = InMemorySingleQueue()
+
+    with queue.buffered():
+        queue.put(tg_chat_id=1, replies=[Reply(text='OK')], workflow=Workflow.DEMAND)
+        queue.put(tg_chat_id=1, replies=[Reply(text='Name?')], workflow=Workflow.DEMAND)
+        assert queue.batches == []
+
+    queue.put(tg_chat_id=2, replies=[Reply(text='Hi')], workflow=Workflow.SUPPLY)
+
+    assert [[(chat_id, json.loads(data)['replies'][0]['text']) for chat_id, data in x] for x in queue.batches] == [
+        [(1, 'OK'), (1, 'Name?')],
+        [(2, 'Hi')],
+    ]
+
+
+def _build_callback_message():
+    return TgMessage.de_json({
+        'message_id': 7,
+        'date': 0,
+        'chat': {'id': 1, 'type': 'private'},
+        'from': {'id': 2, 'is_bot': True, 'first_name': 'Bot'},
+        'text': 'Offer',
+        'reply_markup': {'inline_keyboard': [[{'text': 'Take it', 'callback_data': 'c|take'}]]},
+    }, None)
+
+
+def test_single_queue__slim_envelope():
+    queue = InMemorySingleQueue()
+
+    queue.put(
+        tg_chat_id=1, original_message=_build_callback_message(), replies=[Reply(text='OK'), None],
+        workflow=Workflow.DEMAND,
+    )
+
+    (_, data), = queue.batches[0]
+    assert json.loads(data) == {
+        'version': 2,
+        'tg_chat_id': 1,
+        'original_message': {'message_id': 7, 'has_text': True},
+        'replies': [{'text': 'OK'}],
+        'workflow': 'demand',
+    }
+
+    with patch('rest_food.message_queue.send_messages') as send_messages:
+        queue.process(data)
+
+    send_messages.assert_called_once_with(
+        tg_chat_id=1,
+        original_message=OriginalMessage(message_id=7, has_text=True),
+        replies=[Reply(text='OK')],
+        workflow=Workflow.DEMAND,
+    )
+
+
+def test_single_queue__legacy_envelope():
+    data = json.dumps({
+        'tg_chat_id': 1,
+        'original_message': _build_callback_message().to_dict(),
+        'replies': [{'text': 'OK', 'buttons': None, 'coordinates': None, 'is_text_buttons': False}],
+        'workflow': 'demand',
+    })
+
+    with patch('rest_food.message_queue.send_messages') as send_messages:
+        InMemorySingleQueue().process(data)
+
+    assert send_messages.call_args[1]['original_message'] == OriginalMessage(message_id=7, has_text=True)
+    assert send_messages.call_args[1]['replies'] == [Reply(text='OK')]
+
+
+def test_aws_single_queue__send_message_batch():
+    queue = AwsSingleMessageQueue.__new__(AwsSingleMessageQueue)
+    queue._queue = MagicMock()
+    queue._queue.send_messages.return_value = {'Successful': []}
+
+    queue._put_serialized_batch([(i % 3, str(i)) for i in range(23)])
+
+    entries = [x[1]['Entries'] for x in queue._queue.send_messages.call_args_list]
+    assert [len(x) for x in entries] == [10, 10, 3]
+    assert [x['MessageBody'] for x in entries[0]] == [str(i) for i in range(10)]
+    assert {x['MessageGroupId'] for x in entries[0] if int(x['MessageBody']) % 3 == 1} == {'1'}
+
+
+def test_aws_single_queue__failed_entries():
+    queue = AwsSingleMessageQueue.__new__(AwsSingleMessageQueue)
+    queue._queue = MagicMock()
+    queue._queue.send_messages.side_effect = [
+        {'Failed': [{'Id': '1', 'SenderFault': False}, {'Id': '2', 'SenderFault': False}]},
+        {'Failed': [{'Id': '2', 'SenderFault': False}]},
+    ]
+
+    with pytest.raises(RuntimeError):
+        queue._put_serialized_batch([(i, str(i)) for i in range(3)])
+
+    first, retry = [x[1]['Entries'] for x in queue._queue.send_messages.call_args_list]
+    assert retry == first[1:]
+
+    queue._queue.send_messages.side_effect = [{'Failed': [{'Id': '0', 'SenderFault': False}]}, {}]
+    queue._put_serialized_batch([(0, '0')])
+
+
+def _build_fanout(last_user_id=None):
+    return Fanout(
+        fanout_id=ObjectId(),
+        message_id=str(ObjectId()),
+        owner_id=ObjectId(),
+        location='by:minsk',
+        workflow=Workflow.DEMAND,
+        templates={'be': {'text': 'Суп'}, 'ru': {'text': 'Суп'}, 'en': {'text': 'Soup'}},
+        state=FanoutState.RUNNING,
+        last_user_id=last_user_id,
+    )
+
+
+def _iter_audience(user_ids, *, after_id=None, limit=0, progress=None):
+    for user_id in user_ids:
+        if after_id is not None and user_id <= after_id:
+            continue
+
+        if progress is not None:
+            progress.append(user_id)
+
+        yield Recipient(_id=user_id, chat_id=hash(user_id) % 10**6, language='en')
+
+
+def _get_published_states(message_ids):
+    return {x: MessageState.PUBLISHED for x in message_ids}
+
+
+def _advance(queue, fanout, user_ids, progress=None):
+    def iter_audience(location, *, after_id=None, limit=0, **filters):
+        return islice(_iter_audience(user_ids, after_id=after_id, progress=progress), limit)
+
+    with patch('rest_food.message_queue.db_module') as db_module:
+        db_module.claim_fanout.return_value = fanout
+        db_module.get_message_states.side_effect = _get_published_states
+        db_module.iter_demand_audience.side_effect = iter_audience
+        queue.advance_fanout(fanout.fanout_id, fanout.last_user_id)
+
+    return db_module
+
+
+def _assert_checkpoint(db_module, fanout, **kwargs):
+    assert db_module.checkpoint_fanout.call_count == 1
+    args, call_kwargs = db_module.checkpoint_fanout.call_args
+    assert args == (fanout.fanout_id, )
+    assert {k: call_kwargs[k] for k in kwargs} == kwargs
+
+
+def test_advance_fanout__checkpoints():
+    user_ids = sorted(ObjectId() for _ in range(2500))
+    queue = InMemoryMassQueue()
+    fanout = _build_fanout()
+
+    db_module = _advance(queue, fanout, user_ids)
+
+    _assert_checkpoint(db_module, fanout, last_user_id=user_ids[999], enqueued=1000, is_done=False)
+    assert queue.fanout_steps == [(fanout.fanout_id, user_ids[999])]
+    assert len(queue.super_batches) == 10
+
+    fanout.last_user_id = user_ids[1999]
+    db_module = _advance(queue, fanout, user_ids)
+
+    _assert_checkpoint(db_module, fanout, last_user_id=user_ids[-1], enqueued=500, is_done=True)
+    assert len(queue.fanout_steps) == 1
+
+
+def test_advance_fanout__paced():
+    user_ids = sorted(ObjectId() for _ in range(4000))
+    queue = InMemoryMassQueue()
+    queue.fanout_delivery_window = 400
+    fanout = _build_fanout()
+    fanout.audience_size = 4000
+    fanout.created_at = datetime.datetime.utcnow() - datetime.timedelta(seconds=10)
+
+    db_module = _advance(queue, fanout, user_ids)
+
+    # 1000 of 4000 recipients are queued: the next step is due in 100 s since start.
+    assert 89 < queue.fanout_step_delays[0] <= 90
+    next_step_at = db_module.checkpoint_fanout.call_args[1]['next_step_at']
+    assert 89 < (next_step_at - datetime.datetime.utcnow()).total_seconds() <= 90
+
+
+def test_advance_fanout__behind_schedule():
+    user_ids = sorted(ObjectId() for _ in range(4000))
+    queue = InMemoryMassQueue()
+    queue.fanout_delivery_window = 400
+    fanout = _build_fanout()
+    fanout.audience_size = 4000
+    fanout.created_at = datetime.datetime.utcnow() - datetime.timedelta(seconds=300)
+
+    _advance(queue, fanout, user_ids)
+
+    assert queue.fanout_step_delays == [0]
+
+
+def test_advance_fanout__dormant_last():
+    user_ids = sorted(ObjectId() for _ in range(10))
+    queue = InMemoryMassQueue()
+    fanout = _build_fanout()
+    fanout.dormant_before = datetime.datetime.utcnow() - datetime.timedelta(days=90)
+    fanout.dormant_audience = DormantAudience.LAST
+
+    db_module = _advance(queue, fanout, user_ids)
+
+    assert db_module.iter_demand_audience.call_args[1]['seen_since'] == fanout.dormant_before
+    _assert_checkpoint(db_module, fanout, last_user_id=None, is_done=False, start_dormant_pass=True)
+    assert queue.fanout_steps == [(fanout.fanout_id, None)]
+    assert queue.fanout_step_passes == [True]
+
+    fanout.is_dormant_pass = True
+    db_module = _advance(queue, fanout, user_ids)
+
+    assert db_module.iter_demand_audience.call_args[1]['seen_before'] == fanout.dormant_before
+    _assert_checkpoint(db_module, fanout, last_user_id=user_ids[-1], is_done=True, start_dormant_pass=False)
+    assert len(queue.fanout_steps) == 1
+
+
+def test_advance_fanout__notification_cap():
+    user_ids = sorted(ObjectId() for _ in range(10))
+    queue = InMemoryMassQueue()
+    queue.notification_cap = 3
+    fanout = _build_fanout()
+
+    with patch('rest_food.message_queue.db_module') as db_module:
+        db_module.claim_fanout.return_value = fanout
+        db_module.get_message_states.side_effect = _get_published_states
+        db_module.iter_demand_audience.side_effect = lambda location, **kwargs: _iter_audience(user_ids, **kwargs)
+        db_module.take_notification_quota.side_effect = lambda ids, **kwargs: set(ids[:6])
+        queue.advance_fanout(fanout.fanout_id, fanout.last_user_id)
+
+    assert db_module.take_notification_quota.call_args[1] == {'limit': 3, 'period': queue.notification_cap_period}
+    assert db_module.count_fanout_deliveries.call_args[0] == ({fanout.fanout_id: {'capped': 4}}, )
+    _assert_checkpoint(db_module, fanout, last_user_id=user_ids[-1], enqueued=6, is_done=True)
+
+
+def test_local_runtime__put_later():
+    handled = []
+    runtime = _build_runtime(handled)
+
+    runtime.put_later('bulk', 'second', delay=0.2)
+    runtime.put_later('bulk', 'first', delay=0.1)
+    time.sleep(0.4)
+    runtime.stop()
+    runtime.read_queue()
+
+    assert handled == [('bulk', 'first'), ('bulk', 'second')]
+
+
+def test_advance_fanout__offer_is_not_available():
+    queue = InMemoryMassQueue()
+    fanout = _build_fanout()
+
+    with patch('rest_food.message_queue.db_module') as db_module:
+        db_module.claim_fanout.return_value = fanout
+        db_module.get_message_states.return_value = {fanout.message_id: MessageState.BOOKED}
+        queue.advance_fanout(fanout.fanout_id, None)
+
+    assert db_module.iter_demand_audience.call_count == 0
+    db_module.checkpoint_fanout.assert_called_once_with(fanout.fanout_id, last_user_id=None, enqueued=0, is_done=True)
+    assert queue.fanout_steps == []
+
+
+def test_process__skips_stale_offers():
+    fanout_id = ObjectId()
+    live_message_id, booked_message_id = str(ObjectId()), str(ObjectId())
+    queue = InMemoryMassQueue()
+    for message_id in (live_message_id, booked_message_id):
+        queue.push_super_batch(
+            message_and_user=((Reply(text='Soup'), Recipient(chat_id=i)) for i in range(3)),
+            workflow=Workflow.DEMAND,
+            fanout_id=fanout_id,
+            message_id=message_id,
+        )
+
+    with patch('rest_food.message_queue.db_module') as db_module, \
+            patch('rest_food.message_queue.send_messages') as send_messages:
+        db_module.get_message_states.return_value = {live_message_id: MessageState.PUBLISHED}
+        db_module.claim_deliveries.side_effect = set
+        queue.process_many(queue.super_batches)
+        queue.process_many(queue.super_batches)
+
+    assert send_messages.call_count == 6
+    db_module.get_message_states.assert_called_once_with({live_message_id, booked_message_id})
+    counters = db_module.count_fanout_deliveries.call_args[0][0]
+    assert counters == {fanout_id: {'stale': 3, 'delivered': 3}}
+
+
+def test_redestrib_super_batch__stale_offer():
+    fanout_id = ObjectId()
+    message_id = str(ObjectId())
+    queue = InMemoryAwsMassQueue()
+    data = {
+        'workflow': 'demand',
+        'fanout_id': str(fanout_id),
+        'message_id': message_id,
+        'messages': [{'reply': {'text': 'Soup'}, 'chat_ids': [1, 2]}],
+    }
+
+    with patch('rest_food.message_queue.db_module') as db_module:
+        db_module.get_message_states.return_value = {message_id: MessageState.DEACTIVATED}
+        queue.redestrib_super_batch(data)
+
+    assert queue.items == []
+    db_module.count_fanout_deliveries.assert_called_once_with({fanout_id: {'stale': 2}})
+
+
+@pytest.mark.parametrize('grouping, shards, expected', [
+    (SuperBatchGrouping.COMMON, 1, [['CommonGroup'] * 3, ['CommonGroup'] * 3]),
+    (SuperBatchGrouping.FANOUT, 1, [['fanout-a'] * 3, ['fanout-b'] * 3]),
+    (SuperBatchGrouping.FANOUT, 2, [['fanout-a', 'fanout-a-1', 'fanout-a'], ['fanout-b', 'fanout-b-1', 'fanout-b']]),
+    (SuperBatchGrouping.LOCATION, 1, [['location-minsk'] * 3, ['location-minsk'] * 3]),
+])
+def test_push_super_batch__group_ids(grouping, shards, expected):
+    queue = InMemoryMassQueue()
+    queue.super_batch_grouping = grouping
+    queue.super_batch_group_shards = shards
+    group_ids = []
+
+    for fanout_id in ('a', 'b'):
+        queue.group_ids = []
+        queue.push_super_batch(
+            message_and_user=((Reply(text='Soup'), Recipient(chat_id=i)) for i in range(250)),
+            workflow=Workflow.DEMAND,
+            fanout_id=fanout_id,
+            location='by:minsk',
+        )
+        group_ids.append(queue.group_ids)
+
+    location_group = 'location-' + sha256(b'by:minsk').hexdigest()[:16]
+    assert group_ids == [[x.replace('location-minsk', location_group) for x in ids] for ids in expected]
+
+
+def test_advance_fanout__group_shards_rotate_over_steps():
+    user_ids = sorted(ObjectId() for _ in range(300))
+    queue = InMemoryMassQueue()
+    queue.fanout_step_size = queue.super_batch_size
+    queue.super_batch_grouping = SuperBatchGrouping.FANOUT
+    queue.super_batch_group_shards = 3
+    fanout = _build_fanout()
+
+    for _ in range(3):
+        db_module = _advance(queue, fanout, user_ids)
+        fanout.enqueued += db_module.checkpoint_fanout.call_args[1]['enqueued']
+        fanout.last_user_id = db_module.checkpoint_fanout.call_args[1]['last_user_id']
+
+    group = f'fanout-{fanout.fanout_id}'
+    assert queue.group_ids == [group, f'{group}-1', f'{group}-2']
+
+
+def _build_aws_mass_queue():
+    queue = AwsMassMessageQueue.__new__(AwsMassMessageQueue)
+    queue._super_queue = MagicMock()
+    return queue
+
+
+def test_aws_put_fanout_step__own_group():
+    fanout_id = ObjectId()
+    queue = _build_aws_mass_queue()
+    queue.super_batch_group_shards = 4
+
+    queue.push_super_batch(
+        message_and_user=((Reply(text='Soup'), Recipient(chat_id=i)) for i in range(10000)),
+        workflow=Workflow.DEMAND,
+        fanout_id=fanout_id,
+    )
+    queue.put_fanout_step(fanout_id, last_user_id=ObjectId())
+
+    *super_batches, step = [x[1]['MessageGroupId'] for x in queue._super_queue.send_message.call_args_list]
+    assert step == f'step-{fanout_id}'
+    assert step not in super_batches
+
+
+def test_aws_put_fanout_step__dormant_pass_deduplication():
+    fanout_id = ObjectId()
+    queue = _build_aws_mass_queue()
+
+    queue.put_fanout_step(fanout_id, last_user_id=None)
+    queue.put_fanout_step(fanout_id, last_user_id=None, is_dormant_pass=True)
+
+    first, dormant = [x[1]['MessageDeduplicationId'] for x in queue._super_queue.send_message.call_args_list]
+    assert first != dormant
+
+
+def test_advance_fanout__claimed_by_another_worker():
+    queue = InMemoryMassQueue()
+
+    with patch('rest_food.message_queue.db_module') as db_module:
+        db_module.claim_fanout.return_value = None
+        queue.advance_fanout(ObjectId(), None)
+
+    assert db_module.iter_demand_audience.call_count == 0
+    assert queue.super_batches == []
+
+
+def test_advance_fanout__failure_releases_lease():
+    queue = InMemoryMassQueue()
+    fanout = _build_fanout()
+
+    with patch('rest_food.message_queue.db_module') as db_module, \
+            patch.object(queue, 'put_super_batch_into_queue', side_effect=RuntimeError):
+        db_module.claim_fanout.return_value = fanout
+        db_module.get_message_states.side_effect = _get_published_states
+        db_module.iter_demand_audience.return_value = _iter_audience([ObjectId()])
+
+        with pytest.raises(RuntimeError):
+            queue.advance_fanout(fanout.fanout_id, None)
+
+    db_module.release_fanout.assert_called_once_with(fanout.fanout_id)
+    assert db_module.checkpoint_fanout.call_count == 0
+
+
+def _build_runtime(handled, *, max_size=10):
+    return LocalWorkerRuntime(
+        OrderedDict((
+            ('interactive', lambda x: handled.append(('interactive', x))),
+            ('bulk', lambda x: handled.append(('bulk', x))),
+        )),
+        max_size=max_size,
+        put_timeout=0,
+        queue_factory=queue.Queue,
+        event_factory=threading.Event,
+    )
+
+
+def test_local_runtime__interactive_first():
+    handled = []
+    runtime = _build_runtime(handled)
+    for i in range(3):
+        runtime.put('bulk', 'fanout-%s' % i)
+    runtime.put('interactive', 'button')
+    runtime.stop()
+
+    runtime.read_queue()
+
+    assert handled == [('interactive', 'button'), ('bulk', 'fanout-0'), ('bulk', 'fanout-1'), ('bulk', 'fanout-2')]
+
+
+def test_local_runtime__full_lane_is_handled_by_producer():
+    handled = []
+    runtime = _build_runtime(handled, max_size=1)
+
+    runtime.put('bulk', 'queued')
+    runtime.put('bulk', 'overflow')
+
+    assert handled == [('bulk', 'overflow')]
+
+
+def test_local_runtime__handler_failure():
+    runtime = LocalWorkerRuntime(
+        {'bulk': MagicMock(side_effect=[Exception, None])},
+        put_timeout=0,
+        queue_factory=queue.Queue,
+        event_factory=threading.Event,
+    )
+    runtime.put('bulk', 'broken')
+    runtime.put('bulk', 'fine')
+    runtime.stop()
+
+    runtime.read_queue()
+
+    assert runtime._handlers['bulk'].call_count == 2
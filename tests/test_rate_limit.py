@@ -0,0 +1,97 @@
+from unittest.mock import patch, MagicMock
+
+import pytest
+from telegram.error import RetryAfter
+
+from rest_food._sync_communication import RateLimitedBot
+from rest_food.exceptions import RetryLater
+from rest_food.rate_limit import LocalRateLimitStore, RateLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    clock = FakeClock()
+    with patch('rest_food.rate_limit.time', clock):
+        yield clock
+
+
+def test_local_store__reserve():
+    store = LocalRateLimitStore()
+
+    assert [store.reserve('k', rate=1, capacity=2, now=0, max_wait=5) for _ in range(4)] == [0, 0, 1, 2]
+    # Not reserved.
+    assert store.reserve('k', rate=1, capacity=2, now=0, max_wait=2) == 3
+    assert store.reserve('k', rate=1, capacity=2, now=0.5, max_wait=5) == 2.5
+    assert store.reserve('k', rate=1, capacity=2, now=100, max_wait=5) == 0
+    assert store.reserve('k', rate=1, capacity=2, now=100, max_wait=5) == 0
+    assert store.reserve('k', rate=1, capacity=2, now=100, max_wait=5) == 1
+
+
+def test_local_store__block():
+    store = LocalRateLimitStore()
+    store.block('k', until=10)
+
+    assert store.reserve('k', rate=100, capacity=100, now=4, max_wait=5) == 6
+    assert store.reserve('k', rate=100, capacity=100, now=4, max_wait=6) == 6
+
+
+def test_rate_limiter__waits(clock):
+    limiter = RateLimiter(
+        LocalRateLimitStore(), bot_rate=30, bot_burst=30, chat_rate=1, chat_burst=1, max_wait=5
+    )
+
+    for chat_id in range(60):
+        limiter.acquire('bot', chat_id)
+
+    assert clock.now == pytest.approx(1001)
+
+
+def test_rate_limiter__retry_later(clock):
+    limiter = RateLimiter(
+        LocalRateLimitStore(), bot_rate=30, bot_burst=30, chat_rate=1, chat_burst=1, max_wait=5
+    )
+    limiter.penalize('bot', 20)
+
+    with pytest.raises(RetryLater) as e:
+        limiter.acquire('bot', 1)
+
+    assert e.value.retry_after == 20
+
+
+def test_rate_limiter__bot_bucket_first(clock):
+    store = LocalRateLimitStore()
+    limiter = RateLimiter(store, bot_rate=30, bot_burst=30, chat_rate=1, chat_burst=1, max_wait=5)
+    limiter.penalize('bot', 20)
+
+    with pytest.raises(RetryLater):
+        limiter.acquire('bot', 1)
+
+    assert list(store._buckets) == ['bot']
+
+
+def test_rate_limited_bot__retry_after(clock):
+    limiter = RateLimiter(LocalRateLimitStore(), max_wait=5)
+    bot = MagicMock()
+    bot.send_message.side_effect = RetryAfter(12)
+    limited_bot = RateLimitedBot(bot, token='token', rate_limiter=limiter)
+
+    with pytest.raises(RetryLater) as e:
+        limited_bot.send_message(chat_id=1, text='text')
+
+    assert e.value.retry_after == 12
+
+    with pytest.raises(RetryLater):
+        limited_bot.edit_message_text('text', 2, message_id=3)
+
+    assert bot.edit_message_text.call_count == 0
@@ -0,0 +1,23 @@
+from rest_food.retry import RetryPolicy
+
+
+def test_retry_policy__exponential_backoff():
+    policy = RetryPolicy(max_attempts=5, base_delay=2, max_delay=10)
+
+    delays = [policy.get_delay(failures) for failures in range(5)]
+
+    assert [1 <= delays[0] <= 2, 1 <= delays[1] <= 2, 2 <= delays[2] <= 4, 4 <= delays[3] <= 8] == [True] * 4
+    # Capped.
+    assert 5 <= delays[4] <= 10
+
+
+def test_retry_policy__honors_retry_after():
+    policy = RetryPolicy(max_attempts=5, base_delay=2, max_delay=10)
+
+    assert 31 <= policy.get_delay(1, retry_after=30) <= 32
+
+
+def test_retry_policy__attempts_are_over():
+    policy = RetryPolicy(max_attempts=5, base_delay=2, max_delay=10)
+
+    assert policy.get_delay(5) is None
@@ -0,0 +1,30 @@
+import os
+import re
+
+
+SERVERLESS_YAML = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'serverless.yaml')
+
+
+def test_lambda_role_covers_queues():
+    with open(SERVERLESS_YAML) as f:
+        config = f.read()
+
+    resources, functions = config.split('functions:')
+    queue_arn = r'arn:aws:sqs:[\w-]+:\$\{env:AWS_USER_ID\}:(\S+)'
+    allowed = set(re.findall(queue_arn, resources))
+
+    # Lambdas also send to the queues they consume, e.g. fan-out steps and retries.
+    assert set(re.findall(queue_arn, functions)) <= allowed
+
+
+def test_environment_covers_settings():
+    with open(SERVERLESS_YAML) as f:
+        environment = f.read().split('environment:')[1].split('iamRoleStatements:')[0]
+
+    with open(os.path.join(os.path.dirname(SERVERLESS_YAML), 'rest_food', 'settings.py')) as f:
+        settings = set(re.findall(r"env_var\('(\w+)'", f.read()))
+
+    # Local queue workers are not used on AWS. The webhook path key is only used to deploy and set webhooks.
+    settings -= {x for x in settings if x.startswith('LOCAL_QUEUE_')} | {'BOT_PATH_KEY'}
+
+    assert settings <= set(re.findall(r'^ {4}(\w+): \$\{env:\1\b', environment, re.MULTILINE))
@@ -0,0 +1,171 @@
+from collections import Counter
+from decimal import Decimal
+from unittest.mock import patch, MagicMock
+
+from telegram.error import Unauthorized, BadRequest, RetryAfter, TimedOut
+
+from rest_food._sync_communication import plan_tg_calls, send_messages, build_inline_tg_response, FakeBot
+from rest_food.entities import Reply, OriginalMessage
+from rest_food.enums import Workflow
+
+
+def _build_original_message():
+    return OriginalMessage(message_id=7, has_text=True)
+
+
+def test_plan_tg_calls__callback_query():
+    calls = plan_tg_calls(
+        tg_chat_id=42,
+        original_message=_build_original_message(),
+        replies=[Reply(text='Booked'), None, Reply(coordinates=(Decimal('53.9'), Decimal('27.56')))],
+        coalesce=False,
+    )
+
+    assert [x.method for x in calls] == ['edit_message_text', 'send_location', 'delete_message']
+    assert calls[0].kwargs['message_id'] == 7
+    assert calls[1].kwargs['latitude'] == 53.9
+    assert calls[2].kwargs == {'chat_id': 42, 'message_id': 7}
+
+
+def test_plan_tg_calls__merges_text_replies():
+    buttons = [[{'text': 'Info', 'data': 'c|info'}]]
+
+    calls = plan_tg_calls(
+        tg_chat_id=42,
+        original_message=_build_original_message(),
+        replies=[Reply(text='Booked'), Reply(text='Choose', buttons=buttons), Reply(text='Or type')],
+    )
+
+    assert [x.method for x in calls] == ['edit_message_text', 'send_message']
+    assert calls[0].kwargs['text'] == 'Booked\n\nChoose'
+    assert calls[0].kwargs['reply_markup'] == {'inline_keyboard': [[{'text': 'Info', 'callback_data': 'c|info'}]]}
+    # The original message is edited once.
+    assert 'message_id' not in calls[1].kwargs
+
+
+def test_plan_tg_calls__too_long_to_merge():
+    replies = [Reply(text='a' * 3000), Reply(text='b' * 2000)]
+
+    assert [x.kwargs['text'] for x in plan_tg_calls(tg_chat_id=42, replies=replies)] == ['a' * 3000, 'b' * 2000]
+
+
+def test_plan_tg_calls__original_message_is_deleted_once():
+    original_message = _build_original_message()
+    location = Reply(coordinates=(Decimal('53.9'), Decimal('27.56')))
+
+    calls = plan_tg_calls(
+        tg_chat_id=42,
+        original_message=original_message,
+        replies=[location, Reply(text='Choose', buttons=[['Yes', 'No']], is_text_buttons=True), location],
+    )
+
+    assert [x.method for x in calls] == ['send_location', 'delete_message', 'send_message', 'send_location']
+
+
+def test_send_messages__blocked_chat():
+    bot = MagicMock()
+    bot.send_message.side_effect = Unauthorized('Forbidden: bot was blocked by the user')
+
+    with patch('rest_food._sync_communication.get_bot', return_value=bot), \
+            patch('rest_food._sync_communication.set_inactive') as set_inactive:
+        send_messages(tg_chat_id=42, replies=[Reply(text='Hi')], workflow=Workflow.DEMAND)
+
+    assert bot.send_message.call_args[1]['text'] == 'Hi'
+    assert set_inactive.call_args[1]['chat_id'] == 42
+
+
+def test_build_inline_tg_response():
+    reply = Reply(text='Hi', buttons=[[{'text': 'Info', 'data': 'c|info'}]])
+
+    assert build_inline_tg_response(tg_chat_id=42, replies=[reply, None]) == {
+        'method': 'sendMessage',
+        'chat_id': 42,
+        'text': 'Hi',
+        'parse_mode': 'HTML',
+        'reply_markup': {'inline_keyboard': [[{'text': 'Info', 'callback_data': 'c|info'}]]},
+    }
+
+
+def test_build_inline_tg_response__many_calls():
+    buttons = [[{'text': 'Info', 'data': 'c|info'}]]
+
+    assert build_inline_tg_response(
+        tg_chat_id=42, replies=[Reply(text='Hi', buttons=buttons), Reply(text='Choose')]
+    ) is None
+
+
+def _build_fake_bot(**kwargs):
+    options = {
+        'latency': 0,
+        'latency_sigma': 0,
+        'too_many_requests_ratio': 0,
+        'retry_after': 5,
+        'forbidden_ratio': 0,
+        'chat_not_found_ratio': 0,
+        'timeout_ratio': 0,
+        'seed': 1,
+    }
+    options.update(kwargs)
+    return FakeBot(MagicMock(), **options)
+
+
+def test_fake_bot__chat_errors_are_sticky():
+    bot = _build_fake_bot(forbidden_ratio=0.3, chat_not_found_ratio=0.2)
+    outcomes = {}
+
+    for chat_id in list(range(1000)) * 2:
+        try:
+            bot.send_message(chat_id, 'Hi')
+            outcome = 'ok'
+        except Unauthorized:
+            outcome = 'forbidden'
+        except BadRequest as e:
+            assert e.message == 'Chat not found'
+            outcome = 'chat_not_found'
+
+        assert outcomes.setdefault(chat_id, outcome) == outcome
+
+    assert 250 < sum(x == 'forbidden' for x in outcomes.values()) < 350
+    assert 100 < sum(x == 'chat_not_found' for x in outcomes.values()) < 200
+    assert sum(bot.calls.values()) == 2000
+
+
+def test_fake_bot__call_errors():
+    bot = _build_fake_bot(too_many_requests_ratio=0.1, timeout_ratio=0.1)
+    errors = Counter()
+
+    for chat_id in range(1000):
+        try:
+            bot.edit_message_text('Hi', chat_id, message_id=1)
+        except RetryAfter as e:
+            assert e.retry_after == 5
+            errors['too_many_requests'] += 1
+        except TimedOut:
+            errors['timeout'] += 1
+
+    assert 50 < errors['too_many_requests'] < 150 and 50 < errors['timeout'] < 150
+    calls = bot.get_stats()['edit_message_text']['calls']
+    assert {k: calls[k] for k in errors} == errors
+
+
+def test_fake_bot__latency():
+    bot = _build_fake_bot(latency=0.001, latency_sigma=1)
+
+    with patch('rest_food._sync_communication.time.sleep') as sleep:
+        for chat_id in range(200):
+            bot.send_location(chat_id, 53.9, 27.56)
+
+    latencies = [x[0][0] for x in sleep.call_args_list]
+    assert min(latencies) < 0.001 < max(latencies)
+    stats = bot.get_stats()['send_location']
+    assert stats['p50'] < stats['p99']
+
+
+def test_fake_bot__test_chat():
+    bot = _build_fake_bot(forbidden_ratio=1)
+
+    with patch('rest_food._sync_communication.TEST_TG_CHAT_ID', [42]):
+        bot.send_message(chat_id=42, text='Hi')
+
+    bot._bot.send_message.assert_called_once_with(chat_id=42, text='Hi')
+    assert bot.calls == Counter()
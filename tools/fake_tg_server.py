@@ -0,0 +1,142 @@
+"""
+Local stand-in for the Telegram Bot API to be used in load tests.
+    Point the bot to it with `TELEGRAM_API_URL=http://127.0.0.1:{port}/bot`.
+
+Errors can be injected with `too_many_requests_ratio` (429 for a single call)
+    and `forbidden_ratio` (403 for every call to a chat, as if the user blocked the bot).
+"""
+import json
+import random
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from threading import Lock, Thread
+from typing import Dict, Set
+
+
+class BotApiError(Exception):
+    def __init__(self, code: int, description: str, parameters: dict=None):
+        self.code = code
+        self.description = description
+        self.parameters = parameters
+
+
+class FakeTelegramServer:
+    def __init__(
+            self,
+            *,
+            latency: float=0.05,
+            port: int=0,
+            too_many_requests_ratio: float=0.,
+            forbidden_ratio: float=0.,
+            retry_after: int=1,
+            seed: int=None,
+    ):
+        self.latency = latency
+        self.too_many_requests_ratio = too_many_requests_ratio
+        self.forbidden_ratio = forbidden_ratio
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.errors = Counter()
+        self.delivered_at = {}   # type: Dict[int, float]
+        self._forbidden = set()   # type: Set[int]
+        self._seen = set()   # type: Set[int]
+        self._random = random.Random(seed)
+        self._lock = Lock()
+        self._message_ids = count(1)
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), self._build_handler())
+        self._server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:%s/bot' % self._server.server_address[1]
+
+    def start(self):
+        Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.errors.clear()
+            self.delivered_at.clear()
+            self._forbidden.clear()
+            self._seen.clear()
+
+    def _check_errors(self, chat_id: int):
+        if chat_id not in self._seen:
+            self._seen.add(chat_id)
+            if self._random.random() < self.forbidden_ratio:
+                self._forbidden.add(chat_id)
+
+        if chat_id in self._forbidden:
+            self.errors[403] += 1
+            raise BotApiError(403, 'Forbidden: bot was blocked by the user')
+
+        if self._random.random() < self.too_many_requests_ratio:
+            self.errors[429] += 1
+            raise BotApiError(
+                429, 'Too Many Requests: retry after %s' % self.retry_after, {'retry_after': self.retry_after}
+            )
+
+    def handle(self, method: str, params: dict):
+        time.sleep(self.latency)
+        chat_id = int(params.get('chat_id', 0))
+
+        with self._lock:
+            self.calls[method] += 1
+            self._check_errors(chat_id)
+            if method == 'sendMessage':
+                self.delivered_at[chat_id] = time.monotonic()
+
+        if method in ('deleteMessage', 'setWebhook', 'answerCallbackQuery'):
+            return True
+
+        return {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': params.get('text'),
+        }
+
+    def _build_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                params = json.loads(body) if body else {}
+                method = self.path.rsplit('/', 1)[-1]
+
+                try:
+                    status, data = 200, {'ok': True, 'result': server.handle(method, params)}
+                except BotApiError as e:
+                    status, data = e.code, {'ok': False, 'error_code': e.code, 'description': e.description}
+                    if e.parameters:
+                        data['parameters'] = e.parameters
+
+                response = json.dumps(data).encode()
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == '__main__':
+    fake_server = FakeTelegramServer(port=8081)
+    print('Fake Bot API is listening on %s' % fake_server.url)
+    fake_server._server.serve_forever()
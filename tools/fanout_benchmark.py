@@ -0,0 +1,195 @@
+"""
+End-to-end fan-out benchmark: `publish_supply_event` -> fan-out steps -> `push_super_batch` -> `process_many`
+    -> `send_messages`, with the Local* queues, a seeded local Mongo and a fake Bot API.
+
+Every audience size runs in a separate interpreter so that peak RSS is not shared between runs.
+    Delivery latency is measured from `publish_supply_event` call till the fake server receives `sendMessage`.
+
+Usage: `python -m tools.fanout_benchmark --audience 1000 10000 100000 --latency 0.05 --too-many-requests 0.001`
+Requires mongodb at `DB_CONNECTION_STRING` (mongodb://127.0.0.1:27017 by default). `benchmark` database is dropped.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from tools.fake_tg_server import FakeTelegramServer
+
+
+LOCATION = 'benchmark'
+LANGUAGES = ('be', 'ru', 'en')
+
+
+def _configure_env(api_url: str):
+    os.environ.setdefault('DB_CONNECTION_STRING', 'mongodb://127.0.0.1:27017')
+    os.environ.update({
+        'TELEGRAM_API_URL': api_url,
+        'TELEGRAM_TOKEN_SUPPLY': '100:supply',
+        'TELEGRAM_TOKEN_DEMAND': '200:demand',
+        'GOOGLE_API_KEY': '',
+        'DB_NAME': 'benchmark',
+        'STAGE': 'benchmark',
+        # Bot-wide limit is up to Telegram here: the fake server answers 429 if asked to.
+        'TG_BOT_RATE_LIMIT': '1000000',
+        'TG_BOT_RATE_BURST': '1000000',
+    })
+
+
+def _seed(audience_size: int, chunk_size: int=10000):
+    """
+    Returns
+    -------
+    Supply user who is going to publish an offer.
+    """
+    from bson import ObjectId
+    from rest_food import db as db_module
+    from rest_food.enums import MessageState
+
+    db = db_module.db
+    db.client.drop_database(db.name)
+
+    for migration in ('6', '7', '8'):
+        __import__('rest_food.migrations.%s' % migration, fromlist=['forward']).forward()
+    # Same as migration 9 without the slow per-user backfill.
+    db.audience.create_index([('location', 1), ('_id', 1)])
+    db.audience.create_index([('chat_id', 1), ('provider', 1)])
+
+    for start in range(0, audience_size, chunk_size):
+        users = [{
+            '_id': ObjectId(),
+            'user_id': str(chat_id),
+            'chat_id': chat_id,
+            'provider': 'telegram',
+            'workflow': 'demand',
+            'is_active': True,
+            'info': {'location': LOCATION, 'language': LANGUAGES[chat_id % len(LANGUAGES)]},
+        } for chat_id in range(start + 1, min(start + chunk_size, audience_size) + 1)]
+        db.users.insert_many(users)
+        db.audience.insert_many([{
+            '_id': x['_id'],
+            'location': LOCATION,
+            'chat_id': x['chat_id'],
+            'provider': 'telegram',
+            'language': x['info']['language'],
+        } for x in users])
+
+    supply_user_id = ObjectId()
+    message_id = ObjectId()
+    db.users.insert_one({
+        '_id': supply_user_id,
+        'user_id': 'supply',
+        'chat_id': 0,
+        'provider': 'telegram',
+        'workflow': 'supply',
+        'is_active': True,
+        'editing_message_id': str(message_id),
+        'info': {'location': LOCATION, 'name': 'Cafe', 'language': 'en'},
+    })
+    # Senders skip offers which are not published.
+    db.messages.insert_one({
+        '_id': message_id,
+        'owner_id': supply_user_id,
+        'products': ['Soup', 'Bread'],
+        'state': MessageState.PUBLISHED.value,
+    })
+
+    return db_module.get_user_by_id(str(supply_user_id))
+
+
+def _percentile(values, ratio: float) -> float:
+    if not values:
+        return 0.
+
+    values = sorted(values)
+    return values[min(int(len(values) * ratio), len(values) - 1)]
+
+
+def run_one(audience_size: int, *, latency: float, too_many_requests: float, forbidden: float, timeout: float):
+    server = FakeTelegramServer(
+        latency=latency, too_many_requests_ratio=too_many_requests, forbidden_ratio=forbidden, seed=audience_size,
+    ).start()
+    _configure_env(server.url)
+
+    from rest_food import db as db_module
+    from rest_food.communication import publish_supply_event
+    from rest_food.message_queue import get_local_runtime
+
+    supply_user = _seed(audience_size)
+    runtime = get_local_runtime()
+
+    start = time.monotonic()
+    publish_supply_event(supply_user)
+
+    while len(server.delivered_at) + server.errors[403] < audience_size and time.monotonic() - start < timeout:
+        time.sleep(0.05)
+    duration = time.monotonic() - start
+
+    runtime.stop()
+    server.stop()
+
+    latencies = [x - start for x in server.delivered_at.values()]
+    return {
+        'audience': audience_size,
+        'delivered': len(server.delivered_at),
+        'blocked': server.errors[403],
+        'too_many_requests': server.errors[429],
+        'api_calls': sum(server.calls.values()),
+        'deactivated': audience_size - db_module.db.audience.count_documents({'location': LOCATION}),
+        'seconds': duration,
+        'messages_per_second': len(server.delivered_at) / duration,
+        'p50': _percentile(latencies, 0.5),
+        'p99': _percentile(latencies, 0.99),
+        # Kilobytes on linux.
+        'parent_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'workers_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def _print_report(results):
+    print('%9s %9s %7s %6s %8s %9s %8s %8s %10s %11s' % (
+        'audience', 'delivered', 'blocked', '429', 'seconds', 'msg/s', 'p50, s', 'p99, s', 'parent, MB', 'workers, MB'
+    ))
+    for x in results:
+        print('%9d %9d %7d %6d %8.1f %9.1f %8.2f %8.2f %10.1f %11.1f' % (
+            x['audience'], x['delivered'], x['blocked'], x['too_many_requests'], x['seconds'],
+            x['messages_per_second'], x['p50'], x['p99'], x['parent_rss_mb'], x['workers_rss_mb'],
+        ))
+
+
+parser = argparse.ArgumentParser(description='Measure fan-out throughput against a fake Bot API.')
+parser.add_argument('--audience', type=int, nargs='+', default=[1000, 10000, 100000])
+parser.add_argument('--latency', type=float, default=0.05, help='Bot API response time, s')
+parser.add_argument('--too-many-requests', type=float, default=0.001, help='ratio of calls answered with 429')
+parser.add_argument('--forbidden', type=float, default=0.05, help='ratio of chats which blocked the bot')
+parser.add_argument('--timeout', type=float, default=3600, help='give up a run after this time, s')
+parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+
+
+if __name__ == '__main__':
+    arguments = parser.parse_args()
+    options = {
+        'latency': arguments.latency,
+        'too_many_requests': arguments.too_many_requests,
+        'forbidden': arguments.forbidden,
+        'timeout': arguments.timeout,
+    }
+
+    if arguments.single:
+        print(json.dumps(run_one(arguments.audience[0], **options)))
+        sys.exit()
+
+    results = []
+    for audience_size in arguments.audience:
+        output = subprocess.run(
+            [sys.executable, '-m', 'tools.fanout_benchmark', '--single', '--audience', str(audience_size)] +
+            ['--%s=%s' % (key.replace('_', '-'), value) for key, value in options.items()],
+            check=True,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    _print_report(results)
@@ -0,0 +1,86 @@
+"""
+Compares the mass sender against a local fake Bot API:
+    * `sequential` -- a new Bot per message and one message at a time (how it used to work);
+    * `pooled` -- `BaseMassMessageQueue.process_many` with a shared Bot and concurrent sends.
+
+Usage: `python -m tools.send_benchmark [number of messages] [latency, s]`
+"""
+import json
+import os
+import sys
+import time
+
+from tools.fake_tg_server import FakeTelegramServer
+
+
+def _configure_env(api_url: str):
+    os.environ.update({
+        'TELEGRAM_API_URL': api_url,
+        'TELEGRAM_TOKEN_SUPPLY': '100:supply',
+        'TELEGRAM_TOKEN_DEMAND': '200:demand',
+        'GOOGLE_API_KEY': '',
+        'DB_CONNECTION_STRING': 'mongodb://127.0.0.1:27017',
+        'DB_NAME': 'benchmark',
+        'STAGE': 'benchmark',
+        # Measure the sender itself rather than Telegram limits.
+        'TG_BOT_RATE_LIMIT': '1000000',
+        'TG_BOT_RATE_BURST': '1000000',
+    })
+
+
+def _build_envelopes(messages_count: int, batch_size: int=10):
+    reply = {'text': 'Soup', 'buttons': [[{'text': 'Take it', 'data': 'take|1'}]]}
+    return [
+        json.dumps({
+            'workflow': 'demand',
+            'messages': [{'reply': reply, 'chat_ids': list(range(i, min(i + batch_size, messages_count)))}],
+        })
+        for i in range(0, messages_count, batch_size)
+    ]
+
+
+def run_sequential(envelopes, api_url):
+    from telegram import Bot
+    from rest_food.settings import TELEGRAM_TOKEN_DEMAND
+
+    for envelope in envelopes:
+        data = json.loads(envelope)
+        for message in data['messages']:
+            for chat_id in message['chat_ids']:
+                Bot(TELEGRAM_TOKEN_DEMAND, base_url=api_url).send_message(
+                    chat_id=chat_id, text=message['reply']['text']
+                )
+
+
+def run_pooled(envelopes, api_url):
+    from rest_food.message_queue import BaseMassMessageQueue
+
+    class BenchmarkQueue(BaseMassMessageQueue):
+        def requeue(self, payload: str, *, delay: float):
+            raise AssertionError('Nothing should be postponed.')
+
+    BenchmarkQueue().process_many(envelopes)
+
+
+def run(messages_count: int=500, latency: float=0.05):
+    server = FakeTelegramServer(latency=latency).start()
+    _configure_env(server.url)
+    envelopes = _build_envelopes(messages_count)
+
+    try:
+        for runner in (run_sequential, run_pooled):
+            server.calls.clear()
+            start = time.monotonic()
+            runner(envelopes, server.url)
+            duration = time.monotonic() - start
+
+            assert server.calls['sendMessage'] == messages_count
+            print('%-16s %6d messages in %6.2f s: %8.1f messages/s' % (
+                runner.__name__, messages_count, duration, messages_count / duration
+            ))
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    run(*[float(x) if '.' in x else int(x) for x in sys.argv[1:]])